@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fit DTI/DKI and WMTI maps from one DKI fit, and MSDKI on the same data
+(python -m microstructure dki).
+"""
+
+import sys
+from microstructure.cli import main
+
+if __name__ == '__main__':
+    main(['dki'] + sys.argv[1:])
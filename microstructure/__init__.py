@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""
+Shared loading, fitting and output code for the fit_* scripts.
+"""
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+NODDI and SANDI with AMICO.
+
+AMICO reads and writes its own files: the DWI name is relative to the subject
+directory and the results go to <subjectDirectory>/AMICO/<model>.
+"""
+
+import os
+import traceback
+import amico
+import numpy as np
+from microstructure import input_cache, kernel_cache
+from microstructure.cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, file_hash
+from microstructure.instrumentation import RunLog, write_prometheus
+from microstructure.models import AMICO_MODELS, amico_output_dir
+
+
+def cached_inputs(subjectDirectory, dwiFile, maskFile):
+    # AMICO opens the DWI relative to the subject directory.
+    dwiFile = os.path.relpath(input_cache.convert(os.path.join(subjectDirectory, dwiFile)),
+                              subjectDirectory)
+    return dwiFile, input_cache.convert(maskFile, np.uint8)
+
+
+def write_scheme(name, subjectDirectory, bvalFile, bvecFile,
+                 b0_step=100, TE=0.10, Delta=0.020, delta=0.0055, **kwargs):
+    bvalFile = os.path.join(subjectDirectory, bvalFile)
+    bvecFile = os.path.join(subjectDirectory, bvecFile)
+    schemeFile = os.path.join(subjectDirectory, name.upper() + '.scheme')
+    if name == 'noddi':
+        amico.util.fsl2scheme(bvalFile,bvecFile,schemeFilename=schemeFile,bStep = b0_step)
+    else:
+        amico.util.sandi2scheme(bvalFile, bvecFile, Delta, delta, TE_data=TE, schemeFilename=schemeFile,bStep = b0_step)
+    return schemeFile
+
+
+def evaluation(name, subjectDirectory, n_threads=None):
+    ae = amico.Evaluation(subjectDirectory, '.')
+    if name == 'sandi':
+        ae.set_config('doDirectionalAverage', True)
+    if n_threads is not None:
+        # Threads of the fit, named nthreads in AMICO 1.x and n_threads in 2.x.
+        ae.set_config('nthreads', n_threads)
+        ae.set_config('n_threads', n_threads)
+    return ae
+
+
+def set_subject(ae, subjectDirectory):
+    # An evaluation reads the data and writes the results under DATA_path,
+    # study_path/subject as given to amico.Evaluation.
+    ae.set_config('study_path', subjectDirectory)
+    ae.set_config('subject', '.')
+    ae.set_config('DATA_path', os.path.join(subjectDirectory, '.'))
+
+
+def set_model(ae, name, schemeFile, cache_dir=DEFAULT_CACHE_DIR, cache_size=DEFAULT_CACHE_SIZE):
+    if name == 'noddi':
+        ae.set_model("NODDI")
+        kernel_cache.load_kernels(ae, schemeFile, cache_dir=cache_dir, cache_size=cache_size)
+        return
+
+    ae.set_model("SANDI")
+
+    d_is = 3.0e-3        # Intra-soma diffusivity [mm^2/s]
+    Rs = np.linspace(1.0,12.0,5) * 1e-6           # Radii of the soma [meters]
+    d_in = np.linspace(0.25,3.0,5) * 1e-3         # Intra-neurite diffusivitie(s) [mm^2/s]
+    d_isos = np.linspace(0.25,3.0,5) * 1e-3       # Extra-cellular isotropic mean diffusivitie(s) [mm^2/s]
+
+    ae.model.set(d_is, Rs, d_in, d_isos)
+    kernel_cache.load_kernels(ae, schemeFile, ndirs=1, cache_dir=cache_dir, cache_size=cache_size)
+
+    lambda1 = 0
+    lambda2 = 5e-3
+    ae.set_solver( lambda1=lambda1, lambda2=lambda2 )
+
+
+def fit_subjects(name, subjectDirectories, dwiFile, bvalFile, bvecFile, maskFile,
+                 b0_thr=10, n_threads=None,
+                 cache_dir=DEFAULT_CACHE_DIR, cache_size=DEFAULT_CACHE_SIZE,
+                 input_cache=False, prometheus=None, keep_going=False, **kwargs):
+    """Fit one AMICO model on several subjects in this process.
+
+    Subjects with the same scheme share one evaluation, whose kernels are
+    generated (or read from the kernel store) and loaded once; only the data
+    of each subject is loaded. With keep_going, a failed subject is reported
+    and skipped; the subjects that failed are returned.
+    """
+    if name not in AMICO_MODELS:
+        raise ValueError("Unknown AMICO model '%s', choose from: %s."
+                         % (name, ', '.join(AMICO_MODELS)))
+    if name == 'sandi':
+        amico.core.setup()
+
+    logs, schemes, protocols = {}, {}, {}
+    for subjectDirectory in subjectDirectories:
+        logs[subjectDirectory] = RunLog(subject=os.path.abspath(subjectDirectory), model=name)
+        with logs[subjectDirectory].stage('gradients'):
+            schemes[subjectDirectory] = write_scheme(name, subjectDirectory, bvalFile, bvecFile,
+                                                     **kwargs)
+        protocols[subjectDirectory] = file_hash(schemes[subjectDirectory])['sha256']
+
+    ae, protocol, failed = None, None, []
+    for subjectDirectory in sorted(subjectDirectories, key=protocols.get):
+        log = logs[subjectDirectory]
+        try:
+            subjectDwi = dwiFile
+            subjectMask = os.path.join(subjectDirectory, maskFile)
+            if input_cache:
+                subjectDwi, subjectMask = cached_inputs(subjectDirectory, dwiFile, subjectMask)
+
+            if protocols[subjectDirectory] != protocol:
+                protocol = None
+                ae = evaluation(name, subjectDirectory, n_threads)
+            else:
+                set_subject(ae, subjectDirectory)
+            with log.stage('load'):
+                ae.load_data(dwi_filename = subjectDwi, scheme_filename = schemes[subjectDirectory], mask_filename = subjectMask, b0_thr = b0_thr)
+            if protocol is None:
+                with log.stage('build'):
+                    set_model(ae, name, schemes[subjectDirectory], cache_dir, cache_size)
+                protocol = protocols[subjectDirectory]
+
+            with log.stage('fit'):
+                ae.fit()
+            with log.stage('save'):
+                if name == 'sandi':
+                    ae.save_results(save_dir_avg=True)
+                else:
+                    ae.save_results()
+            log.count('voxels', int(np.count_nonzero(ae.niiMASK_img)))
+            log.write(amico_output_dir(subjectDirectory, name))
+        except Exception:
+            if not keep_going:
+                raise
+            traceback.print_exc()
+            failed.append(subjectDirectory)
+
+    if prometheus is not None:
+        write_prometheus(prometheus, [logs[subjectDirectory] for subjectDirectory in subjectDirectories
+                                      if subjectDirectory not in failed])
+    return failed
+
+
+def fit_noddi(subjectDirectory, dwiFile, bvalFile, bvecFile, maskFile, **options):
+    fit_subjects('noddi', [subjectDirectory], dwiFile, bvalFile, bvecFile, maskFile, **options)
+
+
+def fit_sandi(subjectDirectory, dwiFile, bvalFile, bvecFile, maskFile, **options):
+    fit_subjects('sandi', [subjectDirectory], dwiFile, bvalFile, bvecFile, maskFile, **options)
+
+
+def fit(name, subjectDirectory, dwiFile, bvalFile, bvecFile, maskFile, **options):
+    fit_subjects(name, [subjectDirectory], dwiFile, bvalFile, bvecFile, maskFile, **options)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Command line options of the fitting commands.
+
+Only the standard library and the equally light cache and instrumentation
+modules are imported here, so that a command line is parsed (and --help or an
+argument error answered) before Dipy, AMICO or nibabel are imported. The
+modules using these options take their defaults from here.
+"""
+
+from microstructure import cache, instrumentation
+
+# Same gzip level as nibabel uses for .nii.gz.
+DEFAULT_COMPRESSION = 1
+
+DEFAULT_WRITE_THREADS = 4
+
+# Directory of the converted inputs, inside the directory of the source.
+INPUT_CACHE_DIR = '.microstructure'
+
+# One NIfTI per map, or all maps of a model in one container (see container).
+OUTPUT_FORMATS = ['nifti', 'hdf5']
+DEFAULT_OUTPUT_FORMAT = 'nifti'
+
+PRECISIONS = ['float64', 'float32']
+DEFAULT_PRECISION = 'float64'
+
+# Destinations of the arguments added by the add_*_arguments() functions.
+INPUT_CACHE_OPTIONS = ['input_cache']
+PRECISION_OPTIONS = ['precision']
+PIPELINE_OPTIONS = (['n_jobs', 'max_memory', 'checkpoint', 'compression', 'output_float32',
+                     'output_format', 'write_threads'] +
+                    cache.OPTIONS + INPUT_CACHE_OPTIONS + instrumentation.OPTIONS +
+                    PRECISION_OPTIONS)
+AMICO_OPTIONS = cache.OPTIONS + INPUT_CACHE_OPTIONS + instrumentation.OPTIONS
+
+
+def add_input_cache_arguments(parser):
+    parser.add_argument(
+        '--input-cache', action="store_true", dest="input_cache",
+        help='Convert the DWI and mask once to memory-mappable images in '
+             '<subject>/%s and read those.' % INPUT_CACHE_DIR)
+
+
+def add_precision_arguments(parser):
+    parser.add_argument(
+        '--precision', action="store", dest="precision", type=str,
+        choices=PRECISIONS, default=DEFAULT_PRECISION,
+        help='Precision of the loaded voxels and of the maps, the solvers work in float64 '
+             '(default: %s).' % DEFAULT_PRECISION)
+
+
+def add_pipeline_arguments(parser):
+    parser.add_argument(
+        '--n-jobs', action="store", dest="n_jobs", type=int, default=1,
+        help='Number of worker processes fitting the masked voxels, -1 for all cores (default: 1).')
+    parser.add_argument(
+        '--max-memory', action="store", dest="max_memory", type=float, default=None,
+        help='Fit the masked voxels in blocks within this memory budget in GB, reading the '
+             'DWI and writing the maps block by block (default: all voxels at once).')
+    parser.add_argument(
+        '--checkpoint', action="store_true", dest="checkpoint",
+        help='Save the fitted voxels chunk by chunk in the output directory, so that a rerun '
+             'after an interruption only fits the missing chunks.')
+    cache.add_arguments(parser)
+    add_input_cache_arguments(parser)
+    instrumentation.add_arguments(parser)
+    parser.add_argument(
+        '--compression', action="store", dest="compression", type=int,
+        choices=range(10), metavar='{0..9}', default=DEFAULT_COMPRESSION,
+        help='gzip level of the output maps, 0 writes uncompressed .nii (default: %d).'
+             % DEFAULT_COMPRESSION)
+    parser.add_argument(
+        '--output-float32', action="store_true", dest="output_float32",
+        help='Store floating point output maps as float32.')
+    parser.add_argument(
+        '--output-format', action="store", dest="output_format", type=str,
+        choices=OUTPUT_FORMATS, default=DEFAULT_OUTPUT_FORMAT,
+        help='One NIfTI per map (nifti), or all maps of a model in one chunked, compressed '
+             'maps.h5 with the affine and provenance (hdf5), (default: %s).'
+             % DEFAULT_OUTPUT_FORMAT)
+    add_precision_arguments(parser)
+    parser.add_argument(
+        '--write-threads', action="store", dest="write_threads", type=int,
+        default=DEFAULT_WRITE_THREADS,
+        help='Number of output maps written concurrently (default: %d).'
+             % DEFAULT_WRITE_THREADS)
+
+
+def add_amico_run_arguments(parser):
+    cache.add_arguments(parser)
+    add_input_cache_arguments(parser)
+    instrumentation.add_arguments(parser)
+
+
+def options(args, names=PIPELINE_OPTIONS):
+    return {name: getattr(args, name) for name in names}
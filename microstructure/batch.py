@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable batch fitting of many subjects.
+
+Every subject is split into jobs: one job fitting all its requested Dipy
+models (so its data is loaded once) and one job per AMICO model. Jobs run in
+separate processes on a bounded pool, each with an optional memory budget
+that is both reserved by the scheduler and enforced on the memory of the
+job: the anonymous and shared memory of the job and its worker processes
+(memory-mapped inputs are not counted) is polled, and a job above its budget
+is killed and reported as failed.
+
+As soon as the outputs of a model are saved, a manifest with the SHA-256 of
+its inputs, the options it depends on and its output files is written
+atomically to its output directory. A model whose manifest matches the
+current inputs and options, and whose output files all exist (those of its
+subdirectories too, e.g. DKI/WMTI/), is skipped, so a batch interrupted by a
+crash or a preemption resumes with only the unfinished models.
+"""
+
+import glob
+import inspect
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import sys
+import time
+import traceback
+
+from microstructure.cache import file_hash
+from microstructure.models import AMICO_MODELS, amico_output_dir, get_model
+
+MANIFEST = '.microstructure.json'
+
+# Options of the Dipy pipeline changing the outputs of every model; the
+# other options a model depends on are the keyword arguments of its
+# functions.
+OUTPUT_OPTIONS = ['compression', 'output_float32', 'output_format', 'precision']
+GRADIENT_OPTIONS = ['big_delta', 'small_delta']
+MODEL_FUNCTIONS = ['check_options', 'output_dir', 'cache_key', 'build_model', 'prepare', 'fit',
+                   'finalize']
+
+# Options changing the outputs of the AMICO models.
+AMICO_OPTIONS = {'noddi': ['b0_thr', 'b0_step'],
+                 'sandi': ['b0_thr', 'b0_step', 'TE', 'Delta', 'delta']}
+
+# Seconds between two polls of the memory of the running jobs.
+MEMORY_POLL = 1.0
+
+
+def expand_subjects(patterns, subject_list=None):
+    subjects = []
+    if subject_list is not None:
+        with open(subject_list) as f:
+            patterns = list(patterns or []) + [line.strip() for line in f if line.strip()]
+    for pattern in patterns or []:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        subjects.extend(match for match in matches if os.path.isdir(match))
+    return list(dict.fromkeys(subjects))
+
+
+def output_dir(subjectDirectory, name, **options):
+    if name in AMICO_MODELS:
+        return amico_output_dir(subjectDirectory, name)
+    return get_model(name).output_dir(subjectDirectory, **options)
+
+
+def input_files(subjectDirectory, name, dwiFile, bvalFile, bvecFile, maskFile,
+                schemeFile=None, **options):
+    if name == 'qtdmri':
+        names = [dwiFile, schemeFile, maskFile]
+    else:
+        names = [dwiFile, bvalFile, bvecFile, maskFile]
+    return [os.path.join(subjectDirectory, filename) for filename in names if filename is not None]
+
+
+def option_names(name):
+    if name in AMICO_MODELS:
+        return set(AMICO_OPTIONS[name])
+    module = get_model(name)
+    names = set(OUTPUT_OPTIONS)
+    if module.GRADIENTS == 'bvals':
+        names.update(GRADIENT_OPTIONS)
+    for function in MODEL_FUNCTIONS:
+        if hasattr(module, function):
+            parameters = inspect.signature(getattr(module, function)).parameters.values()
+            names.update(parameter.name for parameter in parameters
+                         if parameter.default is not inspect.Parameter.empty)
+    return names
+
+
+def fitting_options(name, options):
+    # The options the outputs of the model depend on, so that changing an
+    # option of another model does not refit this one.
+    names = option_names(name)
+    return {key: value for key, value in sorted(options.items()) if key in names}
+
+
+def read_manifest(outdir):
+    try:
+        with open(os.path.join(outdir, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(outdir, manifest):
+    filename = os.path.join(outdir, MANIFEST)
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, filename)
+
+
+def is_complete(subjectDirectory, name, files, options):
+    outdir = output_dir(subjectDirectory, name, **options)
+    manifest = read_manifest(outdir)
+    if (manifest is None or
+            manifest.get('options') != json.loads(json.dumps(fitting_options(name, options)))):
+        return False
+    try:
+        inputs = {filename: file_hash(filename, manifest['inputs'].get(filename))
+                  for filename in input_files(subjectDirectory, name, **files)}
+    except OSError:
+        return False
+    if any(inputs[filename]['sha256'] != manifest['inputs'].get(filename, {}).get('sha256')
+           for filename in inputs):
+        return False
+    return all(os.path.isfile(os.path.join(outdir, output)) for output in manifest['outputs'])
+
+
+def output_files(outdir):
+    # The files under the output directory, e.g. WMTI/AWF.nii.gz of DKI,
+    # without the hidden ones (manifest, checkpoints, temporary files).
+    outputs = []
+    for directory, subdirectories, files in os.walk(outdir):
+        subdirectories[:] = [name for name in subdirectories if not name.startswith('.')]
+        outputs.extend(os.path.relpath(os.path.join(directory, name), outdir)
+                       for name in files if not name.startswith('.'))
+    return sorted(outputs)
+
+
+def record(subjectDirectory, name, files, options):
+    outdir = output_dir(subjectDirectory, name, **options)
+    previous = read_manifest(outdir) or {}
+    inputs = {filename: file_hash(filename, previous.get('inputs', {}).get(filename))
+              for filename in input_files(subjectDirectory, name, **files)}
+    write_manifest(outdir, {
+        'model': name,
+        'options': fitting_options(name, options),
+        'inputs': inputs,
+        'outputs': output_files(outdir),
+        'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    })
+
+
+def plan(subjects, models, files, options, force=False):
+    dipy_models = [name for name in models if name not in AMICO_MODELS]
+    jobs = []
+    for subjectDirectory in subjects:
+        todo = [name for name in models
+                if force or not is_complete(subjectDirectory, name, files, options)]
+        pending = [name for name in dipy_models if name in todo]
+        if pending:
+            jobs.append((subjectDirectory, pending))
+        jobs.extend((subjectDirectory, [name]) for name in todo
+                    if name in AMICO_MODELS)
+    return jobs
+
+
+def run_job(subjectDirectory, names, files, options, logFile):
+    # Runs in the job process: output goes to the job's log file.
+    log = os.open(logFile, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    # The job and its workers are killed together when over their budget.
+    os.setpgrp()
+
+    try:
+        # Imported here so that batches of Dipy models do not need AMICO.
+        if names[0] in AMICO_MODELS:
+            from microstructure import amico_models
+            amico_models.fit(names[0], subjectDirectory, **files, **options)
+            record(subjectDirectory, names[0], files, options)
+        else:
+            from microstructure import pipeline
+            pipeline.run(subjectDirectory, names, **files, **options,
+                         saved=lambda name: record(subjectDirectory, name, files, options))
+    except BaseException:
+        traceback.print_exc()
+        sys.exit(1)
+
+
+def process_memory(pid):
+    # Anonymous and shared memory of a process, shared pages divided among
+    # the processes mapping them.
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            fields = dict(line.split()[:2] for line in f if line.endswith('kB\n'))
+        if 'Pss_Anon:' in fields:
+            return (int(fields['Pss_Anon:']) + int(fields.get('Pss_Shmem:', 0))) * 1024
+        with open('/proc/%d/status' % pid) as f:
+            fields = dict(line.split()[:2] for line in f if line.endswith('kB\n'))
+        return (int(fields.get('RssAnon:', 0)) + int(fields.get('RssShmem:', 0))) * 1024
+    except (OSError, ValueError):
+        return 0
+
+
+def group_memory(pgid):
+    # Memory of the processes of a job (the job and its workers).
+    total = 0
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            if os.getpgid(int(name)) == pgid:
+                total += process_memory(int(name))
+        except OSError:
+            continue
+    return total
+
+
+def physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def run_batch(subjects, models, files, options, jobs=1, memory_per_job=None,
+              total_memory=None, force=False, log=None):
+    planned = plan(subjects, models, files, options, force=force)
+    memory_limit = int(memory_per_job * 1024 ** 3) if memory_per_job else 0
+    total_memory = int(total_memory * 1024 ** 3) if total_memory else physical_memory()
+    print("%d jobs to run, %d subjects up to date."
+          % (len(planned), len(subjects) - len({job[0] for job in planned})))
+
+    context = multiprocessing.get_context('spawn')
+    running = {}
+    failed = []
+    over_budget = set()
+    queue = list(planned)
+    while queue or running:
+        while (queue and len(running) < max(1, jobs)
+               and (not running or (len(running) + 1) * memory_limit <= total_memory)):
+            subjectDirectory, names = queue.pop(0)
+            logFile = os.path.join(subjectDirectory, 'microstructure_%s.log' % '_'.join(names))
+            process = context.Process(target=run_job,
+                                      args=(subjectDirectory, names, files, options, logFile))
+            process.start()
+            running[process.sentinel] = (process, subjectDirectory, names, time.time())
+
+        ready = multiprocessing.connection.wait(list(running),
+                                                timeout=MEMORY_POLL if memory_limit else None)
+        if memory_limit:
+            for process, subjectDirectory, names, started in running.values():
+                if process.sentinel not in ready and group_memory(process.pid) > memory_limit:
+                    over_budget.add(process.pid)
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+        for sentinel in ready:
+            process, subjectDirectory, names, started = running.pop(sentinel)
+            process.join()
+            status = 'done' if process.exitcode == 0 else 'failed'
+            over = process.pid in over_budget
+            if status == 'failed':
+                failed.append((subjectDirectory, names))
+            print("%s %s: %s%s (%.0f s)" % (subjectDirectory, ','.join(names), status,
+                                           ', over its memory budget' if over else '',
+                                           time.time() - started))
+            if log is not None:
+                with open(log, 'a') as f:
+                    f.write(json.dumps({'subject': subjectDirectory, 'models': names,
+                                        'status': status, 'exitcode': process.exitcode,
+                                        'over_memory_budget': over,
+                                        'seconds': time.time() - started}) + '\n')
+    return failed
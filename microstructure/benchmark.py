@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of every model path on synthetic phantoms.
+
+A phantom is a box of voxels with an ellipsoidal brain mask, simulated with
+two crossing cylindrically symmetric tensors, free water and an IVIM
+perfusion compartment, with Rician noise. It is written to a temporary
+subject directory together with a multi-shell protocol (FSL bval/bvec) and a
+multi-diffusion-time qt-dMRI scheme. Every model path then runs in a fresh
+process, so that its peak RSS is its own, and the wall/CPU time of each
+stage, the voxels fitted per second and the peak RSS are reported as JSON.
+
+With precision=True, every Dipy model path is instead fitted twice on the
+phantom, with precision='float64' and 'float32', and the maximum absolute,
+maximum relative and median relative error of each float32 map against the
+float64 one are reported.
+
+With warm_start=True, the batched FWDTI engine is fitted twice on
+a phantom whose parameters vary smoothly in space, cold and warm-started from
+the neighbouring voxels, and the fit time, the solver iterations and the
+errors of the warm-started maps against the cold ones are reported.
+
+mapmri_engine='qp' fits the locally constrained MAP-MRI variants on a
+working set of their positivity constraints (see mapmri_solver), e.g. to
+compare its timings and maps with Dipy's per-voxel cvxpy problems.
+
+Phantoms only depend on their size, SNR and seed, and constrained MAP-MRI is
+solved with an open-source cvxpy solver, so results can be compared across
+commits and machines without a MOSEK license. Each MAP-MRI variant computes
+the maps it defines. Paths whose dependencies are missing are skipped; the
+report is still written when a path fails, but the benchmark then exits with
+an error.
+"""
+
+import functools
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import nibabel as nib
+import numpy as np
+
+from microstructure.instrumentation import RunLog, peak_rss
+from microstructure.models.mapmri import QP_VARIANTS, UNAVAILABLE_VARIANTS, VARIANTS, variant_metrics
+
+PATHS = (['fwdti', 'ivim', 'msdki', 'wmti', 'dki'] +
+         ['mapmri:' + variant for variant in VARIANTS if variant not in UNAVAILABLE_VARIANTS] +
+         ['qtdmri', 'noddi', 'sandi'])
+
+DEFAULT_SHAPE = (20, 20, 10)
+
+# Open-source cvxpy solver for the positivity-constrained MAP-MRI variants.
+DEFAULT_SOLVER = 'CLARABEL'
+
+GYROMAGNETIC_RATIO = 2.6751525e8  # [rad/s/T]
+BIG_DELTA = 0.0218
+SMALL_DELTA = 0.0129
+
+FILES = {'dwiFile': 'dwi.nii.gz', 'bvalFile': 'dwi.bval', 'bvecFile': 'dwi.bvec',
+         'maskFile': 'mask.nii.gz', 'schemeFile': 'qtdmri.scheme'}
+SCHEME_DWI = 'dwi_qtdmri.nii.gz'
+
+# Engines compared by the warm-start mode, per path.
+WARM_START_ENGINES = {'fwdti': ('fwdti_engine', ['batched'])}
+
+# Plane waves summed into a smooth parameter map, and their largest number of
+# periods across the phantom.
+SMOOTH_WAVES = 3
+SMOOTH_PERIODS = 1.5
+
+
+def directions(n, rng):
+    bvecs = rng.normal(size=(n, 3))
+    return bvecs / np.linalg.norm(bvecs, axis=1, keepdims=True)
+
+
+def multishell_protocol(rng, n_directions=30):
+    # b0s, low b-values for IVIM and three shells for DKI/MAP-MRI/NODDI/SANDI.
+    bvals = [np.zeros(6)]
+    bvecs = [np.zeros((6, 3))]
+    for b in [10, 20, 50, 100, 200, 400]:
+        bvals.append(np.full(3, b))
+        bvecs.append(directions(3, rng))
+    for b in [1000, 2000, 3000]:
+        bvals.append(np.full(n_directions, b))
+        bvecs.append(directions(n_directions, rng))
+    return np.concatenate(bvals).astype(float), np.concatenate(bvecs)
+
+
+def multitime_protocol(rng, n_directions=20, n_b0=2):
+    # b0s and shells of b = 1000, 2000, 3000 at three diffusion times, as
+    # qt-dMRI normalizes the signal by the b0s of each diffusion time; the
+    # gradient strength G [T/m], as in the scheme columns read by
+    # load_scheme_gtab, is solved from b = (gamma G delta)^2 (Delta - delta/3).
+    rows = []
+    for big_delta in [BIG_DELTA, 0.035, 0.05]:
+        rows += [[0, 0, 0, 0, 0, SMALL_DELTA, big_delta]] * n_b0
+        for b in [1000, 2000, 3000]:
+            G = np.sqrt(b * 1e6 / (big_delta - SMALL_DELTA / 3)) / (GYROMAGNETIC_RATIO * SMALL_DELTA)
+            for bvec in directions(n_directions, rng):
+                rows.append([0, bvec[0], bvec[1], bvec[2], G, SMALL_DELTA, big_delta])
+    scheme = np.array(rows, dtype=float)
+    G = scheme[:, 4]
+    bvals = (GYROMAGNETIC_RATIO * G * scheme[:, 5]) ** 2 * (scheme[:, 6] - scheme[:, 5] / 3) * 1e-6
+    return scheme, bvals, scheme[:, 1:4]
+
+
+def smooth_field(shape, rng):
+    # Values in [0, 1] varying smoothly over the grid.
+    grid = np.meshgrid(*[np.linspace(0, 1, n) for n in shape], indexing='ij')
+    field = sum(np.cos(2 * np.pi * (sum(k * axis for k, axis in
+                                        zip(rng.uniform(0, SMOOTH_PERIODS, len(shape)), grid)) +
+                                    rng.uniform())) for _ in range(SMOOTH_WAVES))
+    field = field - field.min()
+    return (field / max(field.max(), 1e-12)).ravel()
+
+
+def uniform(low, high, n_voxels, rng, shape=None):
+    # Independent in every voxel, or smooth over a grid of the given shape.
+    if shape is None:
+        return rng.uniform(low, high, n_voxels)[:, None]
+    return (low + (high - low) * smooth_field(shape, rng))[:, None]
+
+
+def fiber_directions(n_voxels, rng, shape=None):
+    if shape is None:
+        return directions(n_voxels, rng)
+    vectors = np.column_stack([2 * smooth_field(shape, rng) - 1 for _ in range(3)])
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def simulate(bvals, bvecs, n_voxels, rng, snr=30, S0=1000., shape=None):
+    # With shape, the parameters vary smoothly over the grid of the phantom.
+    d_par = uniform(1.5e-3, 2.0e-3, n_voxels, rng, shape)
+    d_perp = uniform(0.2e-3, 0.5e-3, n_voxels, rng, shape)
+    fiber_fraction = uniform(0.3, 0.7, n_voxels, rng, shape)
+    free_water = uniform(0., 0.3, n_voxels, rng, shape)
+    perfusion = uniform(0., 0.1, n_voxels, rng, shape)
+    d_star = uniform(8e-3, 20e-3, n_voxels, rng, shape)
+
+    b = bvals[None, :]
+    cos1 = (fiber_directions(n_voxels, rng, shape) @ bvecs.T) ** 2
+    cos2 = (fiber_directions(n_voxels, rng, shape) @ bvecs.T) ** 2
+    tissue = (fiber_fraction * np.exp(-b * (d_perp + (d_par - d_perp) * cos1)) +
+              (1 - fiber_fraction) * np.exp(-b * (d_perp + (d_par - d_perp) * cos2)))
+    signal = S0 * ((1 - perfusion) * ((1 - free_water) * tissue + free_water * np.exp(-b * 3e-3)) +
+                   perfusion * np.exp(-b * d_star))
+
+    sigma = S0 / snr
+    return np.sqrt((signal + rng.normal(0, sigma, signal.shape)) ** 2 +
+                   rng.normal(0, sigma, signal.shape) ** 2)
+
+
+def ellipsoid_mask(shape):
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+    return sum(axis ** 2 for axis in grid) <= 0.9
+
+
+def make_phantom(subjectDirectory, shape=DEFAULT_SHAPE, snr=30, seed=0, smooth=False):
+    rng = np.random.default_rng(seed)
+    affine = np.diag([2., 2., 2., 1.])
+    mask = ellipsoid_mask(shape)
+    nib.save(nib.Nifti1Image(mask.astype(np.uint8), affine),
+             os.path.join(subjectDirectory, FILES['maskFile']))
+
+    bvals, bvecs = multishell_protocol(rng)
+    np.savetxt(os.path.join(subjectDirectory, FILES['bvalFile']), bvals[None], fmt='%g')
+    np.savetxt(os.path.join(subjectDirectory, FILES['bvecFile']), bvecs.T, fmt='%.6f')
+    scheme, scheme_bvals, scheme_bvecs = multitime_protocol(rng)
+    np.savetxt(os.path.join(subjectDirectory, FILES['schemeFile']), scheme,
+               fmt='%.8g', header='VERSION: qt-dMRI', comments='')
+
+    n_voxels = int(np.prod(shape))
+    for filename, b, g in [(FILES['dwiFile'], bvals, bvecs),
+                           (SCHEME_DWI, scheme_bvals, scheme_bvecs)]:
+        dwi = simulate(b, g, n_voxels, rng, snr=snr,
+                       shape=shape if smooth else None).reshape(shape + (len(b),))
+        nib.save(nib.Nifti1Image(dwi.astype(np.float32), affine),
+                 os.path.join(subjectDirectory, filename))
+
+    return int(mask.sum())
+
+
+def fit_dipy_path(path, subjectDirectory, log, solver=DEFAULT_SOLVER, precision='float64',
+                  mapmri_engine='dipy', **extra):
+    from microstructure.data import load_gtab, load_masked_dwi, load_scheme_gtab
+    from microstructure.model_cache import build_model
+    from microstructure.models import get_model
+    from microstructure.parallel import fit_voxels
+
+    name, _, variant = path.partition(':')
+    options = dict({'model': variant or 'anisoMAPL', 'cvxpy_solver': solver,
+                    'precision': precision}, **extra)
+    if name == 'mapmri':
+        options['metrics'] = variant_metrics(options['model'])
+        if variant in QP_VARIANTS:
+            options['mapmri_engine'] = mapmri_engine
+    module = get_model(name)
+    dwiFile = SCHEME_DWI if module.GRADIENTS == 'scheme' else FILES['dwiFile']
+
+    with log.stage('load'):
+        data, mask, affine = load_masked_dwi(os.path.join(subjectDirectory, dwiFile),
+                                             os.path.join(subjectDirectory, FILES['maskFile']),
+                                             dtype=precision)
+    with log.stage('gradients'):
+        if module.GRADIENTS == 'scheme':
+            gtab = load_scheme_gtab(os.path.join(subjectDirectory, FILES['schemeFile']))
+        else:
+            gtab = load_gtab(os.path.join(subjectDirectory, FILES['bvalFile']),
+                             os.path.join(subjectDirectory, FILES['bvecFile']),
+                             big_delta=BIG_DELTA, small_delta=SMALL_DELTA)
+    with log.stage('build'):
+        model = build_model(module, gtab, cache_dir=None, **options)
+    with log.stage('fit'):
+        maps = fit_voxels(module, gtab, data, built_model=model, **options)
+    if hasattr(module, 'finalize'):
+        with log.stage('derive'):
+            maps = module.finalize(maps, **options)
+    return maps, mask, affine
+
+
+def run_dipy_path(path, subjectDirectory, log, solver=DEFAULT_SOLVER, mapmri_engine='dipy'):
+    from microstructure.output import save_maps
+
+    maps, mask, affine = fit_dipy_path(path, subjectDirectory, log, solver=solver,
+                                       mapmri_engine=mapmri_engine)
+    with log.stage('save'):
+        save_maps(os.path.join(subjectDirectory, path.replace(':', '_')), maps, mask, affine)
+    return int(mask.sum())
+
+
+def run_amico_path(path, subjectDirectory, log):
+    from microstructure import amico_models
+
+    files = {key: FILES[key] for key in ['dwiFile', 'bvalFile', 'bvecFile', 'maskFile']}
+    with log.stage('fit'):
+        amico_models.fit(path, subjectDirectory, cache_dir=None, **files)
+    return int(nib.load(os.path.join(subjectDirectory, FILES['maskFile'])).get_fdata().sum())
+
+
+def run_path(path, subjectDirectory, solver, mapmri_engine='dipy'):
+    # Runs in a fresh process per path.
+    log = RunLog(path=path)
+    result = {'path': path}
+    try:
+        with log.stage('total'):
+            if path in ('noddi', 'sandi'):
+                n_voxels = run_amico_path(path, subjectDirectory, log)
+            else:
+                n_voxels = run_dipy_path(path, subjectDirectory, log, solver=solver,
+                                         mapmri_engine=mapmri_engine)
+        log.count('voxels', n_voxels)
+        result['status'] = 'ok'
+    except ImportError as e:
+        result['status'] = 'skipped'
+        result['error'] = str(e)
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    report = log.report()
+    for key in ['stages', 'counters', 'voxels_per_second']:
+        if key in report:
+            result[key] = report[key]
+    result['peak_rss_mb'] = peak_rss() / 2 ** 20
+    return result
+
+
+def compare_precision(path, subjectDirectory, solver, mapmri_engine='dipy'):
+    # Runs in a fresh process per path.
+    from microstructure.precision import errors
+
+    result = {'path': path}
+    try:
+        reference, _, _ = fit_dipy_path(path, subjectDirectory, RunLog(), solver=solver,
+                                        mapmri_engine=mapmri_engine)
+        single, _, _ = fit_dipy_path(path, subjectDirectory, RunLog(), solver=solver,
+                                     precision='float32', mapmri_engine=mapmri_engine)
+        result['maps'] = {name: errors(reference[name], single[name]) for name in reference}
+        result['status'] = 'ok'
+    except ImportError as e:
+        result['status'] = 'skipped'
+        result['error'] = str(e)
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    return result
+
+
+def compare_warm_start(path, subjectDirectory, solver):
+    # Runs in a fresh process per path.
+    from microstructure.precision import errors
+
+    result = {'path': path, 'engines': {}}
+    option, engines = WARM_START_ENGINES[path]
+    try:
+        for engine in engines:
+            fits = {}
+            for mode, warm_start in [('cold', False), ('warm', True)]:
+                log = RunLog()
+                maps, _, _ = fit_dipy_path(path, subjectDirectory, log, solver=solver,
+                                           return_iterations=True, warm_start=warm_start,
+                                           **{option: engine})
+                fits[mode] = (maps, log.report()['stages']['fit']['wall_seconds'])
+            (cold, cold_seconds), (warm, warm_seconds) = fits['cold'], fits['warm']
+            result['engines'][engine] = {
+                'fit_seconds': {'cold': cold_seconds, 'warm': warm_seconds},
+                'speedup': cold_seconds / warm_seconds if warm_seconds > 0 else None,
+                'iterations': {'cold': int(np.sum(cold.pop('ITERATIONS'))),
+                               'warm': int(np.sum(warm.pop('ITERATIONS')))},
+                'maps': {name: errors(cold[name], warm[name]) for name in cold},
+            }
+        result['status'] = 'ok'
+    except ImportError as e:
+        result['status'] = 'skipped'
+        result['error'] = str(e)
+    except Exception:
+        result['status'] = 'failed'
+        result['error'] = traceback.format_exc()
+    return result
+
+
+def environment():
+    def version(module):
+        try:
+            return __import__(module).__version__
+        except (ImportError, AttributeError):
+            return None
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'numpy': version('numpy'),
+        'dipy': version('dipy'),
+        'cvxpy': version('cvxpy'),
+        'amico': version('amico'),
+    }
+
+
+def run_benchmark(paths=PATHS, shape=DEFAULT_SHAPE, snr=30, seed=0, solver=DEFAULT_SOLVER,
+                  precision=False, warm_start=False, mapmri_engine='dipy'):
+    context = multiprocessing.get_context('spawn')
+    if warm_start:
+        paths = [path for path in paths if path in WARM_START_ENGINES]
+        run, mode = compare_warm_start, 'warm start against cold start'
+    elif precision:
+        # AMICO fits in its own precision.
+        paths = [path for path in paths if path not in ('noddi', 'sandi')]
+        run = functools.partial(compare_precision, mapmri_engine=mapmri_engine)
+        mode = 'float32 against float64'
+    else:
+        run, mode = functools.partial(run_path, mapmri_engine=mapmri_engine), 'timing'
+    with tempfile.TemporaryDirectory(prefix='microstructure-bench-') as subjectDirectory:
+        n_voxels = make_phantom(subjectDirectory, shape=shape, snr=snr, seed=seed,
+                                smooth=warm_start)
+        results = []
+        for path in paths:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                try:
+                    results.append(executor.submit(run, path, subjectDirectory, solver).result())
+                except BrokenProcessPool as e:
+                    results.append({'path': path, 'status': 'failed', 'error': str(e)})
+
+    return {
+        'benchmark': {'shape': list(shape), 'n_voxels': n_voxels, 'snr': snr,
+                      'seed': seed, 'solver': solver, 'mapmri_engine': mapmri_engine,
+                      'mode': mode},
+        'environment': environment(),
+        'results': results,
+    }
+
+
+def main(paths=PATHS, shape=DEFAULT_SHAPE, snr=30, seed=0, solver=DEFAULT_SOLVER, output=None,
+         precision=False, warm_start=False, mapmri_engine='dipy'):
+    report = run_benchmark(paths=paths, shape=shape, snr=snr, seed=seed, solver=solver,
+                           precision=precision, warm_start=warm_start,
+                           mapmri_engine=mapmri_engine)
+    text = json.dumps(report, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    failed = [result for result in report['results'] if result['status'] == 'failed']
+    if failed:
+        raise SystemExit('\n'.join(['Benchmark path %s failed:\n%s' % (result['path'], result['error'])
+                                    for result in failed]))
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache directory shared by the model and AMICO kernel caches.
+
+Entries are directories written under a temporary name and renamed into
+place; the cache is bounded in size and the least recently used entries
+(by modification time, refreshed on every hit) are evicted first.
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+from contextlib import contextmanager
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    'MICROSTRUCTURE_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'microstructure'))
+
+# Default size bound of each cache [MB].
+DEFAULT_CACHE_SIZE = 4096
+
+# Destinations of the arguments added by add_arguments().
+OPTIONS = ['cache_dir', 'cache_size']
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--cache-dir', action="store", dest="cache_dir", type=str, default=DEFAULT_CACHE_DIR,
+        help='Directory of the cache of acquisition-dependent model data (default: %s).'
+             % DEFAULT_CACHE_DIR)
+    parser.add_argument(
+        '--cache-size', action="store", dest="cache_size", type=float, default=DEFAULT_CACHE_SIZE,
+        help='Size bound of the cache in MB, least recently used entries are evicted (default: %d).'
+             % DEFAULT_CACHE_SIZE)
+    parser.add_argument(
+        '--no-cache', action="store_const", dest="cache_dir", const=None,
+        help='Build everything from scratch without the cache.')
+
+
+def options(args):
+    return {name: getattr(args, name) for name in OPTIONS}
+
+
+@contextmanager
+def locked(filename):
+    while True:
+        f = open(filename, 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        # The lock file of an evicted entry is removed under its lock: lock
+        # the file now at this path instead.
+        try:
+            if os.stat(filename).st_ino == os.fstat(f.fileno()).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        f.close()
+    try:
+        yield
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+
+@contextmanager
+def try_locked(filename):
+    # Yields whether the lock was taken, without waiting for it.
+    with open(filename, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def touch(entry):
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+
+
+def entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+
+def remove_entry(entry, lock=False):
+    # With lock, an entry whose lock is held (being generated or loaded by
+    # another job) is kept; its lock file is removed with it.
+    if not lock:
+        shutil.rmtree(entry, ignore_errors=True)
+        return True
+    with try_locked(entry + '.lock') as taken:
+        if taken:
+            shutil.rmtree(entry, ignore_errors=True)
+            os.remove(entry + '.lock')
+        return taken
+
+
+def evict(directory, cache_size, keep=None, lock=False):
+    entries = []
+    for name in os.listdir(directory):
+        entry = os.path.join(directory, name)
+        if lock and name.endswith('.lock') and not os.path.isdir(entry[:-len('.lock')]):
+            # Left over by a failed generation.
+            remove_entry(entry[:-len('.lock')], lock=True)
+            continue
+        if name.startswith('.') or not os.path.isdir(entry):
+            continue
+        try:
+            entries.append((os.path.getmtime(entry), entry_size(entry), entry))
+        except OSError:
+            continue
+
+    total = sum(size for mtime, size, entry in entries)
+    for mtime, size, entry in sorted(entries):
+        if total <= cache_size * 1024 ** 2:
+            break
+        if entry == keep:
+            continue
+        if remove_entry(entry, lock=lock):
+            total -= size
+
+
+def file_hash(filename, previous=None):
+    # Reuse the recorded hash while the file keeps its size and mtime, so
+    # large DWIs are hashed once rather than on every run.
+    stat = os.stat(filename)
+    if (previous is not None and previous.get('size') == stat.st_size
+            and previous.get('mtime_ns') == stat.st_mtime_ns):
+        return previous
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(16 * 1024 ** 2), b''):
+            sha.update(block)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha.hexdigest()}
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+"""
+Command line interface of ``python -m microstructure``.
+
+Every model has its own subcommand, with the arguments of its former
+fit_*.py script, next to run, batch, amico, bench and profile-imports. Only
+the standard library, microstructure.arguments and the model registry are
+imported to parse the command line; the backend of a command (Dipy through
+the pipeline, or AMICO) is imported once its arguments are parsed, and AMICO
+is set up only when a fit starts.
+"""
+
+import argparse
+import json
+import os
+import sys
+from microstructure import arguments
+from microstructure.models import AMICO_MODELS, MODELS
+
+DESCRIPTIONS = {
+    'dki': 'Fit DTI, DKI and WMTI from one kurtosis fit, and MSDKI on the same data, with Dipy',
+    'fwdti': 'Fit FreeWater model with Dipy',
+    'ivim': 'Fit IVIM model with Dipy',
+    'mapmri': 'Fit MAP-MRI model with Dipy',
+    'msdki': 'Fit MSDKI model with Dipy',
+    'qtdmri': 'Fit QTDMRI model with Dipy',
+    'wmti': 'Fit WMTI model with Dipy',
+    'noddi': 'Fit NODDI model with AMICO',
+    'sandi': 'Fit SANDI model with AMICO',
+}
+
+
+def add_file_arguments(parser):
+    parser.add_argument(
+        'dwiFile',
+        help='Name of DWI.')
+    parser.add_argument(
+        'bvalFile',
+        help='Name of b-value.')
+    parser.add_argument(
+        'bvecFile',
+        help='Name of gradiet vectory.')
+    parser.add_argument(
+        'maskFile',
+        help='Name of brain mask.')
+
+
+# The options of the models, in one table for the subcommand of each model
+# and for run and batch: the models taking the option, its flag in the
+# subcommand of a model, its flag with run and batch (the AMICO options with
+# batch and amico), and its argparse settings.
+MODEL_OPTIONS = [
+    (['mapmri'], '-model', '-mapmri_model', dict(
+        action="store", dest="model", type=str, default="anisoMAPL",
+        help='MAP-MRI variant: anisoMAPL, anisoCMAP, anisoCMAPL, anisoMAP+, isoMAPL, isoCMAP, isoCMAPL, (default: anisoMAPL).')),
+    (['mapmri'], '--metrics', '-mapmri_metrics', dict(
+        action="store", dest="metrics", type=str, default=None,
+        help='Comma separated MAP-MRI maps to compute, from: MSD, QIV, RTOP, RTAP, RTPP, NG, NGper, NGpar, ODF, '
+             'RTOP_cortex_norm, RTAP_cortex_norm, RTPP_cortex_norm, PDF, NOLS, ISF, SH, COEF; NG, NGper and '
+             'NGpar need an aniso variant, SH an iso variant (default: all the variant computes).')),
+    (['mapmri'], '-engine', '-mapmri_engine', dict(
+        action="store", dest="mapmri_engine", type=str, default="dipy",
+        help='MAP-MRI fit: dipy (a cvxpy problem per voxel) or qp (working set of the positivity constraints, warm-started from the previous voxel; anisoCMAP, anisoCMAPL, isoCMAP, isoCMAPL), (default: dipy).')),
+    (['mapmri'], '-solver', '-mapmri_solver', dict(
+        action="store", dest="cvxpy_solver", type=str, default="MOSEK",
+        help='Solver of the constrained MAP-MRI variants, e.g. MOSEK or CLARABEL; CLARABEL or OSQP with the qp engine, (default: MOSEK).')),
+    (['fwdti'], '-engine', '-fwdti_engine', dict(
+        action="store", dest="fwdti_engine", type=str, default="dipy",
+        help='FWDTI fit: dipy (per-voxel NLS) or batched (all voxels at once), (default: dipy).')),
+    (['fwdti'], '-warm_start', '-warm_start', dict(
+        action="store_true", dest="warm_start",
+        help='Seed the batched FWDTI fit of a voxel from its fitted neighbour.')),
+    (['ivim'], '-engine', '-ivim_engine', dict(
+        action="store", dest="ivim_engine", type=str, default="varpro",
+        help='IVIM fit: varpro (Dipy, per voxel), batched (all voxels at once) or batched-varpro (batched fit refined per voxel), (default: varpro).')),
+    (['qtdmri'], '-weighting', '-qtdmri_weighting', dict(
+        action="store", dest="weighting", type=str, default="voxel",
+        help='qt-dMRI Laplacian/L1 weights searched in every voxel (voxel), or on a sample of voxels for the whole brain (global) or per FA/MD stratum (strata), (default: voxel).')),
+    (['qtdmri'], '-weighting_samples', '-qtdmri_weighting_samples', dict(
+        action="store", dest="weighting_samples", type=int, default=1000,
+        help='Voxels sampled to search the qt-dMRI weights (default: 1000).')),
+    (['qtdmri'], '-weighting_bins', '-qtdmri_weighting_bins', dict(
+        action="store", dest="weighting_bins", type=int, default=4,
+        help='FA and MD bins of the qt-dMRI strata (default: 4).')),
+    (['mapmri'], '-big_delta', '-big_delta', dict(
+        action="store", dest="big_delta", type=float, default=0.0218,
+        help='time between pulses [s].')),
+    (['mapmri'], '-small_delta', '-small_delta', dict(
+        action="store", dest="small_delta", type=float, default=0.0129,
+        help='pulses duration in [s].')),
+    (['noddi', 'sandi'], '-b0thr', '-b0thr', dict(
+        action="store", dest="b0_thr", type=float, default=10,
+        help='Threshold for select non-dwi image.')),
+    (['noddi', 'sandi'], '-b0step', '-b0step', dict(
+        action="store", dest="b0_step", type=float, default=100,
+        help='Threshold for normalize b-value.')),
+    (['sandi'], '-TE', '-TE', dict(
+        action="store", dest="TE", type=float, default=0.10,
+        help='SANDI echo time if different from delta+small_delta [s] (optional).')),
+    (['sandi'], '-Delta', '-Delta', dict(
+        action="store", dest="Delta", type=float, default=0.020,
+        help='SANDI time between pulses [s].')),
+    (['sandi'], '-delta', '-delta', dict(
+        action="store", dest="delta", type=float, default=0.0055,
+        help='SANDI pulses duration in [s].')),
+    (['noddi', 'sandi'], '-threads', '-threads', dict(
+        action="store", dest="n_threads", type=int, default=None,
+        help='Threads of the AMICO fit (default: AMICO\'s own).')),
+]
+
+
+def add_options(parser, models, shared):
+    # The options of the given models, with their run/batch flags if shared.
+    for option_models, flag, shared_flag, settings in MODEL_OPTIONS:
+        if any(name in models for name in option_models):
+            parser.add_argument(shared_flag if shared else flag, **settings)
+
+
+def add_model_arguments(parser):
+    parser.add_argument(
+        '-scheme', action="store", dest="schemeFile", type=str, default=None,
+        help='Name of qt-dMRI scheme, required by qtdmri.')
+    add_options(parser, MODELS, shared=True)
+    arguments.add_pipeline_arguments(parser)
+
+
+def add_amico_arguments(parser):
+    add_options(parser, AMICO_MODELS, shared=True)
+
+
+def add_subject_arguments(parser, name):
+    parser.add_argument(
+        'subjectDirectory',
+        help='A directory of study subjects.')
+    parser.add_argument(
+        'dwiFile',
+        help='Name of DWI.')
+    if name == 'qtdmri':
+        parser.add_argument(
+            'schemeFile',
+            help='Name of scheme')
+    else:
+        parser.add_argument(
+            'bvalFile',
+            help='Name of b-value.')
+        parser.add_argument(
+            'bvecFile',
+            help='Name of gradiet vectory.')
+    parser.add_argument(
+        'maskFile',
+        help='Name of brain mask.')
+
+
+def add_fit_arguments(parser, name):
+    # The arguments of the fit_*.py script of the model.
+    add_options(parser, [name], shared=False)
+    if name in AMICO_MODELS:
+        arguments.add_amico_run_arguments(parser)
+    else:
+        arguments.add_pipeline_arguments(parser)
+
+
+def fit(name, options):
+    subjectDirectory = options.pop('subjectDirectory')
+    dwiFile = options.pop('dwiFile')
+    maskFile = options.pop('maskFile')
+    if name in AMICO_MODELS:
+        from microstructure import amico_models
+        amico_models.fit(name, subjectDirectory, dwiFile, options.pop('bvalFile'),
+                         options.pop('bvecFile'), maskFile, **options)
+    else:
+        from microstructure import pipeline
+        return pipeline.run(subjectDirectory, [name], dwiFile, maskFile, **options)
+
+
+def split_models(models, choices):
+    models = [name.strip() for name in models.split(',') if name.strip()]
+    unknown = [name for name in models if name not in choices]
+    if unknown:
+        raise SystemExit("Unknown models %s, choose from: %s."
+                         % (', '.join(unknown), ', '.join(choices)))
+    return models
+
+
+def main(argv=None):
+    #-----------------
+    # Parse arguments
+    #-----------------
+    parser = argparse.ArgumentParser(
+        prog="microstructure",
+        description="Fit microstructure models with Dipy and AMICO",
+        epilog="Written by Ye Wu, dr.yewu@outlook.com.\"")
+    parser.add_argument("-v", "--version",
+        action="version", default=argparse.SUPPRESS,
+        version='1.0',
+        help="Show program's version number and exit")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for name in list(MODELS) + AMICO_MODELS:
+        model_parser = subparsers.add_parser(
+            name, description=DESCRIPTIONS[name],
+            help=DESCRIPTIONS[name] + '.')
+        model_parser.add_argument("-v", "--version",
+            action="version", default=argparse.SUPPRESS,
+            version='1.0',
+            help="Show program's version number and exit")
+        add_subject_arguments(model_parser, name)
+        add_fit_arguments(model_parser, name)
+
+    run_parser = subparsers.add_parser(
+        'run',
+        help='Load a subject once and fit several models on it.')
+    run_parser.add_argument(
+        'subjectDirectory',
+        help='A directory of study subjects.')
+    add_file_arguments(run_parser)
+    run_parser.add_argument(
+        '--models', action="store", dest="models", type=str,
+        default="fwdti,ivim,msdki,wmti,mapmri",
+        help='Comma separated models to fit, from: %s (default: fwdti,ivim,msdki,wmti,mapmri).'
+             % ', '.join(MODELS))
+    add_model_arguments(run_parser)
+
+    batch_parser = subparsers.add_parser(
+        'batch',
+        help='Fit models on many subjects, skipping the ones already up to date.')
+    add_file_arguments(batch_parser)
+    batch_parser.add_argument(
+        '--subjects', action="store", dest="subjects", type=str, nargs='+', default=[],
+        help='Subject directories, or glob patterns of subject directories.')
+    batch_parser.add_argument(
+        '--subject-list', action="store", dest="subject_list", type=str, default=None,
+        help='Text file listing one subject directory (or glob pattern) per line.')
+    batch_parser.add_argument(
+        '--models', action="store", dest="models", type=str,
+        default="fwdti,ivim,msdki,wmti,mapmri",
+        help='Comma separated models to fit, from: %s (default: fwdti,ivim,msdki,wmti,mapmri).'
+             % ', '.join(list(MODELS) + AMICO_MODELS))
+    batch_parser.add_argument(
+        '--jobs', action="store", dest="jobs", type=int, default=1,
+        help='Number of jobs running at once (default: 1).')
+    batch_parser.add_argument(
+        '--memory-per-job', action="store", dest="memory_per_job", type=float, default=None,
+        help='Memory budget of each job in GB, reserved by the scheduler; a job whose memory (with its workers, without memory-mapped files) exceeds it is killed.')
+    batch_parser.add_argument(
+        '--total-memory', action="store", dest="total_memory", type=float, default=None,
+        help='Memory shared by the running jobs in GB (default: physical memory).')
+    batch_parser.add_argument(
+        '--force', action="store_true", dest="force",
+        help='Refit models that are already up to date.')
+    batch_parser.add_argument(
+        '--log', action="store", dest="log", type=str, default=None,
+        help='JSON lines file recording the status of every job.')
+    add_model_arguments(batch_parser)
+    add_amico_arguments(batch_parser)
+
+    amico_parser = subparsers.add_parser(
+        'amico',
+        help='Fit an AMICO model on many subjects in one process, sharing the kernels of each protocol.')
+    amico_parser.add_argument(
+        'model', choices=AMICO_MODELS,
+        help='AMICO model to fit.')
+    add_file_arguments(amico_parser)
+    amico_parser.add_argument(
+        '--subjects', action="store", dest="subjects", type=str, nargs='+', default=[],
+        help='Subject directories, or glob patterns of subject directories.')
+    amico_parser.add_argument(
+        '--subject-list', action="store", dest="subject_list", type=str, default=None,
+        help='Text file listing one subject directory (or glob pattern) per line.')
+    add_amico_arguments(amico_parser)
+    arguments.add_amico_run_arguments(amico_parser)
+
+    bench_parser = subparsers.add_parser(
+        'bench',
+        help='Benchmark every model path on a synthetic phantom, reported as JSON.')
+    bench_parser.add_argument(
+        '--paths', action="store", dest="paths", type=str, default=None,
+        help='Comma separated paths to run, e.g. fwdti,ivim,mapmri:isoCMAP,noddi (default: all).')
+    bench_parser.add_argument(
+        '--shape', action="store", dest="shape", type=int, nargs=3, default=[20, 20, 10],
+        help='Size of the phantom in voxels (default: 20 20 10).')
+    bench_parser.add_argument(
+        '--snr', action="store", dest="snr", type=float, default=30,
+        help='Signal to noise ratio of the b0 signal (default: 30).')
+    bench_parser.add_argument(
+        '--seed', action="store", dest="seed", type=int, default=0,
+        help='Seed of the phantom (default: 0).')
+    bench_parser.add_argument(
+        '--solver', action="store", dest="solver", type=str, default='CLARABEL',
+        help='cvxpy solver of the constrained MAP-MRI variants; OSQP only solves the CMAP and CMAPL variants (default: CLARABEL).')
+    bench_parser.add_argument(
+        '--mapmri-engine', action="store", dest="mapmri_engine", type=str,
+        choices=['dipy', 'qp'], default='dipy',
+        help='Fit the CMAP and CMAPL variants with Dipy or on a working set of their constraints (default: dipy).')
+    bench_parser.add_argument(
+        '--precision', action="store_true", dest="precision",
+        help='Report the errors of the float32 maps against float64 instead of timings.')
+    bench_parser.add_argument(
+        '--warm-start', action="store_true", dest="warm_start",
+        help='Report the time, iterations and map differences of the warm-started batched '
+             'FWDTI fit against a cold start, on a spatially smooth phantom, instead of timings.')
+    bench_parser.add_argument(
+        '-o', '--output', action="store", dest="output", type=str, default=None,
+        help='JSON report file (default: standard output).')
+
+    export_parser = subparsers.add_parser(
+        'export',
+        help='Write the maps of a maps.h5 container (--output-format hdf5) as NIfTI files.')
+    export_parser.add_argument(
+        'container',
+        help='The maps.h5 file.')
+    export_parser.add_argument(
+        '-o', '--outdir', action="store", dest="outdir", type=str, default=None,
+        help='Output directory (default: the directory of the container).')
+    export_parser.add_argument(
+        '--maps', action="store", dest="maps", type=str, default=None,
+        help='Comma separated maps to export, e.g. FA,MD,WMTI/AWF (default: all).')
+    export_parser.add_argument(
+        '--compression', action="store", dest="compression", type=int,
+        choices=range(10), metavar='{0..9}', default=arguments.DEFAULT_COMPRESSION,
+        help='gzip level of the NIfTI files, 0 writes uncompressed .nii (default: %d).'
+             % arguments.DEFAULT_COMPRESSION)
+
+    profile_parser = subparsers.add_parser(
+        'profile-imports',
+        help='Report the import time of the command line and of the backend of every command, as JSON.')
+    profile_parser.add_argument(
+        '--commands', action="store", dest="commands", type=str, default=None,
+        help='Comma separated commands to profile, e.g. cli,fwdti,noddi (default: all).')
+    profile_parser.add_argument(
+        '-o', '--output', action="store", dest="output", type=str, default=None,
+        help='JSON report file (default: standard output).')
+
+    serve_parser = subparsers.add_parser(
+        'serve',
+        help='Run a daemon of warm workers fitting the jobs sent to a Unix socket.')
+    serve_parser.add_argument(
+        '--socket', action="store", dest="socket", type=str, required=True,
+        help='Unix socket to listen on.')
+    serve_parser.add_argument(
+        '--workers', action="store", dest="workers", type=int, default=1,
+        help='Number of jobs running at once (default: 1).')
+
+    submit_parser = subparsers.add_parser(
+        'submit',
+        help='Send a model or run command to the daemon, e.g. submit --socket S fwdti subject dwi.nii.gz ...')
+    submit_parser.add_argument(
+        '--socket', action="store", dest="socket", type=str, default=None,
+        help='Unix socket of the daemon (default: $MICROSTRUCTURE_DAEMON).')
+    submit_parser.add_argument(
+        '--no-wait', action="store_false", dest="wait",
+        help='Return the job id at once instead of waiting for the job.')
+    submit_parser.add_argument(
+        'job', nargs=argparse.REMAINDER,
+        help='Model or run command and its arguments.')
+
+    jobs_parser = subparsers.add_parser(
+        'jobs',
+        help='Report the jobs of the daemon, as JSON.')
+    jobs_parser.add_argument(
+        '--socket', action="store", dest="socket", type=str, default=None,
+        help='Unix socket of the daemon (default: $MICROSTRUCTURE_DAEMON).')
+    jobs_parser.add_argument(
+        '--id', action="store", dest="id", type=int, default=None,
+        help='Report only this job.')
+    jobs_parser.add_argument(
+        '--shutdown', action="store_true", dest="shutdown",
+        help='Stop the daemon once its running jobs have finished.')
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args = parser.parse_args(argv)
+
+    if args.command in MODELS or args.command in AMICO_MODELS:
+        from microstructure import daemon
+        if os.environ.get(daemon.DAEMON_VARIABLE):
+            sys.exit(daemon.submit(os.environ[daemon.DAEMON_VARIABLE], argv))
+        options = vars(args)
+        return fit(options.pop('command'), options)
+
+    elif args.command == 'run':
+        from microstructure import pipeline
+        options = vars(args)
+        del options['command']
+        options['models'] = split_models(args.models, list(MODELS))
+        pipeline.run(**options)
+
+    elif args.command == 'batch':
+        from microstructure import batch
+        options = vars(args)
+        files = {name: options.pop(name)
+                 for name in ['dwiFile', 'bvalFile', 'bvecFile', 'maskFile', 'schemeFile']}
+        scheduling = {name: options.pop(name)
+                      for name in ['jobs', 'memory_per_job', 'total_memory', 'force', 'log']}
+        subjects = batch.expand_subjects(options.pop('subjects'), options.pop('subject_list'))
+        models = split_models(options.pop('models'), list(MODELS) + AMICO_MODELS)
+        del options['command']
+        failed = batch.run_batch(subjects, models, files, options, **scheduling)
+        if failed:
+            sys.exit(1)
+
+    elif args.command == 'amico':
+        from microstructure import amico_models, batch
+        options = vars(args)
+        del options['command']
+        subjects = batch.expand_subjects(options.pop('subjects'), options.pop('subject_list'))
+        failed = amico_models.fit_subjects(options.pop('model'), subjects, keep_going=True,
+                                           **options)
+        if failed:
+            sys.exit(1)
+
+    elif args.command == 'bench':
+        from microstructure import benchmark
+        paths = benchmark.PATHS if args.paths is None else split_models(args.paths, benchmark.PATHS)
+        benchmark.main(paths=paths, shape=tuple(args.shape), snr=args.snr, seed=args.seed,
+                       solver=args.solver, output=args.output, precision=args.precision,
+                       warm_start=args.warm_start, mapmri_engine=args.mapmri_engine)
+
+    elif args.command == 'serve':
+        from microstructure import daemon
+        daemon.serve(args.socket, workers=args.workers)
+
+    elif args.command in ('submit', 'jobs'):
+        from microstructure import daemon
+        path = args.socket or os.environ.get(daemon.DAEMON_VARIABLE)
+        if path is None:
+            parser.error('%s needs --socket or $%s.' % (args.command, daemon.DAEMON_VARIABLE))
+        if args.command == 'submit':
+            # Checked here, so that a wrong command fails before it is queued.
+            job = parser.parse_args(args.job)
+            if job.command not in daemon.JOB_COMMANDS:
+                parser.error('submit takes a model or run command, not %s.' % job.command)
+            sys.exit(daemon.submit(path, args.job, wait=args.wait))
+        if args.shutdown:
+            message = {'op': 'shutdown'}
+        elif args.id is not None:
+            message = {'op': 'status', 'id': args.id}
+        else:
+            message = {'op': 'list'}
+        print(json.dumps(daemon.request(path, message), indent=2))
+
+    elif args.command == 'export':
+        from microstructure import container
+        names = None if args.maps is None else [name.strip() for name in args.maps.split(',')
+                                                  if name.strip()]
+        container.export(args.container, outdir=args.outdir, names=names,
+                         compression=args.compression)
+
+    elif args.command == 'profile-imports':
+        from microstructure import import_profile
+        commands = (None if args.commands is None else
+                    split_models(args.commands, list(import_profile.COMMANDS)))
+        import_profile.main(commands=commands, output=args.output)
+
+
+if __name__ == '__main__':
+    main()
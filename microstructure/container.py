@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+All the maps of a model fit in one chunked HDF5 container.
+
+With output_format='hdf5' a model writes <outdir>/maps.h5 instead of one
+NIfTI per map: one dataset per map (a name with a subdirectory becomes a
+group), chunked in blocks of about CHUNK_BYTES, so that reading a region of
+a map only reads and decompresses the chunks it overlaps. Chunks are
+compressed with Blosc (zstd, byte shuffle) on write_threads threads when
+hdf5plugin is installed, with gzip otherwise; chunks without a voxel of the
+mask are not written, and so not stored. The container keeps the affine, the grid shape and the
+provenance of the fit (model, inputs, options, library versions) as
+attributes, and is written under a temporary name and renamed once complete.
+
+export() writes the maps of a container back to NIfTI files, named as the
+NIfTI output of the model.
+"""
+
+import json
+import os
+import platform
+import sys
+import time
+
+import h5py
+import numpy as np
+from microstructure.output import (DEFAULT_COMPRESSION, DEFAULT_WRITE_THREADS, extension,
+                                   finish_nifti, open_nifti_memmap, temporary_name)
+from microstructure.voxels import ChunkedMap
+
+CONTAINER = 'maps.h5'
+
+CHUNK_BYTES = 2 * 1024 ** 2
+
+# Libraries whose versions are recorded in the provenance, when imported.
+VERSIONS = ['numpy', 'scipy', 'nibabel', 'dipy', 'cvxpy', 'h5py', 'hdf5plugin']
+
+
+def provenance(**info):
+    versions = {name: getattr(sys.modules[name], '__version__', None)
+                for name in VERSIONS if name in sys.modules}
+    return dict(info, created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                python=platform.python_version(), versions=versions)
+
+
+def compression_options(compression=DEFAULT_COMPRESSION, write_threads=DEFAULT_WRITE_THREADS):
+    if compression == 0:
+        return {}
+    try:
+        import hdf5plugin
+    except ImportError:
+        return {'compression': 'gzip', 'compression_opts': compression, 'shuffle': True}
+    # c-blosc reads its number of threads from the environment on every call.
+    os.environ['BLOSC_NTHREADS'] = str(max(1, write_threads))
+    return dict(hdf5plugin.Blosc(cname='zstd', clevel=compression,
+                                 shuffle=hdf5plugin.Blosc.SHUFFLE))
+
+
+def chunk_shape(shape, grid_ndim, itemsize):
+    # Cubic blocks of the grid, with whole values (e.g. all ODF directions)
+    # of each voxel.
+    values = int(np.prod(shape[grid_ndim:]))
+    edge = max(1, int((CHUNK_BYTES / (itemsize * values)) ** (1 / grid_ndim)))
+    return tuple(min(n, edge) for n in shape[:grid_ndim]) + tuple(shape[grid_ndim:])
+
+
+def create_map(f, name, shape, dtype, grid_ndim, options):
+    dtype = np.dtype(dtype)
+    return f.create_dataset(name, shape=shape, dtype=dtype, fillvalue=0,
+                            chunks=chunk_shape(shape, grid_ndim, dtype.itemsize), **options)
+
+
+def slabs(dataset):
+    # Slabs of the first axis, one chunk thick.
+    thickness = dataset.chunks[0] if dataset.chunks else dataset.shape[0]
+    for x0 in range(0, dataset.shape[0], thickness):
+        yield x0, min(x0 + thickness, dataset.shape[0])
+
+
+def write_tiles(dataset, x0, x1, block, mask):
+    # The chunks of a slab that hold a voxel of the mask; the others are
+    # left unallocated and read as the fill value.
+    grid_ndim = mask.ndim
+    edges = dataset.chunks[1:grid_ndim] if dataset.chunks else dataset.shape[1:grid_ndim]
+    slab_mask = mask[x0:x1]
+    for corner in np.ndindex(*(-(-n // edge) for n, edge in zip(dataset.shape[1:grid_ndim], edges))):
+        tile = tuple(slice(i * edge, (i + 1) * edge) for i, edge in zip(corner, edges))
+        if slab_mask[(slice(None),) + tile].any():
+            dataset[(slice(x0, x1),) + tile] = block[(slice(None),) + tile]
+
+
+def write_compact(dataset, values, mask):
+    # The masked voxels are in C order, so the voxels of a slab of the first
+    # axis are contiguous in the compact array.
+    index = np.nonzero(mask)
+    for x0, x1 in slabs(dataset):
+        start, stop = np.searchsorted(index[0], [x0, x1])
+        if stop == start:
+            continue
+        if isinstance(values, ChunkedMap):
+            chunk = values.evaluate(start, stop)
+        else:
+            chunk = values[start:stop]
+        block = np.zeros((x1 - x0,) + dataset.shape[1:], dtype=dataset.dtype)
+        block[(index[0][start:stop] - x0,) + tuple(axis[start:stop] for axis in index[1:])] = chunk
+        write_tiles(dataset, x0, x1, block, mask)
+
+
+def write_attributes(f, shape, affine, info):
+    f.attrs['affine'] = np.asarray(affine, dtype=np.float64)
+    f.attrs['shape'] = np.asarray(shape, dtype=np.int64)
+    f.attrs['provenance'] = json.dumps(info or {}, default=repr)
+
+
+def write_container(filename, write, shape, affine, info):
+    tmp = temporary_name(filename)
+    try:
+        with h5py.File(tmp, 'w') as f:
+            write_attributes(f, shape, affine, info)
+            write(f)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def save_maps(outdir, maps, mask, affine, compression=DEFAULT_COMPRESSION, float32=False,
+              write_threads=DEFAULT_WRITE_THREADS, info=None):
+    options = compression_options(compression, write_threads)
+
+    def write(f):
+        for name, values in maps.items():
+            if isinstance(values, ChunkedMap):
+                shape, dtype = values.shape, values.dtype
+            else:
+                values = np.asarray(values)
+                shape, dtype = values.shape[1:], values.dtype
+            if float32 and np.issubdtype(dtype, np.floating):
+                dtype = np.float32
+            dataset = create_map(f, name, mask.shape + tuple(shape), dtype, mask.ndim, options)
+            write_compact(dataset, values, mask)
+
+    os.makedirs(outdir, exist_ok=True)
+    write_container(os.path.join(outdir, CONTAINER), write, mask.shape, affine, info)
+
+
+def save_stream(outdir, stream, compression=DEFAULT_COMPRESSION,
+                write_threads=DEFAULT_WRITE_THREADS, info=None):
+    # The maps of an output.MapStream, from its memory-mapped volumes, which
+    # are removed once the container is complete.
+    options = compression_options(compression, write_threads)
+    mask = np.zeros(stream.shape, dtype=bool)
+    mask[stream.index] = True
+
+    def write(f):
+        for name, volume in stream.volumes.items():
+            dataset = create_map(f, name, volume.shape, volume.dtype, len(stream.shape), options)
+            for x0, x1 in slabs(dataset):
+                if mask[x0:x1].any():
+                    write_tiles(dataset, x0, x1, np.asarray(volume[x0:x1]), mask)
+
+    os.makedirs(outdir, exist_ok=True)
+    write_container(os.path.join(outdir, CONTAINER), write, stream.shape, stream.affine, info)
+    stream.abort()
+
+
+def map_names(f):
+    names = []
+    f.visititems(lambda name, item: names.append(name) if isinstance(item, h5py.Dataset) else None)
+    return names
+
+
+def read_map(filename, name, region=()):
+    # region: a tuple of slices of the grid, e.g. the bounding box of an ROI.
+    with h5py.File(filename, 'r') as f:
+        return f[name][region]
+
+
+def read_provenance(filename):
+    with h5py.File(filename, 'r') as f:
+        return json.loads(f.attrs['provenance'])
+
+
+def export(filename, outdir=None, names=None, compression=DEFAULT_COMPRESSION):
+    outdir = outdir if outdir is not None else os.path.dirname(os.path.abspath(filename))
+    with h5py.File(filename, 'r') as f:
+        affine = f.attrs['affine']
+        for name in names or map_names(f):
+            if name not in f:
+                raise ValueError("%s has no map '%s'." % (filename, name))
+            dataset = f[name]
+            output = os.path.join(outdir, name + extension(compression))
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            tmp = temporary_name(output + '.nii')
+            try:
+                volume = open_nifti_memmap(tmp, dataset.shape, dataset.dtype, affine)
+                for x0, x1 in slabs(dataset):
+                    volume[x0:x1] = dataset[x0:x1]
+                volume.flush()
+                del volume
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+            finish_nifti(tmp, output, compression)
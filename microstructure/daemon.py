@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Warm worker daemon running fit jobs sent over a Unix socket.
+
+``python -m microstructure serve --socket PATH --workers N`` starts N worker
+processes that import the pipeline (and AMICO, when installed) once and keep
+the models they load in memory from job to job (see model_cache). A job is
+the argument list of a model subcommand or of run, e.g. ['fwdti', subject,
+dwi, bval, bvec, mask, '--n-jobs', '4'], with the working directory of the
+client, and runs in a worker exactly as the subcommand would; any other
+command (serve, batch, ...) is rejected. The socket is created readable and
+writable by its owner only.
+
+Requests and responses are JSON objects, one per line:
+    {"op": "submit", "argv": [...], "cwd": "...", "wait": true}
+    {"op": "status", "id": N}
+    {"op": "list"}
+    {"op": "shutdown"}
+A job is 'queued', 'running', 'done', 'failed' or 'cancelled' (queued when
+the daemon was shut down); a submit with wait answers
+once the job has finished, otherwise at once with the job id. A finished job
+reports its wall time, the run reports of its models (Dipy models) or its
+error.
+
+With MICROSTRUCTURE_DAEMON set to the socket, the model subcommands (and so
+the fit_*.py scripts) parse their arguments as usual and then send the job
+to the daemon and wait for it instead of fitting.
+"""
+
+import importlib
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from microstructure.models import AMICO_MODELS, MODELS
+
+# Environment variable holding the socket of the daemon used by the model
+# subcommands.
+DAEMON_VARIABLE = 'MICROSTRUCTURE_DAEMON'
+
+# Finished jobs kept for status requests.
+JOB_HISTORY = 1000
+
+# Subcommands a job may run.
+JOB_COMMANDS = list(MODELS) + AMICO_MODELS + ['run']
+
+
+def _init_worker():
+    # Jobs run here, not sent on to a daemon.
+    os.environ.pop(DAEMON_VARIABLE, None)
+    # Imported once per worker rather than once per job; a job needing a
+    # missing backend fails with its ImportError.
+    for module in ['microstructure.pipeline', 'microstructure.amico_models']:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+
+def run_job(argv, cwd):
+    from microstructure.cli import main
+
+    os.chdir(cwd)
+    started = time.time()
+    try:
+        logs = main(argv)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise RuntimeError("%s exited with status %s." % (' '.join(argv), e.code))
+        logs = None
+    return {'seconds': time.time() - started,
+            'reports': [log.report() for log in logs or []]}
+
+
+class Job:
+
+    def __init__(self, job_id, argv, cwd, future):
+        self.id = job_id
+        self.argv = argv
+        self.cwd = cwd
+        self.future = future
+        self.submitted = time.time()
+
+    def status(self):
+        if self.future.cancelled():
+            return 'cancelled'
+        if self.future.running():
+            return 'running'
+        if not self.future.done():
+            return 'queued'
+        return 'failed' if self.future.exception() is not None else 'done'
+
+    def report(self):
+        report = {'id': self.id, 'argv': self.argv, 'cwd': self.cwd,
+                  'status': self.status(), 'submitted': self.submitted}
+        if report['status'] == 'done':
+            report.update(self.future.result())
+        elif report['status'] == 'failed':
+            error = self.future.exception()
+            report['error'] = ''.join(traceback.format_exception(type(error), error,
+                                                                 error.__traceback__))
+        return report
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.dispatch(json.loads(line))
+            except Exception as e:
+                response = {'status': 'error', 'error': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode())
+            self.wfile.flush()
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, workers=1):
+        super().__init__(path, Handler)
+        self.workers = max(1, workers)
+        self.executor = self.start_workers()
+        self.jobs = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def server_bind(self):
+        # Bound under a umask rather than chmod-ed afterwards, so that other
+        # users can never connect to the socket.
+        umask = os.umask(0o077)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def start_workers(self):
+        # Workers are spawned, as in parallel.worker_pool.
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker)
+
+    def submit(self, argv, cwd):
+        with self.lock:
+            try:
+                future = self.executor.submit(run_job, argv, cwd)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for its memory): its job has
+                # failed, the next ones run on new workers.
+                self.executor = self.start_workers()
+                future = self.executor.submit(run_job, argv, cwd)
+            job = Job(self.next_id, list(argv), cwd, future)
+            self.jobs[job.id] = job
+            self.next_id += 1
+            finished = [job_id for job_id, other in self.jobs.items() if other.future.done()]
+            for job_id in finished[:max(0, len(finished) - JOB_HISTORY)]:
+                del self.jobs[job_id]
+        return job
+
+    def dispatch(self, request):
+        op = request.get('op')
+        if op == 'submit':
+            argv = request['argv']
+            if not argv or not all(isinstance(arg, str) for arg in argv) \
+                    or argv[0] not in JOB_COMMANDS:
+                raise ValueError("A job runs one of the commands %s, not %s."
+                                 % (', '.join(JOB_COMMANDS), argv[:1]))
+            job = self.submit(argv, request.get('cwd') or os.getcwd())
+            if request.get('wait', True):
+                wait([job.future])
+            return job.report()
+        if op == 'status':
+            job = self.jobs.get(request['id'])
+            if job is None:
+                raise ValueError("Unknown job %s." % request['id'])
+            return job.report()
+        if op == 'list':
+            return {'jobs': [job.report() for job in list(self.jobs.values())]}
+        if op == 'shutdown':
+            threading.Thread(target=self.shutdown).start()
+            return {'status': 'shutting down'}
+        raise ValueError("Unknown request '%s'." % op)
+
+
+def remove_stale_socket(path):
+    # A socket nobody listens on is left over by a daemon that died.
+    if not os.path.exists(path):
+        return
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    raise RuntimeError("A daemon is already listening on %s." % path)
+
+
+def serve(path, workers=1):
+    remove_stale_socket(path)
+    daemon = Daemon(path, workers=workers)
+    print("Serving on %s with %d workers." % (path, max(1, workers)), flush=True)
+    try:
+        daemon.serve_forever()
+    finally:
+        daemon.server_close()
+        daemon.executor.shutdown(wait=True, cancel_futures=True)
+        os.unlink(path)
+
+
+def request(path, message):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        with client.makefile('rwb') as stream:
+            stream.write((json.dumps(message) + '\n').encode())
+            stream.flush()
+            return json.loads(stream.readline())
+
+
+def submit(path, argv, wait=True):
+    # Client side of a model subcommand: returns its exit status.
+    report = request(path, {'op': 'submit', 'argv': list(argv), 'cwd': os.getcwd(),
+                            'wait': wait})
+    if report.get('status') in ('failed', 'error'):
+        sys.stderr.write(report.get('error', '') + '\n')
+        return 1
+    print(json.dumps(report, indent=2))
+    return 0
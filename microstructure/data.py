@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Loading of DWI volumes, brain masks and gradient tables.
+"""
+
+import nibabel as nib
+import numpy as np
+from dipy.core.gradients import gradient_table, gradient_table_from_gradient_strength_bvecs
+from dipy.io.image import load_nifti
+from microstructure.input_cache import open_dwi
+from microstructure.voxels import gather
+
+
+def load_dwi(dwiFile, maskFile, input_cache=False, dtype=np.float64):
+    # dtype: the precision the input cache converts the DWI to.
+    if input_cache:
+        return open_dwi(dwiFile, maskFile, dtype=dtype)
+    # The DWI is kept in its on-disk dtype; only the masked voxels are
+    # converted (to float64, or float32) by gather().
+    dwi_img = nib.load(dwiFile)
+    dwi_data = np.asanyarray(dwi_img.dataobj)
+    mask_data, mask_affine = load_nifti(maskFile, return_img=False)
+    return dwi_data, mask_data, dwi_img.affine
+
+
+def load_masked_dwi(dwiFile, maskFile, input_cache=False, dtype=np.float64):
+    dwi_data, mask_data, dwi_affine = load_dwi(dwiFile, maskFile, input_cache=input_cache,
+                                               dtype=dtype)
+    data, mask = gather(dwi_data, mask_data, dtype=dtype)
+    return data, mask, dwi_affine
+
+
+def load_gtab(bvalFile, bvecFile, big_delta=None, small_delta=None):
+    return gradient_table(bvalFile, bvecFile,
+                          big_delta=big_delta,
+                          small_delta=small_delta)
+
+
+def load_scheme_gtab(schemeFile):
+    qtdmri_scheme = np.loadtxt(schemeFile, skiprows=1)
+    bvecs = qtdmri_scheme[:, 1:4]
+    G = qtdmri_scheme[:, 4] / 1e3
+    small_delta = qtdmri_scheme[:, 5]
+    big_delta = qtdmri_scheme[:, 6]
+    return gradient_table_from_gradient_strength_bvecs(G, bvecs, big_delta, small_delta)
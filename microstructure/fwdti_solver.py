@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Batched free-water DTI fit of all masked voxels at once with NumPy array
+operations.
+
+The signal S = S0 ((1 - f) exp(-b g'Dg) + f exp(-b Diso)) is fitted as in
+Dipy's FreeWaterTensorModel(fit_method='NLS'), on whole blocks of voxels:
+
+1. f on a grid refined three times (11 values from 0 to 1, then within 0.1
+   and 0.01 of the best value), with a weighted log-linear tensor fit of the
+   signal corrected for free water for every grid value; voxels whose tensor
+   MD without free water exceeds mdreg are taken as free water (f = 1);
+2. Levenberg-Marquardt steps on the unweighted least squares, with the
+   tensor parameterized by its Cholesky factor (D = L L', positive
+   definite), log S0 and f = sin(x)^2, and a damping factor and a
+   convergence mask per voxel.
+
+A voxel has converged when a step decreases its cost by less than tol
+(relative) or the damping exceeds 1e10. The maps then agree with Dipy's NLS
+fit to within that tolerance, except where the two solvers stop in different
+local minima.
+
+With warm_start=True, the voxels of a block are solved in red-black order:
+the even voxels from the grid search, then every odd voxel whose neighbour
+before it (along the fastest axis of the mask: C order in memory, x in the
+axial slabs of streaming) is tissue from that neighbour's converged
+parameters, with its own log S0, skipping its grid search. An odd voxel left
+with more than RESTART_FACTOR times the cost of its neighbour, e.g. at an
+edge of the mask, is solved again from the grid search. The red-black order
+starts again in every block, and seeds do not cross blocks nor the chunks of
+parallel.fit_voxels (n_jobs, checkpoints) and streaming, so the maps then
+depend on the chunks within the tolerance of the solver.
+"""
+
+import numpy as np
+from microstructure.voxels import CHUNK_VOXELS
+
+# Free water diffusivity and MD above which a voxel is free water [mm^2/s],
+# as in Dipy.
+DISO = 3.0e-3
+MDREG = 2.7e-3
+MIN_SIGNAL = 1e-6
+
+MAX_ITER = 100
+TOLERANCE = 1e-8
+
+# Cost, relative to the neighbour it was seeded from, above which a
+# warm-started voxel is solved again from the grid search.
+RESTART_FACTOR = 2
+
+
+class FreeWaterTensorFit:
+    """Maps of a batch of voxels, with the attributes of Dipy's FreeWaterTensorFit."""
+
+    def __init__(self, evals, f, S0, iterations=None):
+        self.evals = evals
+        self.f = f
+        self.S0 = S0
+        # Levenberg-Marquardt steps per voxel.
+        self.iterations = iterations
+
+    @property
+    def md(self):
+        return self.evals.mean(axis=-1)
+
+    @property
+    def ad(self):
+        return self.evals[..., 2]
+
+    @property
+    def rd(self):
+        return self.evals[..., :2].mean(axis=-1)
+
+    @property
+    def fa(self):
+        l1, l2, l3 = self.evals[..., 0], self.evals[..., 1], self.evals[..., 2]
+        norm = np.sqrt(l1 ** 2 + l2 ** 2 + l3 ** 2)
+        spread = np.sqrt((l1 - l2) ** 2 + (l2 - l3) ** 2 + (l3 - l1) ** 2)
+        return np.sqrt(0.5) * np.divide(spread, norm, out=np.zeros_like(norm), where=norm > 0)
+
+
+def tensor_design(gtab):
+    # b g'Dg = B d with d = (Dxx, Dxy, Dyy, Dxz, Dyz, Dzz), Dipy's order.
+    g = np.asarray(gtab.bvecs, dtype=float)
+    b = np.asarray(gtab.bvals, dtype=float)
+    x, y, z = g[:, 0], g[:, 1], g[:, 2]
+    return b[:, None] * np.column_stack([x * x, 2 * x * y, y * y, 2 * x * z, 2 * y * z, z * z])
+
+
+def tensor_matrix(d):
+    return np.stack([d[:, [0, 1, 3]], d[:, [1, 2, 4]], d[:, [3, 4, 5]]], axis=1)
+
+
+def cholesky_to_tensor(l):
+    l1, l2, l3, l4, l5, l6 = l.T
+    return np.column_stack([l1 * l1, l1 * l2, l2 * l2 + l3 * l3, l1 * l4,
+                            l2 * l4 + l3 * l5, l4 * l4 + l5 * l5 + l6 * l6])
+
+
+def cholesky_jacobian(l):
+    # d d_k / d l_j of cholesky_to_tensor, (n_voxels, 6, 6).
+    l1, l2, l3, l4, l5, l6 = l.T
+    zero = np.zeros_like(l1)
+    return np.stack([
+        np.column_stack([2 * l1, zero, zero, zero, zero, zero]),
+        np.column_stack([l2, l1, zero, zero, zero, zero]),
+        np.column_stack([zero, 2 * l2, 2 * l3, zero, zero, zero]),
+        np.column_stack([l4, zero, zero, l1, zero, zero]),
+        np.column_stack([zero, l4, l5, l2, l3, zero]),
+        np.column_stack([zero, zero, zero, 2 * l4, 2 * l5, 2 * l6]),
+    ], axis=1)
+
+
+def tensor_to_cholesky(d):
+    # Cholesky factor of the tensor with its eigenvalues clipped positive.
+    evals, evecs = np.linalg.eigh(tensor_matrix(d))
+    evals = np.clip(evals, 1e-8, None)
+    L = np.linalg.cholesky(np.einsum('vij,vj,vkj->vik', evecs, evals, evecs))
+    return np.column_stack([L[:, 0, 0], L[:, 1, 0], L[:, 1, 1], L[:, 2, 0], L[:, 2, 1], L[:, 2, 2]])
+
+
+class BatchedFreeWaterTensorModel:
+
+    def __init__(self, gtab, Diso=DISO, mdreg=MDREG, max_iter=MAX_ITER, tol=TOLERANCE,
+                 warm_start=False):
+        self.B = tensor_design(gtab)
+        self.b0s_mask = np.asarray(gtab.b0s_mask)
+        if not self.b0s_mask.any():
+            raise ValueError("The batched free-water DTI fit needs b0 volumes.")
+        self.water = np.exp(-np.asarray(gtab.bvals, dtype=float) * Diso)
+        self.mdreg = mdreg
+        self.max_iter = max_iter
+        self.tol = tol
+        self.warm_start = warm_start
+
+    def fit(self, data):
+        data = np.asarray(data, dtype=float).reshape(-1, len(self.B))
+        evals = np.empty((len(data), 3))
+        f = np.empty(len(data))
+        S0 = np.empty(len(data))
+        iterations = np.zeros(len(data), dtype=int)
+        for start in range(0, len(data), CHUNK_VOXELS):
+            stop = min(start + CHUNK_VOXELS, len(data))
+            (evals[start:stop], f[start:stop], S0[start:stop],
+             iterations[start:stop]) = self.fit_block(data[start:stop])
+        return FreeWaterTensorFit(evals, f, S0, iterations=iterations)
+
+    def fit_block(self, data):
+        S0 = np.clip(data[:, self.b0s_mask].mean(axis=1), MIN_SIGNAL, None)
+        free_water = self.free_water(data)
+        if self.warm_start:
+            p, iterations = self.warm_fit(data, S0, free_water)
+        else:
+            p, iterations = self.cold_fit(data, S0, free_water)
+
+        evals = np.linalg.eigvalsh(tensor_matrix(cholesky_to_tensor(p[:, :6])))
+        f = np.sin(p[:, 7]) ** 2
+        evals[free_water] = 0
+        f[free_water] = 1
+        return evals, f, np.exp(p[:, 6]), iterations
+
+    def cold_fit(self, data, S0, free_water):
+        d, log_S0, f = self.search_water(data, S0)
+        p = np.column_stack([tensor_to_cholesky(d), log_S0, np.arcsin(np.sqrt(f))])
+        return self.refine(data, p, ~free_water)
+
+    def warm_fit(self, data, S0, free_water):
+        n = len(data)
+        p = np.empty((n, 8))
+        iterations = np.zeros(n, dtype=int)
+        odd = np.arange(1, n, 2)
+        # A free water neighbour has no tensor to seed from.
+        seeded = odd[~free_water[odd] & ~free_water[odd - 1]]
+        cold = np.setdiff1d(np.arange(n), seeded)
+        p[cold], iterations[cold] = self.cold_fit(data[cold], S0[cold], free_water[cold])
+
+        seed = p[seeded - 1]
+        seed[:, 6] = np.log(S0[seeded])
+        p[seeded], iterations[seeded] = self.refine(data[seeded], seed,
+                                                    np.ones(len(seeded), dtype=bool))
+
+        cost = self.cost(data, p)
+        restart = seeded[cost[seeded] > RESTART_FACTOR * cost[seeded - 1]]
+        if len(restart):
+            p[restart], steps = self.cold_fit(data[restart], S0[restart], free_water[restart])
+            iterations[restart] += steps
+        return p, iterations
+
+    def tensor_wls(self, signal):
+        # Weighted log-linear fit of (d, log S0) to the tissue signal.
+        signal = np.clip(signal, MIN_SIGNAL, None)
+        X = np.column_stack([-self.B, np.ones(len(self.B))])
+        w = signal ** 2
+        XtWX = np.einsum('vn,ni,nj->vij', w, X, X) + 1e-12 * np.eye(7)
+        XtWz = np.einsum('vn,ni,vn->vi', w, X, np.log(signal))
+        coef = np.linalg.solve(XtWX, XtWz[..., None])[..., 0]
+        return coef[:, :6], coef[:, 6]
+
+    def free_water(self, data):
+        d, _ = self.tensor_wls(data)
+        return d[:, [0, 2, 5]].mean(axis=1) > self.mdreg
+
+    def search_water(self, data, S0):
+        n = len(data)
+        best_cost = np.full(n, np.inf)
+        best_f = np.zeros(n)
+        best_d = np.zeros((n, 6))
+        best_log_S0 = np.log(S0)
+        low, high = np.zeros(n), np.ones(n)
+        for step in [0.1, 0.01, 0.001]:
+            for fraction in np.linspace(0, 1, 11):
+                # f = 1 leaves no tissue signal to fit.
+                f = np.minimum(low + fraction * (high - low), 1 - step / 10)
+                tissue = (data - (S0 * f)[:, None] * self.water) / (1 - f)[:, None]
+                d, log_S0 = self.tensor_wls(tissue)
+                predicted = ((S0 * f)[:, None] * self.water +
+                             ((1 - f) * np.exp(log_S0))[:, None] * np.exp(-d @ self.B.T))
+                cost = np.sum((data - predicted) ** 2, axis=1)
+                better = cost < best_cost
+                best_cost[better], best_f[better] = cost[better], f[better]
+                best_d[better], best_log_S0[better] = d[better], log_S0[better]
+            low = np.clip(best_f - step, 0, 1)
+            high = np.clip(best_f + step, 0, 1)
+        return best_d, best_log_S0, best_f
+
+    def predict(self, p):
+        tissue = np.exp(-cholesky_to_tensor(p[:, :6]) @ self.B.T)
+        f = np.sin(p[:, 7]) ** 2
+        S0 = np.exp(p[:, 6])
+        predicted = S0[:, None] * ((1 - f)[:, None] * tissue + f[:, None] * self.water)
+        return predicted, tissue, f, S0
+
+    def cost(self, data, p):
+        r = data - self.predict(p)[0]
+        return np.sum(r * r, axis=1)
+
+    def jacobian(self, p, predicted, tissue, f, S0):
+        tensor = -((S0 * (1 - f))[:, None, None] * tissue[:, :, None]) * self.B[None]
+        J_l = tensor @ cholesky_jacobian(p[:, :6])
+        J_S0 = predicted[..., None]
+        J_x = (S0[:, None] * (self.water[None] - tissue) * np.sin(2 * p[:, 7])[:, None])[..., None]
+        return np.concatenate([J_l, J_S0, J_x], axis=-1)
+
+    def refine(self, data, p, active):
+        predicted, tissue, f, S0 = self.predict(p)
+        r = data - predicted
+        cost = np.sum(r * r, axis=1)
+        damping = np.full(len(data), 1e-3)
+        active = active.copy()
+        iterations = np.zeros(len(data), dtype=int)
+
+        for _ in range(self.max_iter):
+            v = np.flatnonzero(active)
+            if not len(v):
+                break
+            iterations[v] += 1
+            J = self.jacobian(p[v], predicted[v], tissue[v], f[v], S0[v])
+            JtJ = np.einsum('vni,vnj->vij', J, J)
+            Jtr = np.einsum('vni,vn->vi', J, r[v])
+            diagonal = np.einsum('vii->vi', JtJ)
+            A = JtJ + (damping[v, None] * diagonal + 1e-30)[:, :, None] * np.eye(p.shape[1])
+            trial = p[v] + np.linalg.solve(A, Jtr[..., None])[..., 0]
+
+            trial_predicted, trial_tissue, trial_f, trial_S0 = self.predict(trial)
+            trial_r = data[v] - trial_predicted
+            trial_cost = np.sum(trial_r * trial_r, axis=1)
+            better = trial_cost < cost[v]
+            decrease = (cost[v] - trial_cost) / np.maximum(cost[v], MIN_SIGNAL)
+
+            accepted = v[better]
+            p[accepted] = trial[better]
+            predicted[accepted], tissue[accepted] = trial_predicted[better], trial_tissue[better]
+            f[accepted], S0[accepted] = trial_f[better], trial_S0[better]
+            r[accepted], cost[accepted] = trial_r[better], trial_cost[better]
+            damping[v] = np.where(better, damping[v] / 10, damping[v] * 10)
+
+            converged = (better & (decrease < self.tol)) | (damping[v] > 1e10)
+            active[v[converged]] = False
+
+        return p, iterations
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Import time of the command line and of the backend of every command.
+
+Each module is imported in a fresh interpreter with ``python -X importtime``,
+so that nothing is already imported, and the report gives its total import
+time and the packages that take the longest (with the packages they import),
+as JSON.
+"""
+
+import json
+import subprocess
+import sys
+
+from microstructure.models import AMICO_MODELS, MODELS
+
+# Module imported by each command: the command line itself, the pipeline with
+# the model module of a Dipy model, the AMICO driver of an AMICO model.
+COMMANDS = dict([('cli', ['microstructure.cli'])] +
+                [(name, ['microstructure.pipeline', module]) for name, module in MODELS.items()] +
+                [(name, ['microstructure.amico_models']) for name in AMICO_MODELS])
+
+TOP_PACKAGES = 10
+
+
+def parse_importtime(stderr):
+    # Lines of -X importtime: "import time: self [us] | cumulative | package",
+    # nested imports indented by two spaces per level.
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((depth, name.strip(), int(cumulative)))
+    return entries
+
+
+def profile(modules):
+    statement = '; '.join('import ' + module for module in modules)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                             capture_output=True, text=True)
+    if process.returncode != 0:
+        return {'status': 'failed', 'error': process.stderr.strip().splitlines()[-1]}
+
+    # Imports of the interpreter's startup come before those of the statement,
+    # and an import is listed after the imports it triggers: the statement's
+    # imports follow the last startup import at depth 0 before the first
+    # microstructure module.
+    entries = parse_importtime(process.stderr)
+    first = next((i for i, (_, name, _) in enumerate(entries)
+                  if name.partition('.')[0] == 'microstructure'), len(entries))
+    start = max([i + 1 for i, (depth, _, _) in enumerate(entries[:first]) if depth == 0],
+                default=0)
+    entries = entries[start:]
+    packages = {}
+    for depth, name, cumulative in entries:
+        package = name.partition('.')[0]
+        if package == 'microstructure':
+            continue
+        packages[package] = max(packages.get(package, 0), cumulative)
+    top = sorted(packages.items(), key=lambda item: -item[1])[:TOP_PACKAGES]
+    return {
+        'status': 'ok',
+        'total_ms': sum(cumulative for depth, _, cumulative in entries if depth == 0) / 1e3,
+        'modules': len(entries),
+        'packages_ms': {package: cumulative / 1e3 for package, cumulative in top},
+    }
+
+
+def main(commands=None, output=None):
+    commands = list(COMMANDS) if commands is None else commands
+    report = {command: profile(COMMANDS[command]) for command in commands}
+    text = json.dumps(report, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Converted, memory-mapped copies of the input images.
+
+A gzipped NIfTI cannot be memory-mapped, so every run decompresses the whole
+DWI. With the input cache, the DWI is converted once to an uncompressed
+NIfTI in the precision of the fit (and the mask to uint8), named after the
+whole source file name and the dtype, in <subject>/.microstructure/, next to
+the source, and opened with mmap afterwards: repeated runs skip the
+decompression, read only the pages they use, and concurrent jobs on one
+subject share the page cache. Each volume of the converted image is stored
+contiguously, slab after slab, as in any NIfTI.
+
+A converted image is valid while its source keeps its size and mtime, or
+otherwise its SHA-256; it is converted under a lock, so that concurrent jobs
+convert it once, written under a temporary name and renamed into place.
+"""
+
+import json
+import os
+
+import nibabel as nib
+import numpy as np
+from microstructure.arguments import INPUT_CACHE_DIR as CACHE_DIR
+from microstructure.cache import file_hash, locked
+from microstructure.output import open_nifti_memmap, temporary_name
+
+
+def cached_path(filename, dtype):
+    # With the extension, so that dwi.nii and dwi.nii.gz do not share a copy.
+    directory, name = os.path.split(os.path.abspath(filename))
+    return os.path.join(directory, CACHE_DIR, '%s.%s.nii' % (name, np.dtype(dtype).name))
+
+
+def read_meta(path):
+    try:
+        with open(path + '.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_meta(path, meta):
+    tmp = temporary_name(path + '.json')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp, path + '.json')
+
+
+def convert_image(filename, path, dtype):
+    img = nib.load(filename, keep_file_open=True)
+    tmp = temporary_name(path)
+    try:
+        volume = open_nifti_memmap(tmp, img.shape, dtype, img.affine, header=img.header)
+        if np.dtype(dtype) == np.uint8:
+            volume[:] = np.asanyarray(img.dataobj) > 0
+        elif len(img.shape) == 4:
+            # Volume by volume, so that a gzipped source is decompressed in
+            # one forward pass without being held in memory.
+            for k in range(img.shape[3]):
+                volume[..., k] = img.dataobj[..., k]
+        else:
+            volume[:] = img.dataobj
+        volume.flush()
+        del volume
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def convert(filename, dtype=np.float32):
+    path = cached_path(filename, dtype)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with locked(path + '.lock'):
+        meta = read_meta(path)
+        if meta is not None and os.path.exists(path):
+            source = file_hash(filename, meta['source'])
+            if source['sha256'] == meta['source']['sha256']:
+                if source is not meta['source']:
+                    write_meta(path, {'source': source})
+                return path
+        else:
+            source = file_hash(filename)
+        convert_image(filename, path, dtype)
+        write_meta(path, {'source': source})
+    return path
+
+
+def open_image(filename, dtype=np.float32):
+    img = nib.load(convert(filename, dtype), mmap='r')
+    return np.asanyarray(img.dataobj), img.affine
+
+
+def open_dwi(dwiFile, maskFile, dtype=np.float64):
+    dwi_data, dwi_affine = open_image(dwiFile, dtype)
+    mask_data, _ = open_image(maskFile, np.uint8)
+    return dwi_data, mask_data, dwi_affine
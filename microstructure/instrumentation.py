@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing and resource usage of a fit.
+
+A RunLog records, for every stage (loading, gradient table or scheme, model
+construction, fit, derived metrics, writing), the wall time, the CPU time of
+the process and of its finished worker processes, and the peak RSS. It also
+holds counters such as the number of voxels fitted and the solver failures.
+The log is written as a JSON sidecar in the output directory and can be
+appended to a Prometheus node-exporter textfile.
+"""
+
+import json
+import os
+import platform
+import resource
+import time
+from contextlib import contextmanager
+
+SIDECAR = 'microstructure_run.json'
+
+# Destinations of the arguments added by add_arguments().
+OPTIONS = ['prometheus']
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '--prometheus', action="store", dest="prometheus", type=str, default=None,
+        help='Also write the run metrics to this Prometheus textfile (.prom).')
+
+
+def options(args):
+    return {name: getattr(args, name) for name in OPTIONS}
+
+
+def reset_peak_rss():
+    # Linux resets the process high water mark (VmHWM) on writing 5.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on Linux, the peak over the process lifetime.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Peak RSS seen by each stage in progress, outermost first. The process high
+# water mark is reset when a stage starts, so it is folded into the stages
+# already running before that, and nested stages keep their own peak.
+_running_peaks = []
+
+
+def fold_peak_rss():
+    rss = peak_rss()
+    for i, peak in enumerate(_running_peaks):
+        _running_peaks[i] = max(peak, rss)
+
+
+def cpu_times():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + own.ru_stime,
+            children.ru_utime + children.ru_stime,
+            children.ru_maxrss * 1024)
+
+
+class RunLog:
+    """Stages and counters of one model fit on one subject."""
+
+    def __init__(self, **info):
+        self.info = dict(info)
+        self.stages = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def copy(self, **info):
+        log = RunLog(**dict(self.info, **info))
+        log.stages = dict(self.stages)
+        log.counters = dict(self.counters)
+        log.started = self.started
+        return log
+
+    @contextmanager
+    def stage(self, name):
+        fold_peak_rss()
+        reset_peak_rss()
+        _running_peaks.append(peak_rss())
+        wall = time.perf_counter()
+        cpu, children_cpu, children_rss = cpu_times()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            end_cpu, end_children_cpu, end_children_rss = cpu_times()
+            fold_peak_rss()
+            peak = _running_peaks.pop()
+            self.stages[name] = {
+                'wall_seconds': wall,
+                'cpu_seconds': end_cpu - cpu,
+                'workers_cpu_seconds': end_children_cpu - children_cpu,
+                'peak_rss_bytes': peak,
+                'workers_peak_rss_bytes': end_children_rss,
+            }
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        report = dict(self.info)
+        report['started'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started))
+        report['host'] = platform.node()
+        report['stages'] = self.stages
+        report['counters'] = dict(self.counters)
+        report['wall_seconds'] = sum(stage['wall_seconds'] for stage in self.stages.values())
+        report['peak_rss_bytes'] = max([stage['peak_rss_bytes'] for stage in self.stages.values()],
+                                       default=0)
+        if 'voxels' in self.counters and 'fit' in self.stages and self.stages['fit']['wall_seconds'] > 0:
+            report['voxels_per_second'] = self.counters['voxels'] / self.stages['fit']['wall_seconds']
+        return report
+
+    def write(self, outdir):
+        os.makedirs(outdir, exist_ok=True)
+        filename = os.path.join(outdir, SIDECAR)
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(tmp, filename)
+
+
+def prometheus_labels(report):
+    labels = {key: report[key] for key in ['subject', 'model'] if key in report}
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key, value in labels.items())
+
+
+def write_prometheus(filename, logs):
+    # Written under a temporary name and renamed, as the node-exporter
+    # textfile collector requires.
+    lines = []
+    metrics = [
+        ('microstructure_stage_wall_seconds', 'Wall time of a fitting stage.', 'wall_seconds'),
+        ('microstructure_stage_cpu_seconds', 'CPU time of a fitting stage.', 'cpu_seconds'),
+        ('microstructure_stage_peak_rss_bytes', 'Peak RSS during a fitting stage.', 'peak_rss_bytes'),
+    ]
+    reports = [log.report() for log in logs]
+    for metric, description, key in metrics:
+        lines.append('# HELP %s %s' % (metric, description))
+        lines.append('# TYPE %s gauge' % metric)
+        for report in reports:
+            for stage, values in report['stages'].items():
+                lines.append('%s{%s,stage="%s"} %g'
+                             % (metric, prometheus_labels(report), stage, values[key]))
+
+    lines.append('# HELP microstructure_voxels_per_second Voxels fitted per second.')
+    lines.append('# TYPE microstructure_voxels_per_second gauge')
+    for report in reports:
+        if 'voxels_per_second' in report:
+            lines.append('microstructure_voxels_per_second{%s} %g'
+                         % (prometheus_labels(report), report['voxels_per_second']))
+
+    lines.append('# HELP microstructure_count Counters of a fit (voxels, solver failures).')
+    lines.append('# TYPE microstructure_count gauge')
+    for report in reports:
+        for name, value in report['counters'].items():
+            lines.append('microstructure_count{%s,name="%s"} %g'
+                         % (prometheus_labels(report), name, value))
+
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp, filename)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Batched IVIM fit of all masked voxels at once with NumPy array operations.
+
+The signal S(b) = S0 (f exp(-b D*) + (1 - f) exp(-b D)) is fitted in three
+segments, each on whole blocks of voxels:
+
+1. D from a weighted log-linear fit of the high b-values (b >= split_b), where
+   the perfusion compartment has decayed;
+2. D* on a log-spaced grid, with f solved in closed form for every grid value
+   (variable projection), keeping the best grid value of each voxel;
+3. Levenberg-Marquardt steps on (f, D*), D fixed, with a damping factor and a
+   convergence mask per voxel.
+
+S0 is the mean of the b0 volumes. The parameters are kept within the bounds
+of the least squares of Dipy's VarPro fit (IvimModelVP.bounds), and D* is
+searched over the range of its differential evolution. With refine='varpro', every voxel is then refined with
+the variable projection least squares of (D*, D), starting from the batched
+estimate instead of Dipy's differential evolution search.
+
+VarProIvimModel is Dipy's per-voxel VarPro fit, with the perfusion fraction
+of its convex step clipped to the bounds of its least squares step.
+"""
+
+import numpy as np
+from dipy.reconst.ivim import IvimModelVP
+from scipy.optimize import least_squares
+from microstructure.voxels import CHUNK_VOXELS
+
+# Range of D* [mm^2/s] searched by the differential evolution of
+# IvimModelVP.fit.
+D_STAR_RANGE = (0.005, 0.01)
+
+# b-value [s/mm^2] above which the perfusion signal is neglected.
+SPLIT_B = 400
+
+D_STAR_GRID = 64
+MAX_ITER = 50
+TOLERANCE = 1e-6
+
+
+class IvimFit:
+    """IVIM parameters of a batch of voxels, with the attributes of Dipy's IvimFit."""
+
+    def __init__(self, S0, f, D_star, D):
+        self.S0_predicted = S0
+        self.perfusion_fraction = f
+        self.D_star = D_star
+        self.D = D
+
+
+class BatchedIvimModel:
+
+    def __init__(self, gtab, split_b=SPLIT_B, refine=None, max_iter=MAX_ITER, tol=TOLERANCE):
+        self.bvals = np.asarray(gtab.bvals, dtype=float)
+        self.b0s_mask = np.asarray(gtab.b0s_mask)
+        self.high = self.bvals >= split_b
+        if not self.b0s_mask.any():
+            raise ValueError("The batched IVIM fit needs b0 volumes.")
+        if len(np.unique(self.bvals[self.high])) < 2:
+            raise ValueError("The batched IVIM fit needs two b-values >= %g s/mm^2." % split_b)
+        if refine not in (None, 'varpro'):
+            raise ValueError("Unknown IVIM refinement '%s'." % refine)
+        self.refine = refine
+        self.max_iter = max_iter
+        self.tol = tol
+        # Bounds of (f, D*, D) [-, mm^2/s, mm^2/s].
+        self.bounds = np.array(IvimModelVP(gtab).bounds, dtype=float)
+        self.D_star_grid = np.geomspace(*D_STAR_RANGE, D_STAR_GRID)
+
+    def fit(self, data):
+        data = np.asarray(data, dtype=float).reshape(-1, len(self.bvals))
+        params = np.empty((len(data), 4))
+        for start in range(0, len(data), CHUNK_VOXELS):
+            stop = min(start + CHUNK_VOXELS, len(data))
+            params[start:stop] = self.fit_block(data[start:stop])
+        if self.refine == 'varpro':
+            for i in range(len(data)):
+                params[i, 1:] = self.fit_varpro(data[i], params[i, 2:])
+        return IvimFit(*params.T)
+
+    def fit_block(self, data):
+        S0 = data[:, self.b0s_mask].mean(axis=1)
+        valid = S0 > 0
+        y = data / np.where(valid, S0, 1)[:, None]
+
+        D = self.fit_diffusion(y)
+        f, D_star = self.search_perfusion(y, D)
+        f, D_star = self.refine_perfusion(y, D, f, D_star)
+
+        params = np.column_stack([S0, f, D_star, D])
+        params[~valid, 1:] = np.nan
+        return params
+
+    def fit_diffusion(self, y):
+        # log y = log(1 - f) - b D, weighted by y^2 to undo the
+        # noise amplification of the logarithm.
+        b = self.bvals[self.high]
+        signal = np.clip(y[:, self.high], 1e-6, None)
+        X = np.column_stack([np.ones_like(b), -b])
+        w = signal ** 2
+        XtWX = np.einsum('vb,bi,bj->vij', w, X, X) + 1e-12 * np.eye(2)
+        XtWz = np.einsum('vb,bi,vb->vi', w, X, np.log(signal))
+        coef = np.linalg.solve(XtWX, XtWz[..., None])[..., 0]
+        return np.clip(coef[:, 1], self.bounds[0, 2], self.bounds[1, 2])
+
+    def search_perfusion(self, y, D):
+        # For y - exp(-b D) = f (exp(-b D*) - exp(-b D)), the best f of each
+        # D* is (r.u) / (u.u); the sums over b-values are matrix products.
+        b = self.bvals
+        eD = np.exp(-np.outer(D, b))
+        E = np.exp(-np.outer(self.D_star_grid, b))
+        r = y - eD
+        ru = r @ E.T - np.sum(r * eD, axis=1)[:, None]
+        uu = np.sum(E * E, axis=1)[None] - 2 * eD @ E.T + np.sum(eD * eD, axis=1)[:, None]
+        f = np.clip(ru / np.maximum(uu, 1e-12), self.bounds[0, 0], self.bounds[1, 0])
+        cost = np.sum(r * r, axis=1)[:, None] - 2 * f * ru + f ** 2 * uu
+        best = np.argmin(cost, axis=1)
+        rows = np.arange(len(y))
+        return f[rows, best], self.D_star_grid[best]
+
+    def residuals(self, y, eD, f, D_star):
+        eS = np.exp(-D_star[:, None] * self.bvals)
+        return y - (f[:, None] * eS + (1 - f[:, None]) * eD), eS
+
+    def refine_perfusion(self, y, D, f, D_star):
+        b = self.bvals
+        eD = np.exp(-np.outer(D, b))
+        p = np.column_stack([f, D_star])
+        lower, upper = self.bounds[0, :2], self.bounds[1, :2]
+        r, eS = self.residuals(y, eD, p[:, 0], p[:, 1])
+        cost = np.sum(r * r, axis=1)
+        damping = np.full(len(y), 1e-3)
+        active = np.ones(len(y), dtype=bool)
+
+        for _ in range(self.max_iter):
+            v = np.flatnonzero(active)
+            if not len(v):
+                break
+            J = np.stack([eS[v] - eD[v], -p[v, 0, None] * b * eS[v]], axis=-1)
+            JtJ = np.einsum('vbi,vbj->vij', J, J)
+            Jtr = np.einsum('vbi,vb->vi', J, r[v])
+            diagonal = np.einsum('vii->vi', JtJ)
+            A = JtJ + (damping[v, None] * diagonal + 1e-15)[:, :, None] * np.eye(2)
+            step = np.linalg.solve(A, Jtr[..., None])[..., 0]
+            trial = np.clip(p[v] + step, lower, upper)
+
+            trial_r, trial_eS = self.residuals(y[v], eD[v], trial[:, 0], trial[:, 1])
+            trial_cost = np.sum(trial_r * trial_r, axis=1)
+            better = trial_cost < cost[v]
+            accepted = v[better]
+            change = np.abs(trial[better] - p[accepted])
+            p[accepted] = trial[better]
+            r[accepted], eS[accepted], cost[accepted] = trial_r[better], trial_eS[better], trial_cost[better]
+            damping[v] = np.where(better, damping[v] / 10, damping[v] * 10)
+
+            converged = np.zeros(len(v), dtype=bool)
+            converged[better] = np.all(change <= self.tol * (np.abs(p[accepted]) + self.tol), axis=1)
+            converged |= damping[v] > 1e10
+            active[v[converged]] = False
+
+        return p[:, 0], p[:, 1]
+
+    def fit_varpro(self, signal, x0):
+        # Variable projection: for given (D*, D), S0 f and S0 (1 - f) are the
+        # linear least squares coefficients of the two exponentials.
+        if not np.all(np.isfinite(x0)):
+            return np.full(3, np.nan)
+        b = self.bvals
+
+        def linear(x):
+            basis = np.exp(-np.outer(b, x))
+            coef = np.linalg.lstsq(basis, signal, rcond=None)[0]
+            return basis, coef
+
+        def residuals(x):
+            basis, coef = linear(x)
+            return basis @ coef - signal
+
+        result = least_squares(residuals, x0, bounds=(self.bounds[0, 1:], self.bounds[1, 1:]),
+                               xtol=self.tol)
+        _, coef = linear(result.x)
+        total = coef.sum()
+        f = coef[0] / total if total > 0 else np.nan
+        return np.array([np.clip(f, self.bounds[0, 0], self.bounds[1, 0]), result.x[0], result.x[1]])
+
+
+class VarProIvimModel(IvimModelVP):
+
+    def cvx_fit(self, signal, phi):
+        # cvxpy meets the upper bound of f only within its tolerance, and
+        # least_squares rejects a start even slightly out of its bounds.
+        f = super().cvx_fit(signal, phi)
+        f[0] = np.clip(f[0], self.bounds[0][0], self.bounds[1][0])
+        return f
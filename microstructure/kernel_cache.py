@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Shared store of AMICO kernels, reused across subjects on the same protocol.
+
+Kernels only depend on the acquisition scheme and the model parameters, so
+they are generated once per (scheme file, model parameters, kernel options)
+and the AMICO evaluation is pointed at the stored copy. Kernels are
+generated and loaded under the lock of their entry, so concurrent jobs on a
+miss wait for the first one instead of regenerating, and eviction (under the
+same locks) skips entries another job is generating or loading.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import amico
+import numpy as np
+from microstructure.cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, evict, locked, touch
+
+
+def model_params(model):
+    params = []
+    for name, value in sorted(vars(model).items()):
+        if isinstance(value, (bool, int, float, str)):
+            params.append((name, value))
+        elif isinstance(value, (np.ndarray, list, tuple)):
+            params.append((name, np.asarray(value).tolist()))
+    return params
+
+
+def kernel_hash(schemeFile, model, **kwargs):
+    sha = hashlib.sha256()
+    with open(schemeFile, 'rb') as f:
+        sha.update(f.read())
+    sha.update(repr(model_params(model)).encode())
+    sha.update(repr(sorted(kwargs.items())).encode())
+    sha.update(getattr(amico, '__version__', '').encode())
+    return sha.hexdigest()
+
+
+def load_kernels(ae, schemeFile, cache_dir=DEFAULT_CACHE_DIR,
+                 cache_size=DEFAULT_CACHE_SIZE, **kwargs):
+    if cache_dir is None:
+        ae.generate_kernels(regenerate=True, **kwargs)
+        ae.load_kernels()
+        return
+
+    directory = os.path.join(cache_dir, 'kernels')
+    os.makedirs(directory, exist_ok=True)
+    entry = os.path.join(directory, ae.model.id + '-' + kernel_hash(schemeFile, ae.model, **kwargs))
+
+    with locked(entry + '.lock'):
+        if not os.path.isdir(entry):
+            tmp = tempfile.mkdtemp(dir=directory, prefix='.tmp-')
+            try:
+                ae.set_config('ATOMS_path', tmp)
+                ae.generate_kernels(regenerate=True, **kwargs)
+                os.rename(tmp, entry)
+            except BaseException:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+
+        # The kernels are found in place, this only records lmax/ndirs for
+        # load_kernels().
+        ae.set_config('ATOMS_path', entry)
+        ae.generate_kernels(regenerate=False, **kwargs)
+        ae.load_kernels()
+        touch(entry)
+        evict(directory, cache_size, keep=entry, lock=True)
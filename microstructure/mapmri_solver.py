@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Positivity-constrained MAP-MRI solved on a working set of constraints.
+
+Dipy's MapmriModel builds and canonicalizes a cvxpy problem for every voxel
+of the locally constrained variants (CMAP, CMAPL), with one positivity
+constraint per point of the constraint grid (hundreds), of which only a few
+are active at the solution. QpMapmriModel fits them as Dipy does, but solves
+
+    min ||M c - y||^2 + lopt c' Lap c    s.t.    m0 c = 1,  K c >= -0.1
+
+directly with Clarabel or OSQP on a working set of the constraints: the QP
+is solved with the rows of K in the working set only, the grid rows its
+solution violates are added, and so on until none is violated, which is
+then the solution of the whole QP. A voxel starts from the rows active in
+the previous voxel, a neighbour along the fastest axis of the mask, so that
+most voxels take one or two small solves; OSQP also starts from the
+solution (not the multipliers) of the previous voxel. Each solve sets the
+solver up anew: M and K change with the scaling of every voxel, and the
+rows with the working set, so there is no factorization to keep from one
+solve to the next. cvxpy is still needed, since MapmriModel imports it and
+checks the solver against cvxpy.installed_solvers() for any positivity
+constraint. A QP the solver fails on, e.g. too badly conditioned at radial
+order 8 without regularization (isoCMAP), is solved again with the
+residuals M c - y as variables, as cvxpy poses Dipy's problem.
+
+The globally constrained variants (MAP+) are semidefinite programs, which
+Dipy already builds once (PositiveDefiniteLeastSquares); they stay with Dipy.
+"""
+
+import numpy as np
+import scipy.sparse
+from dipy.reconst import mapmri
+from dipy.reconst.multi_voxel import multi_voxel_fit
+from microstructure.models.mapmri import QP_SOLVERS
+
+# Lower bound of the propagator on the constraint grid, as in Dipy.
+POSITIVITY_BOUND = -0.1
+
+# Violation of a (unit norm) constraint row accepted as satisfied, the most
+# violated rows added to the working set per solve, and the solves per voxel.
+TOLERANCE = 1e-7
+ROWS_PER_SOLVE = 16
+MAX_SOLVES = 50
+
+
+class SolverError(Exception):
+    pass
+
+
+def solve_clarabel(P, q, A, b, n_equalities, x0=None):
+    # min x'Px/2 + q'x  s.t.  A[:n_equalities] x = b[:n_equalities],
+    # A[n_equalities:] x <= b[n_equalities:].
+    import clarabel
+
+    settings = clarabel.DefaultSettings()
+    settings.verbose = False
+    settings.tol_gap_abs = settings.tol_gap_rel = settings.tol_feas = 1e-10
+    cones = [clarabel.ZeroConeT(n_equalities), clarabel.NonnegativeConeT(len(b) - n_equalities)]
+    solution = clarabel.DefaultSolver(scipy.sparse.triu(P, format='csc'), q,
+                                      scipy.sparse.csc_matrix(A), b, cones, settings).solve()
+    if solution.status != clarabel.SolverStatus.Solved:
+        raise SolverError("The MAP-MRI QP is %s." % solution.status)
+    return np.asarray(solution.x)
+
+
+def solve_osqp(P, q, A, b, n_equalities, x0=None):
+    import osqp
+
+    lower = np.r_[b[:n_equalities], np.full(len(b) - n_equalities, -np.inf)]
+    solver = osqp.OSQP()
+    solver.setup(scipy.sparse.triu(P, format='csc'), q, scipy.sparse.csc_matrix(A), lower, b,
+                 verbose=False, eps_abs=1e-9, eps_rel=1e-9, max_iter=100000, polish=True)
+    if x0 is not None:
+        solver.warm_start(x=x0)
+    result = solver.solve()
+    if result.info.status != 'solved':
+        raise SolverError("The MAP-MRI QP is %s." % result.info.status)
+    return result.x
+
+
+class PositivityQP:
+    """The constrained least squares of the voxels, fitted one after the other."""
+
+    def __init__(self, solver='CLARABEL'):
+        if solver not in QP_SOLVERS:
+            raise ValueError("The MAP-MRI QP is solved with %s, not %s."
+                             % (' or '.join(QP_SOLVERS), solver))
+        self.solver = solver
+        self.active = np.zeros(0, dtype=int)
+        self.x = None
+
+    def solve_working_set(self, P, q, E, e, K, bound, rows):
+        solve = solve_clarabel if self.solver == 'CLARABEL' else solve_osqp
+        # K c >= bound as -K c <= -bound, c the first columns of x.
+        inequalities = np.zeros((len(rows), E.shape[1]))
+        inequalities[:, :K.shape[1]] = -K[rows]
+        A = np.vstack([E, inequalities])
+        return solve(P, q, A, np.r_[e, -bound[rows]], len(e), x0=self.x)
+
+    def solve_from(self, P, q, E, e, K, bound, rows):
+        for _ in range(MAX_SOLVES):
+            x = self.solve_working_set(P, q, E, e, K, bound, rows)
+            slack = np.dot(K, x[:K.shape[1]]) - bound
+            violated = np.flatnonzero(slack < -TOLERANCE)
+            if not violated.size:
+                return x, rows[slack[rows] < TOLERANCE]
+            violated = violated[np.argsort(slack[violated])[:ROWS_PER_SOLVE]]
+            rows = np.union1d(rows, violated)
+        raise SolverError("The working set of the MAP-MRI QP did not converge.")
+
+    def problem(self, M, y, laplacian, m0, residuals=False):
+        # min x'Px/2 + q'x  s.t.  E x = e, with x = c, or with residuals
+        # x = (c, r), r = M c - y, and min r'r + c' laplacian c, as cvxpy
+        # canonicalizes Dipy's problem: a larger QP, but far better
+        # conditioned than M'M, e.g. at radial order 8 without regularization.
+        n_dwis, n_coef = M.shape
+        if not residuals:
+            return 2 * (np.dot(M.T, M) + laplacian), -2 * np.dot(M.T, y), m0[None], np.ones(1)
+        P = scipy.sparse.block_diag([2 * laplacian, 2 * scipy.sparse.eye(n_dwis)], format='csc')
+        E = np.block([[m0[None], np.zeros((1, n_dwis))],
+                      [M, -np.eye(n_dwis)]])
+        return P, np.zeros(n_coef + n_dwis), E, np.r_[1., y]
+
+    def solve(self, M, y, laplacian, m0, K):
+        # Rows of unit norm, so that the tolerance is in units of c.
+        norms = np.linalg.norm(K, axis=1)
+        norms[norms == 0] = 1
+        K = K / norms[:, None]
+        bound = POSITIVITY_BOUND / norms
+
+        # From the rows active in the previous voxel, else from none: nearly
+        # parallel rows of neighbouring grid points taken over from the
+        # previous voxel can leave the QP degenerate; else with residuals.
+        empty = np.zeros(0, dtype=int)
+        for residuals, rows in [(False, self.active[self.active < len(K)]),
+                                (False, empty), (True, empty)]:
+            P, q, E, e = self.problem(M, y, laplacian, m0, residuals)
+            if self.x is not None and len(self.x) != len(q):
+                self.x = None
+            try:
+                self.x, self.active = self.solve_from(P, q, E, e, K, bound, rows)
+                return self.x[:M.shape[1]]
+            except SolverError:
+                self.x = None
+        raise SolverError("The MAP-MRI QP has no solution.")
+
+
+class QpMapmriModel(mapmri.MapmriModel):
+
+    def __init__(self, gtab, **kwargs):
+        super().__init__(gtab, **kwargs)
+        if not self.positivity_constraint or self.global_constraints:
+            raise ValueError("The MAP-MRI QP needs positivity_constraint=True "
+                             "and global_constraints=False.")
+        self.qp = PositivityQP(self.cvxpy_solver)
+
+    def __getstate__(self):
+        # The working set is only a starting point for the next voxel.
+        return dict(self.__dict__, qp=PositivityQP(self.cvxpy_solver))
+
+    @multi_voxel_fit
+    def fit(self, data):
+        # MapmriModel.fit, with the constrained problem solved by the QP.
+        errorcode = 0
+        tenfit = self.tenmodel.fit(data[self.cutoff])
+        evals = tenfit.evals
+        R = tenfit.evecs
+        evals = np.clip(evals, self.eigenvalue_threshold, evals.max())
+        qvals = np.sqrt(self.gtab.bvals / self.tau) / (2 * np.pi)
+        mu_max = max(np.sqrt(evals * 2 * self.tau))
+        if self.anisotropic_scaling:
+            mu = np.sqrt(evals * 2 * self.tau)
+            q = np.dot(self.gtab.bvecs, R) * qvals[:, None]
+            M = mapmri.mapmri_phi_matrix(self.radial_order, mu, q)
+        elif hasattr(self, 'M'):
+            M, mu = self.M, self.mu
+        else:
+            u0 = mapmri.isotropic_scale_factor(evals * 2 * self.tau)
+            mu = np.array([u0, u0, u0])
+            M = mapmri.mapmri_isotropic_M_mu_dependent(
+                self.radial_order, mu[0], qvals) * self.M_mu_independent
+
+        if self.laplacian_regularization:
+            if self.anisotropic_scaling:
+                laplacian_matrix = mapmri.mapmri_laplacian_reg_matrix(
+                    self.ind_mat, mu, self.S_mat, self.T_mat, self.U_mat)
+            else:
+                laplacian_matrix = self.laplacian_matrix * mu[0]
+            if (isinstance(self.laplacian_weighting, str) and
+                    self.laplacian_weighting.upper() == 'GCV'):
+                try:
+                    lopt = mapmri.generalized_crossvalidation(data, M, laplacian_matrix)
+                except np.linalg.LinAlgError:
+                    lopt = 0.05
+                    errorcode = 1
+            elif np.isscalar(self.laplacian_weighting):
+                lopt = self.laplacian_weighting
+            else:
+                lopt = mapmri.generalized_crossvalidation_array(
+                    data, M, laplacian_matrix, self.laplacian_weighting)
+        else:
+            lopt = 0.
+            laplacian_matrix = np.zeros((M.shape[1], M.shape[1]))
+
+        if self.pos_radius == 'adaptive':
+            constraint_grid = mapmri.create_rspace(self.pos_grid, np.sqrt(5) * mu_max)
+        else:
+            constraint_grid = self.constraint_grid
+        if self.anisotropic_scaling:
+            K = mapmri.mapmri_psi_matrix(self.radial_order, mu, constraint_grid)
+        elif self.pos_radius == 'adaptive':
+            K = mapmri.mapmri_isotropic_psi_matrix(self.radial_order, mu[0], constraint_grid)
+        else:
+            K = mapmri.mapmri_isotropic_K_mu_dependent(
+                self.radial_order, mu[0], constraint_grid) * self.pos_K_independent
+
+        data_norm = np.asarray(data / data[self.gtab.b0s_mask].mean())
+        try:
+            coef = self.qp.solve(M, data_norm, lopt * laplacian_matrix,
+                                 M[self.gtab.b0s_mask][0], K)
+        except Exception:
+            errorcode = 2
+            try:
+                coef = np.dot(np.linalg.pinv(M), data_norm)
+            except np.linalg.LinAlgError:
+                coef = np.zeros(M.shape[1])
+                return mapmri.MapmriFit(self, coef, mu, R, lopt, 3)
+
+        coef = coef / sum(coef * self.Bm)
+        return mapmri.MapmriFit(self, coef, mu, R, lopt, errorcode)
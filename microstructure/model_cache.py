@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of built Dipy models, keyed by acquisition.
+
+MapmriModel and QtdmriModel precompute their basis index matrices, Laplacian
+regularization matrices and positivity-constraint grids when they are built,
+and these only depend on the acquisition and the model variant. A model
+module opts in by defining ``cache_key(**options)``; its built model is then
+stored once per acquisition, with the array attributes as .npy files that
+later runs memory-map instead of recomputing. A process also keeps the last
+models it loaded, while their entries are in the cache.
+"""
+
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import dipy
+import numpy as np
+from microstructure.cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, evict, touch
+
+# Models loaded by this process, kept in memory for the next fits on the same
+# acquisition (e.g. the jobs of a daemon worker), most recently used last.
+RESIDENT_MODELS = 8
+_resident = OrderedDict()
+
+
+def acquisition_hash(gtab, *key):
+    sha = hashlib.sha256()
+    sha.update(repr(key).encode())
+    sha.update(dipy.__version__.encode())
+    for value in (gtab.bvals, gtab.bvecs, gtab.big_delta, gtab.small_delta):
+        if value is None:
+            sha.update(b'None')
+        else:
+            value = np.ascontiguousarray(value, dtype=np.float64)
+            sha.update(repr(value.shape).encode())
+            sha.update(value.tobytes())
+    sha.update(repr(gtab.b0_threshold).encode())
+    return sha.hexdigest()
+
+
+def store(entry, model):
+    arrays = {name: value for name, value in vars(model).items()
+              if isinstance(value, np.ndarray)}
+    rest = object.__new__(type(model))
+    rest.__dict__.update({name: value for name, value in vars(model).items()
+                          if name not in arrays})
+
+    directory = os.path.dirname(entry)
+    os.makedirs(directory, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=directory, prefix='.tmp-')
+    try:
+        for name, value in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), value, allow_pickle=False)
+        with open(os.path.join(tmp, 'model.pkl'), 'wb') as f:
+            pickle.dump(rest, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # Another job stored the same entry in the meantime.
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def load(entry):
+    with open(os.path.join(entry, 'model.pkl'), 'rb') as f:
+        model = pickle.load(f)
+    for name in os.listdir(entry):
+        if name.endswith('.npy'):
+            setattr(model, name[:-4], np.load(os.path.join(entry, name), mmap_mode='r'))
+    touch(entry)
+    return model
+
+
+def resident(entry, model):
+    _resident[entry] = model
+    _resident.move_to_end(entry)
+    while len(_resident) > RESIDENT_MODELS:
+        _resident.popitem(last=False)
+    return model
+
+
+def build_model(module, gtab, cache_dir=DEFAULT_CACHE_DIR,
+                cache_size=DEFAULT_CACHE_SIZE, **options):
+    if cache_dir is None or not hasattr(module, 'cache_key'):
+        return module.build_model(gtab, **options)
+
+    directory = os.path.join(cache_dir, 'models')
+    entry = os.path.join(directory, module.__name__ + '-' +
+                         acquisition_hash(gtab, *module.cache_key(**options)))
+    if entry in _resident and os.path.isdir(entry):
+        touch(entry)
+        return resident(entry, _resident[entry])
+    if os.path.isdir(entry):
+        try:
+            return resident(entry, load(entry))
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            shutil.rmtree(entry, ignore_errors=True)
+
+    model = module.build_model(gtab, **options)
+    try:
+        store(entry, model)
+    except (OSError, pickle.PicklingError, TypeError, AttributeError):
+        return model
+    evict(directory, cache_size, keep=entry)
+    return resident(entry, model)
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the Dipy models that can be fitted on a loaded subject.
+
+Each model module provides:
+    GRADIENTS     -- 'bvals' (bval/bvec files) or 'scheme' (qt-dMRI scheme file)
+    output_dir    -- output directory of the model inside the subject directory
+    build_model   -- the Dipy model for a gradient table
+    fit           -- the fitted parameter maps of a (n_voxels, n_dwis) array of
+                     masked voxels, as an ordered dict name -> (n_voxels, ...) array;
+                     a name may contain a subdirectory of the output directory
+    check_options -- (optional) raises ValueError on invalid options, before any
+                     data is loaded
+    prepare       -- (optional) options estimated from all masked voxels before
+                     the fit, given a function that fits a subset of them; returns
+                     (options, report), the report is kept in the run log
+    finalize      -- (optional) maps derived from all fitted voxels at once
+    cache_key     -- (optional) the options the built model depends on, besides
+                     the acquisition, to cache it with microstructure.model_cache
+"""
+
+import importlib
+import os
+
+MODELS = {
+    'dki': 'microstructure.models.dki',
+    'fwdti': 'microstructure.models.fwdti',
+    'ivim': 'microstructure.models.ivim',
+    'msdki': 'microstructure.models.msdki',
+    'wmti': 'microstructure.models.wmti',
+    'mapmri': 'microstructure.models.mapmri',
+    'qtdmri': 'microstructure.models.qtdmri',
+}
+
+# Models fitted by AMICO from the subject's files, see microstructure.amico_models.
+AMICO_MODELS = ['noddi', 'sandi']
+
+
+def amico_output_dir(subjectDirectory, name):
+    return os.path.join(subjectDirectory, 'AMICO', name.upper())
+
+
+def get_model(name):
+    if name not in MODELS:
+        raise ValueError("Unknown model '%s', choose from: %s."
+                         % (name, ', '.join(MODELS)))
+    return importlib.import_module(MODELS[name])
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+DKI family (DTI/DKI scalars and WMTI from one kurtosis fit, and MSDKI) with Dipy.
+
+The DKI fit is done once and the WMTI maps are derived from its parameters as
+in KurtosisMicrostructureModel.fit. MSDKI is still a separate fit, on the
+same loaded voxels: its mean signal diffusivity and kurtosis are fitted to
+the signal averaged over the directions of each shell, which the DKI
+parameters do not give, with a linear WLS that takes under 1% of the time of
+the DKI maps. The
+properties of the fits are memoized, so that e.g. the hindered eigenvalues or
+the MSDKI water fraction are computed once rather than on every access by the
+properties that depend on them. The DTI/DKI scalars are written to DKI/, the
+WMTI and MSDKI maps to DKI/WMTI/ and DKI/MSDKI/, with the names of the wmti
+and msdki models.
+"""
+
+import functools
+import os
+import dipy.reconst.dki as dki
+import dipy.reconst.dki_micro as dki_micro
+import dipy.reconst.msdki as msdki
+import numpy as np
+from microstructure.models import msdki as msdki_maps
+from microstructure.models import wmti as wmti_maps
+
+GRADIENTS = 'bvals'
+
+
+def output_dir(subjectDirectory, **kwargs):
+    return os.path.join(subjectDirectory, 'DKI')
+
+
+def build_model(gtab, **kwargs):
+    return dki_micro.KurtosisMicrostructureModel(gtab), msdki.MeanDiffusionKurtosisModel(gtab)
+
+
+def memoize(fit):
+    # Turns the properties of the fit's class into cached properties of a
+    # subclass, so that they are computed at most once for this fit.
+    cls = type(fit)
+    properties = {}
+    for base in reversed(cls.__mro__):
+        for name, value in vars(base).items():
+            if isinstance(value, property):
+                properties[name] = functools.cached_property(value.fget)
+            elif name in properties:
+                del properties[name]
+    fit.__class__ = type('Memoized' + cls.__name__, (cls,), properties)
+    return fit
+
+
+def fit(models, data, **kwargs):
+    micro_model, msdki_model = models
+    dki_params = dki.DiffusionKurtosisModel.fit(micro_model, data).model_params
+    awf = dki_micro.axonal_water_fraction(dki_params)
+    hindered, restricted = dki_micro.diffusion_components(dki_params, awf=awf)
+    params = np.concatenate((dki_params, np.array([awf]).T, hindered, restricted), axis=-1)
+    micro_fit = memoize(dki_micro.KurtosisMicrostructuralFit(micro_model, params))
+    # A fit of its own, on the powder-averaged signal.
+    msdki_fit = memoize(msdki_model.fit(data))
+
+    maps = {
+        'FA': micro_fit.fa,
+        'MD': micro_fit.md,
+        'AD': micro_fit.ad,
+        'RD': micro_fit.rd,
+        'MK': micro_fit.mk(),
+        'AK': micro_fit.ak(),
+        'RK': micro_fit.rk(),
+        'MKT': micro_fit.mkt(),
+        'KFA': micro_fit.kfa,
+    }
+    for name, values in wmti_maps.maps(micro_fit).items():
+        maps[os.path.join('WMTI', name)] = values
+    for name, values in msdki_maps.maps(msdki_fit).items():
+        maps[os.path.join('MSDKI', name)] = values
+    return maps
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Free-water DTI (FWDTI) with Dipy.
+
+engine='dipy' is Dipy's per-voxel NLS fit; 'batched' fits all voxels at once
+with microstructure.fwdti_solver, which warm_start seeds from the
+neighbouring voxels.
+"""
+
+import os
+import dipy.reconst.fwdti as fwdti
+from microstructure.fwdti_solver import BatchedFreeWaterTensorModel
+
+GRADIENTS = 'bvals'
+
+ENGINES = ['dipy', 'batched']
+
+
+def check_options(fwdti_engine='dipy', warm_start=False, **kwargs):
+    if fwdti_engine not in ENGINES:
+        raise ValueError("Unknown FWDTI engine '%s', choose from: %s."
+                         % (fwdti_engine, ', '.join(ENGINES)))
+    if warm_start and fwdti_engine != 'batched':
+        raise ValueError("warm_start needs the batched FWDTI engine.")
+
+
+def output_dir(subjectDirectory, **kwargs):
+    return os.path.join(subjectDirectory, 'FWDTI')
+
+
+def build_model(gtab, fwdti_engine='dipy', warm_start=False, **kwargs):
+    if fwdti_engine == 'batched':
+        return BatchedFreeWaterTensorModel(gtab, warm_start=warm_start)
+    return fwdti.FreeWaterTensorModel(gtab)
+
+
+def fit(fwdtimodel, data, return_iterations=False, **kwargs):
+    fwdtifit = fwdtimodel.fit(data)
+
+    maps = {
+        'FA': fwdtifit.fa,
+        'MD': fwdtifit.md,
+        'FW': fwdtifit.f,
+        'RD': fwdtifit.rd,
+        'AD': fwdtifit.ad,
+    }
+    if return_iterations:
+        # Solver iterations per voxel of the batched engine, as compared by
+        # ``python -m microstructure bench --warm-start``.
+        maps['ITERATIONS'] = fwdtifit.iterations
+    return maps
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Intravoxel incoherent motion (IVIM) with Dipy.
+
+engine='varpro' is Dipy's per-voxel VarPro fit, with the start of its least
+squares kept within bounds; 'batched' fits all voxels at once with
+microstructure.ivim_solver, and 'batched-varpro' refines every voxel of the
+batched fit with variable projection least squares, without Dipy's
+differential evolution search.
+"""
+
+import os
+from microstructure.ivim_solver import BatchedIvimModel, VarProIvimModel
+
+GRADIENTS = 'bvals'
+
+ENGINES = ['varpro', 'batched', 'batched-varpro']
+
+
+def check_options(ivim_engine='varpro', **kwargs):
+    if ivim_engine not in ENGINES:
+        raise ValueError("Unknown IVIM engine '%s', choose from: %s."
+                         % (ivim_engine, ', '.join(ENGINES)))
+
+
+def output_dir(subjectDirectory, **kwargs):
+    return os.path.join(subjectDirectory, 'IVIM')
+
+
+def build_model(gtab, ivim_engine='varpro', **kwargs):
+    if ivim_engine == 'batched':
+        return BatchedIvimModel(gtab)
+    if ivim_engine == 'batched-varpro':
+        return BatchedIvimModel(gtab, refine='varpro')
+    return VarProIvimModel(gtab)
+
+
+def fit(ivimmodel, data, **kwargs):
+    ivimfit = ivimmodel.fit(data)
+
+    return {
+        'Perfusion': ivimfit.perfusion_fraction,
+        'D_star': ivimfit.D_star,
+        'D': ivimfit.D,
+    }
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Mean apparent propagator MRI (MAP-MRI) with Dipy.
+
+mapmri_engine='dipy' is Dipy's fit; 'qp' fits the locally constrained
+variants (CMAP, CMAPL) on a working set of their positivity constraints,
+warm-started from the previous voxel (microstructure.mapmri_solver).
+cvxpy_solver picks the solver of the constrained variants: a cvxpy solver,
+e.g. MOSEK or CLARABEL, with Dipy, CLARABEL or OSQP with the qp engine.
+"""
+
+import os
+import numpy as np
+from dipy.reconst import mapmri
+from dipy.data import get_sphere
+from microstructure.voxels import ChunkedMap
+
+GRADIENTS = 'bvals'
+
+VARIANTS = ['anisoMAPL', 'anisoCMAP', 'anisoCMAPL', 'anisoMAP+',
+            'isoMAPL', 'isoCMAP', 'isoCMAPL', 'isoMAP+']
+
+ENGINES = ['dipy', 'qp']
+
+# Solvers of the qp engine, called directly rather than through cvxpy (which
+# Dipy's MapmriModel still imports for the constrained variants).
+QP_SOLVERS = ['CLARABEL', 'OSQP']
+
+# Variants whose positivity constraint is a QP; the MAP+ variants constrain
+# the propagator globally with a semidefinite program.
+QP_VARIANTS = ['anisoCMAP', 'anisoCMAPL', 'isoCMAP', 'isoCMAPL']
+SDP_VARIANTS = ['anisoMAP+', 'isoMAP+']
+
+# Displacement [mm] at which the propagator is sampled on the sphere.
+PDF_RADIUS = 0.015
+
+METRICS = ['MSD', 'QIV', 'RTOP', 'RTAP', 'RTPP', 'NG', 'NGper', 'NGpar', 'ODF',
+           'RTOP_cortex_norm', 'RTAP_cortex_norm', 'RTPP_cortex_norm',
+           'PDF', 'NOLS', 'ISF', 'SH', 'COEF']
+
+
+# Maps Dipy only defines with anisotropic scaling (NG) or only with
+# isotropic scaling (SH).
+ANISOTROPIC_METRICS = ['NG', 'NGper', 'NGpar']
+ISOTROPIC_METRICS = ['SH']
+
+# Dipy only applies the global constraints with anisotropic scaling.
+UNAVAILABLE_VARIANTS = ['isoMAP+']
+
+
+def variant_metrics(model="anisoMAPL"):
+    # The maps the variant can compute, the default selection.
+    excluded = ISOTROPIC_METRICS if model.startswith('aniso') else ANISOTROPIC_METRICS
+    return [name for name in METRICS if name not in excluded]
+
+
+def selected_metrics(metrics=None, model="anisoMAPL"):
+    if metrics is None:
+        return variant_metrics(model)
+    if isinstance(metrics, str):
+        metrics = [name.strip() for name in metrics.split(',') if name.strip()]
+    unknown = [name for name in metrics if name not in METRICS]
+    if unknown:
+        raise ValueError("Unknown MAP-MRI metrics %s, choose from: %s."
+                         % (', '.join(unknown), ', '.join(METRICS)))
+    unavailable = [name for name in metrics if name not in variant_metrics(model)]
+    if unavailable:
+        raise ValueError("MAP-MRI %s cannot compute %s, choose from: %s."
+                         % (model, ', '.join(unavailable), ', '.join(variant_metrics(model))))
+    return [name for name in METRICS if name in metrics]
+
+
+def fitted_metrics(metrics=None, model="anisoMAPL"):
+    # The cortex-normalized maps are derived from RTOP/RTAP/RTPP in finalize().
+    selected = selected_metrics(metrics, model)
+    fitted = []
+    for name in selected:
+        if name.endswith('_cortex_norm'):
+            name = name[:-len('_cortex_norm')]
+        if name not in fitted:
+            fitted.append(name)
+    return fitted
+
+
+def check_options(metrics=None, model="anisoMAPL", mapmri_engine='dipy', cvxpy_solver='MOSEK',
+                  **kwargs):
+    if model not in VARIANTS:
+        raise ValueError("Unknown MAP-MRI model '%s', choose from: %s."
+                         % (model, ', '.join(VARIANTS)))
+    if model in UNAVAILABLE_VARIANTS:
+        raise ValueError("MAP-MRI %s is not available: Dipy only applies the global "
+                         "constraints with anisotropic scaling, use anisoMAP+." % model)
+    selected_metrics(metrics, model)
+    if mapmri_engine not in ENGINES:
+        raise ValueError("Unknown MAP-MRI engine '%s', choose from: %s."
+                         % (mapmri_engine, ', '.join(ENGINES)))
+    if mapmri_engine == 'qp' and model not in QP_VARIANTS:
+        raise ValueError("The qp MAP-MRI engine fits the variants: %s."
+                         % ', '.join(QP_VARIANTS))
+    if mapmri_engine == 'qp' and cvxpy_solver not in QP_SOLVERS:
+        raise ValueError("The qp MAP-MRI engine solves with %s, not %s."
+                         % (' or '.join(QP_SOLVERS), cvxpy_solver))
+    if cvxpy_solver == 'OSQP' and model in SDP_VARIANTS:
+        raise ValueError("OSQP only solves QPs, %s needs a semidefinite solver, e.g. CLARABEL."
+                         % model)
+
+
+def output_dir(subjectDirectory, model="anisoMAPL", **kwargs):
+    return os.path.join(subjectDirectory, model)
+
+
+def cache_key(model="anisoMAPL", cvxpy_solver='MOSEK', mapmri_engine='dipy', **kwargs):
+    return (model, cvxpy_solver, mapmri_engine)
+
+
+def build_model(gtab, model="anisoMAPL", cvxpy_solver='MOSEK', mapmri_engine='dipy', **kwargs):
+    if mapmri_engine == 'qp':
+        # Imported here: Clarabel and OSQP are only needed by this engine.
+        from microstructure.mapmri_solver import QpMapmriModel
+        model_class = QpMapmriModel
+    else:
+        model_class = mapmri.MapmriModel
+
+    match model:
+        case "anisoMAPL":
+            radial_order = 6
+            map_model = model_class(gtab, radial_order=radial_order,
+                                     laplacian_regularization=True,
+                                     laplacian_weighting="GCV",
+                                     cvxpy_solver=cvxpy_solver)
+
+        case "anisoCMAP":
+            radial_order = 6
+            map_model = model_class(gtab,
+                                     radial_order=radial_order,
+                                     laplacian_regularization=False,
+                                     positivity_constraint=True,
+                                     cvxpy_solver=cvxpy_solver)
+
+        case "anisoCMAPL":
+            radial_order = 6
+            map_model = model_class(gtab, radial_order=radial_order,
+                                     laplacian_regularization=True,
+                                     laplacian_weighting="GCV",
+                                     positivity_constraint=True,
+                                     cvxpy_solver=cvxpy_solver)
+
+        case "anisoMAP+":
+            radial_order = 6
+            map_model = model_class(gtab,
+                                     radial_order=radial_order,
+                                     laplacian_regularization=False,
+                                     positivity_constraint=True,
+                                     global_constraints=True,
+                                     cvxpy_solver=cvxpy_solver)
+
+        case "isoMAPL":
+            radial_order = 8
+            map_model = model_class(gtab, radial_order=radial_order,
+                                     laplacian_regularization=True,
+                                     laplacian_weighting="GCV",
+                                     anisotropic_scaling=False,
+                                     cvxpy_solver=cvxpy_solver)
+
+        case "isoCMAP":
+            radial_order = 8
+            map_model = model_class(gtab,
+                                     radial_order=radial_order,
+                                     laplacian_regularization=False,
+                                     positivity_constraint=True,
+                                     anisotropic_scaling=False,
+                                     cvxpy_solver=cvxpy_solver)
+
+        case "isoCMAPL":
+            radial_order = 8
+            map_model = model_class(gtab, radial_order=radial_order,
+                                     laplacian_regularization=True,
+                                     laplacian_weighting="GCV",
+                                     positivity_constraint=True,
+                                     anisotropic_scaling=False,
+                                     cvxpy_solver=cvxpy_solver)
+
+        case "isoMAP+":
+            radial_order = 8
+            map_model = model_class(gtab,
+                                     radial_order=radial_order,
+                                     laplacian_regularization=False,
+                                     positivity_constraint=True,
+                                     global_constraints=True,
+                                     anisotropic_scaling=False,
+                                     cvxpy_solver=cvxpy_solver)
+
+        case _:
+            raise ValueError("Unknown MAP-MRI model '%s', choose from: %s."
+                             % (model, ', '.join(VARIANTS)))
+
+    return map_model
+
+
+def fit(map_model, data, metrics=None, model="anisoMAPL", **kwargs):
+    mapfit = map_model.fit(data)
+    sphere = get_sphere('repulsion724')
+
+    # Only the requested metrics are evaluated from the fitted coefficients;
+    # the large (n_voxels, 724) ODF and PDF are evaluated in float32 chunks
+    # while they are written.
+    accessors = {
+        'MSD': lambda: mapfit.msd(),
+        'QIV': lambda: mapfit.qiv(),
+        'RTOP': lambda: mapfit.rtop(),
+        'RTAP': lambda: mapfit.rtap(),
+        'RTPP': lambda: mapfit.rtpp(),
+        'NG': lambda: mapfit.ng(),
+        'NGper': lambda: mapfit.ng_perpendicular(),
+        'NGpar': lambda: mapfit.ng_parallel(),
+        'ODF': lambda: ChunkedMap(
+            len(data), (len(sphere.vertices),),
+            lambda start, stop: mapfit[start:stop].odf(sphere, s=2)),
+        'PDF': lambda: ChunkedMap(
+            len(data), (len(sphere.vertices),),
+            lambda start, stop: mapfit[start:stop].pdf(sphere.vertices * PDF_RADIUS)),
+        'NOLS': lambda: mapfit.norm_of_laplacian_signal(),
+        'ISF': lambda: mapfit.mapmri_mu,
+        'SH': lambda: mapfit.odf_sh(s=2),
+        'COEF': lambda: mapfit.mapmri_coeff,
+    }
+
+    return {name: accessors[name]() for name in fitted_metrics(metrics, model)}
+
+
+def finalize(maps, metrics=None, model="anisoMAPL", **kwargs):
+    # Normalized by the mean over the whole mask, so this runs once all
+    # voxels are fitted.
+    selected = selected_metrics(metrics, model)
+    for name in ['RTOP', 'RTAP', 'RTPP']:
+        if name + '_cortex_norm' in selected:
+            # Averaged in float64, so that float32 maps stay float32.
+            maps[name + '_cortex_norm'] = maps[name] / float(maps[name].mean(dtype=np.float64))
+        if name not in selected:
+            maps.pop(name, None)
+    return maps
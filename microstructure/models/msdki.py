@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Mean signal diffusion kurtosis imaging (MSDKI) with Dipy.
+"""
+
+import os
+import dipy.reconst.msdki as msdki
+
+GRADIENTS = 'bvals'
+
+
+def output_dir(subjectDirectory, **kwargs):
+    return os.path.join(subjectDirectory, 'MSDKI')
+
+
+def build_model(gtab, **kwargs):
+    return msdki.MeanDiffusionKurtosisModel(gtab)
+
+
+def fit(msdki_model, data, **kwargs):
+    return maps(msdki_model.fit(data))
+
+
+def maps(msdki_fit):
+    return {
+        'MSD': msdki_fit.msd,
+        'MSK': msdki_fit.msk,
+        'F': msdki_fit.smt2f,
+        'DI': msdki_fit.smt2di,
+        'uFA': msdki_fit.smt2uFA,
+    }
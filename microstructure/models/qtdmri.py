@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Spatio-temporal diffusion MRI (qt-dMRI) with Dipy.
+
+By default the Laplacian weight (GCV) and the L1 weight (cross-validation)
+are searched in every voxel, as in fit_QTDMRI.py. With weighting='global' or
+'strata', prepare() searches them on a subsample of voxels stratified by
+tensor FA and MD, and every voxel is then fitted with the fixed weights of its
+FA/MD stratum (one stratum for 'global'). The loss of accuracy against the
+per-voxel search is measured on held-out sampled voxels and reported.
+"""
+
+import os
+import numpy as np
+from dipy.reconst import qtdmri
+from dipy.reconst.dti import TensorModel
+from dipy.data import get_sphere
+from microstructure.voxels import ChunkedMap
+
+GRADIENTS = 'scheme'
+
+# Diffusion time at which the time-dependent metrics are evaluated [s].
+TAU = 1 / (4 * np.pi ** 2)
+
+WEIGHTINGS = ['voxel', 'global', 'strata']
+DEFAULT_WEIGHTING_SAMPLES = 1000
+DEFAULT_WEIGHTING_BINS = 4
+
+# Maps compared between the per-voxel search and the estimated weights.
+SCALARS = ['RTOP', 'RTAP', 'RTPP', 'QIV', 'MSD']
+
+
+def check_options(weighting='voxel', weighting_samples=DEFAULT_WEIGHTING_SAMPLES,
+                  weighting_bins=DEFAULT_WEIGHTING_BINS, **kwargs):
+    if weighting not in WEIGHTINGS:
+        raise ValueError("Unknown qt-dMRI weighting '%s', choose from: %s."
+                         % (weighting, ', '.join(WEIGHTINGS)))
+    if weighting_samples < 2:
+        raise ValueError("qt-dMRI weighting needs at least 2 sampled voxels.")
+    if weighting_bins < 1:
+        raise ValueError("qt-dMRI weighting needs at least 1 bin.")
+
+
+def output_dir(subjectDirectory, **kwargs):
+    return os.path.join(subjectDirectory, 'QTDMRI')
+
+
+def cache_key(**kwargs):
+    return ()
+
+
+def build_model(gtab, laplacian_weighting='GCV', l1_weighting='CV', **kwargs):
+    return qtdmri.QtdmriModel(
+        gtab, radial_order=6, time_order=2,
+        laplacian_regularization=True, laplacian_weighting=laplacian_weighting,
+        l1_regularization=True, l1_weighting=l1_weighting
+    )
+
+
+def tensor_features(gtab, data):
+    tenfit = TensorModel(gtab).fit(data)
+    return np.nan_to_num(tenfit.fa), np.nan_to_num(tenfit.md)
+
+
+def strata(fa, md, edges):
+    # Stratum of each voxel on the FA x MD grid given by the inner bin edges.
+    fa_edges, md_edges = edges
+    return (np.searchsorted(fa_edges, fa, side='right') * (len(md_edges) + 1) +
+            np.searchsorted(md_edges, md, side='right'))
+
+
+def stratified_sample(labels, n_strata, n_samples, rng):
+    # Proportional to the size of each stratum, with a few voxels at least
+    # from every non-empty stratum.
+    n_samples = min(n_samples, len(labels))
+    at_least = max(2, n_samples // (4 * n_strata))
+    sample = []
+    for s in range(n_strata):
+        members = np.flatnonzero(labels == s)
+        n = min(len(members), max(at_least, int(round(n_samples * len(members) / len(labels)))))
+        sample.append(rng.choice(members, n, replace=False))
+    return np.sort(np.concatenate(sample))
+
+
+def weight_table(labels, lopt, alpha, n_strata):
+    # Median searched weights of each stratum, the overall median for strata
+    # without sampled voxels.
+    overall = [np.nanmedian(lopt), np.nanmedian(alpha)]
+    if not np.all(np.isfinite(overall)):
+        raise ValueError("qt-dMRI weight search failed in every sampled voxel.")
+    table = np.tile(overall, (n_strata, 1))
+    for s in range(n_strata):
+        members = labels == s
+        if members.any():
+            median = [np.nanmedian(lopt[members]), np.nanmedian(alpha[members])]
+            if np.all(np.isfinite(median)):
+                table[s] = median
+    return table
+
+
+def relative_errors(searched, estimated):
+    errors = {}
+    for name in SCALARS:
+        reference = searched[name]
+        error = np.abs(estimated[name] - reference) / np.abs(reference)
+        error = error[np.isfinite(error)]
+        if len(error):
+            errors[name] = {'median': float(np.median(error)),
+                            'p95': float(np.percentile(error, 95))}
+    return errors
+
+
+def prepare(gtab, data, fit_sample, weighting='voxel',
+            weighting_samples=DEFAULT_WEIGHTING_SAMPLES,
+            weighting_bins=DEFAULT_WEIGHTING_BINS, **kwargs):
+    if weighting == 'voxel':
+        return {}, {}
+
+    bins = weighting_bins if weighting == 'strata' else 1
+    n_strata = bins ** 2
+    if bins > 1:
+        fa, md = tensor_features(gtab, data)
+        quantiles = np.linspace(0, 1, bins + 1)[1:-1]
+        edges = (np.quantile(fa, quantiles), np.quantile(md, quantiles))
+        labels = strata(fa, md, edges)
+    else:
+        edges = (np.empty(0), np.empty(0))
+        labels = np.zeros(len(data), dtype=int)
+
+    rng = np.random.default_rng(0)
+    sample = stratified_sample(labels, n_strata, weighting_samples, rng)
+    searched = fit_sample(data[sample], weighting='voxel', return_weights=True)
+    lopt, alpha = searched['LAPLACIAN_WEIGHT'], searched['L1_WEIGHT']
+    sample_labels = labels[sample]
+
+    # Accuracy of weights estimated on half of the sample, on the other half.
+    held_out = np.arange(len(sample)) % 2 == 1
+    table = weight_table(sample_labels[~held_out], lopt[~held_out], alpha[~held_out], n_strata)
+    estimated = fit_sample(data[sample[held_out]], weighting=weighting, return_weights=True,
+                           weighting_edges=edges, weighting_table=table)
+    errors = relative_errors({name: values[held_out] for name, values in searched.items()},
+                             estimated)
+
+    table = weight_table(sample_labels, lopt, alpha, n_strata)
+    report = {
+        'weighting': weighting,
+        'sampled_voxels': len(sample),
+        'strata': n_strata,
+        'laplacian_weights': table[:, 0].tolist(),
+        'l1_weights': table[:, 1].tolist(),
+        'held_out_relative_error': errors,
+    }
+    return {'weighting_edges': edges, 'weighting_table': table}, report
+
+
+def fit_maps(qtdmri_fit, n_voxels, return_weights=False):
+    maps = {
+        'RTOP': qtdmri_fit.rtop(TAU),
+        'RTAP': qtdmri_fit.rtap(TAU),
+        'RTPP': qtdmri_fit.rtpp(TAU),
+        'QIV': qtdmri_fit.qiv(TAU),
+        'MSD': qtdmri_fit.msd(TAU),
+    }
+    if return_weights:
+        maps['LAPLACIAN_WEIGHT'] = np.asarray(qtdmri_fit.lopt, dtype=float)
+        maps['L1_WEIGHT'] = np.asarray(qtdmri_fit.alpha, dtype=float)
+    else:
+        sphere = get_sphere('repulsion724')
+        sharpening_factor = 2
+        maps['ODF'] = ChunkedMap(
+            n_voxels, (len(sphere.vertices),),
+            lambda start, stop: qtdmri_fit[start:stop].odf(sphere, TAU, s=sharpening_factor))
+    return maps
+
+
+def merge_strata(parts, n_voxels):
+    # parts: (voxel indices, maps) of each stratum, indices in increasing order.
+    maps = {}
+    for name in parts[0][1]:
+        if isinstance(parts[0][1][name], ChunkedMap):
+            maps[name] = ChunkedMap(n_voxels, parts[0][1][name].shape,
+                                    lambda start, stop, name=name: evaluate_strata(parts, name, start, stop))
+            continue
+        first = np.asarray(parts[0][1][name])
+        values = np.empty((n_voxels,) + first.shape[1:], dtype=first.dtype)
+        for index, part in parts:
+            values[index] = part[name]
+        maps[name] = values
+    return maps
+
+
+def evaluate_strata(parts, name, start, stop):
+    chunked = parts[0][1][name]
+    values = np.empty((stop - start,) + chunked.shape, dtype=chunked.dtype)
+    for index, part in parts:
+        lo, hi = np.searchsorted(index, [start, stop])
+        if hi > lo:
+            values[index[lo:hi] - start] = part[name].evaluate(lo, hi)
+    return values
+
+
+def fit(qtdmri_mod, data, weighting='voxel', weighting_edges=None, weighting_table=None,
+        return_weights=False, **kwargs):
+    if weighting == 'voxel':
+        return fit_maps(qtdmri_mod.fit(data), len(data), return_weights)
+    if weighting_table is None:
+        raise ValueError("qt-dMRI weighting '%s' needs the weights estimated by prepare()."
+                         % weighting)
+
+    if len(weighting_table) > 1:
+        labels = strata(*tensor_features(qtdmri_mod.gtab, data), weighting_edges)
+    else:
+        labels = np.zeros(len(data), dtype=int)
+    parts = []
+    for s, (lopt, alpha) in enumerate(weighting_table):
+        index = np.flatnonzero(labels == s)
+        if len(index):
+            model = build_model(qtdmri_mod.gtab, laplacian_weighting=lopt, l1_weighting=alpha)
+            parts.append((index, fit_maps(model.fit(data[index]), len(index), return_weights)))
+    return merge_strata(parts, len(data))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+White matter tract integrity (WMTI) with Dipy.
+"""
+
+import os
+import dipy.reconst.dki_micro as dki_micro
+
+GRADIENTS = 'bvals'
+
+
+def output_dir(subjectDirectory, **kwargs):
+    return os.path.join(subjectDirectory, 'WMTI')
+
+
+def build_model(gtab, **kwargs):
+    return dki_micro.KurtosisMicrostructureModel(gtab)
+
+
+def fit(dki_micro_model, data, **kwargs):
+    return maps(dki_micro_model.fit(data))
+
+
+def maps(dki_micro_fit):
+    return {
+        'AWF': dki_micro_fit.awf,
+        'Tortuosity': dki_micro_fit.tortuosity,
+        'Restricted': dki_micro_fit.restricted_evals,
+        'Hindered': dki_micro_fit.hindered_evals,
+        'Axonal': dki_micro_fit.axonal_diffusivity,
+        'Hindered_AD': dki_micro_fit.hindered_ad,
+        'Hindered_RD': dki_micro_fit.hindered_rd,
+    }
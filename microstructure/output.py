@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Writing of fitted parameter maps.
+
+Maps are written concurrently on a thread pool (zlib releases the GIL while
+compressing), with a configurable gzip level or uncompressed .nii files, and
+optionally converted to float32. Every file is written under a temporary name
+in the output directory and renamed once complete, so a partially written
+map never has its final name.
+"""
+
+import gzip
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import nibabel as nib
+import numpy as np
+from microstructure.arguments import DEFAULT_COMPRESSION, DEFAULT_WRITE_THREADS
+from microstructure.voxels import ChunkedMap, scatter, scatter_chunks
+
+
+def extension(compression=DEFAULT_COMPRESSION):
+    return '.nii.gz' if compression > 0 else '.nii'
+
+
+def temporary_name(filename):
+    directory, name = os.path.split(filename)
+    return os.path.join(directory, '.%s.%d.tmp' % (name, os.getpid()))
+
+
+def open_nifti_memmap(filename, shape, dtype, affine, header=None):
+    # Uncompressed NIfTI with a zero-filled (sparse) data block, mapped for
+    # writing. The header matches the one nibabel writes for an image, or
+    # is a copy of header (orientation, zooms) without its scaling.
+    if header is None:
+        hdr = nib.Nifti1Header()
+        hdr.set_sform(affine, code='aligned')
+        hdr.set_qform(affine, code='unknown')
+    else:
+        hdr = nib.Nifti1Header.from_header(header)
+        hdr.set_slope_inter(None, None)
+    hdr.set_data_shape(shape)
+    hdr.set_data_dtype(dtype)
+
+    with open(filename, 'wb') as f:
+        hdr.write_to(f)
+        offset = int(hdr['vox_offset'])
+        f.truncate(offset + int(np.prod(shape)) * hdr.get_data_dtype().itemsize)
+
+    return np.memmap(filename, dtype=hdr.get_data_dtype(), mode='r+',
+                     offset=offset, shape=shape, order='F')
+
+
+def write_nifti(filename, volume, affine, compression=DEFAULT_COMPRESSION):
+    img = nib.Nifti1Image(volume, affine)
+    tmp = temporary_name(filename)
+    try:
+        with open(tmp, 'wb') as f:
+            if compression > 0:
+                with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=compression) as gz:
+                    img.to_file_map({'image': nib.FileHolder(fileobj=gz)})
+            else:
+                img.to_file_map({'image': nib.FileHolder(fileobj=f)})
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def finish_nifti(tmp, filename, compression=DEFAULT_COMPRESSION):
+    # Compresses (or renames) a complete uncompressed temporary file into place.
+    try:
+        if compression > 0:
+            gz_tmp = temporary_name(filename)
+            try:
+                with open(tmp, 'rb') as src, \
+                        gzip.open(gz_tmp, 'wb', compresslevel=compression) as dst:
+                    shutil.copyfileobj(src, dst, 16 * 1024 ** 2)
+                os.replace(gz_tmp, filename)
+            finally:
+                if os.path.exists(gz_tmp):
+                    os.remove(gz_tmp)
+        else:
+            os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def write_chunked(filename, chunked, mask, affine, compression=DEFAULT_COMPRESSION, float32=False):
+    dtype = np.float32 if float32 else chunked.dtype
+    tmp = temporary_name(filename + '.nii')
+    try:
+        volume = open_nifti_memmap(tmp, mask.shape + chunked.shape, dtype, affine)
+        scatter_chunks(chunked, mask, volume)
+        volume.flush()
+        del volume
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finish_nifti(tmp, filename, compression)
+
+
+def write_map(filename, values, mask, affine, compression=DEFAULT_COMPRESSION, float32=False):
+    if isinstance(values, ChunkedMap):
+        write_chunked(filename, values, mask, affine, compression=compression, float32=float32)
+        return
+
+    volume = scatter(values, mask)
+    if float32 and np.issubdtype(volume.dtype, np.floating):
+        volume = volume.astype(np.float32)
+    write_nifti(filename, volume, affine, compression=compression)
+
+
+def save_maps(outdir, maps, mask, affine, compression=DEFAULT_COMPRESSION,
+              float32=False, write_threads=DEFAULT_WRITE_THREADS):
+    os.makedirs(outdir, exist_ok=True)
+    # Map names may contain a subdirectory of outdir.
+    for name in maps:
+        os.makedirs(os.path.dirname(os.path.join(outdir, name)), exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=max(1, write_threads)) as executor:
+        futures = [executor.submit(write_map,
+                                   os.path.join(outdir, name + extension(compression)),
+                                   values, mask, affine,
+                                   compression=compression, float32=float32)
+                   for name, values in maps.items()]
+        for future in futures:
+            future.result()
+
+
+class MapStream:
+    """Maps written block by block into memory-mapped NIfTI files.
+
+    Blocks are ranges of the voxels whose coordinates are given by index (a
+    tuple of coordinate arrays); close() compresses the files into place.
+    """
+
+    def __init__(self, outdir, shape, index, affine, compression=DEFAULT_COMPRESSION,
+                 float32=False):
+        self.outdir = outdir
+        self.shape = tuple(shape)
+        self.index = index
+        self.n_voxels = len(index[0])
+        self.affine = affine
+        self.compression = compression
+        self.float32 = float32
+        self.volumes = {}
+        self.tmps = {}
+
+    def filename(self, name):
+        return os.path.join(self.outdir, name + extension(self.compression))
+
+    def coordinates(self, start, stop):
+        return tuple(axis[start:stop] for axis in self.index)
+
+    def volume(self, name, shape, dtype):
+        if name not in self.volumes:
+            filename = self.filename(name)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            if self.float32 and np.issubdtype(dtype, np.floating):
+                dtype = np.float32
+            self.tmps[name] = temporary_name(filename + '.nii')
+            self.volumes[name] = open_nifti_memmap(self.tmps[name], self.shape + tuple(shape),
+                                                   dtype, self.affine)
+        return self.volumes[name]
+
+    def write(self, start, stop, maps):
+        for name, values in maps.items():
+            if isinstance(values, ChunkedMap):
+                volume = self.volume(name, values.shape, values.dtype)
+                for chunk_start, chunk_stop, chunk in values.chunks():
+                    volume[self.coordinates(start + chunk_start, start + chunk_stop)] = chunk
+            else:
+                values = np.asarray(values)
+                volume = self.volume(name, values.shape[1:], values.dtype)
+                volume[self.coordinates(start, stop)] = values
+
+    def maps(self):
+        # The written maps of all voxels: one value per voxel as arrays, the
+        # others read back chunk by chunk.
+        maps = {}
+        for name, volume in self.volumes.items():
+            if volume.ndim == len(self.shape):
+                maps[name] = np.asarray(volume[self.coordinates(0, self.n_voxels)])
+            else:
+                maps[name] = ChunkedMap(
+                    self.n_voxels, volume.shape[len(self.shape):],
+                    lambda start, stop, volume=volume: volume[self.coordinates(start, stop)],
+                    dtype=volume.dtype)
+        return maps
+
+    def discard(self, name):
+        del self.volumes[name]
+        os.remove(self.tmps.pop(name))
+
+    def close(self, write_threads=DEFAULT_WRITE_THREADS):
+        for volume in self.volumes.values():
+            volume.flush()
+        self.volumes.clear()
+        with ThreadPoolExecutor(max_workers=max(1, write_threads)) as executor:
+            futures = [executor.submit(finish_nifti, tmp, self.filename(name), self.compression)
+                       for name, tmp in self.tmps.items()]
+            for future in futures:
+                future.result()
+        self.tmps.clear()
+
+    def abort(self):
+        self.volumes.clear()
+        for tmp in self.tmps.values():
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.tmps.clear()
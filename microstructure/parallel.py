@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked fitting of the masked voxels on a pool of worker processes.
+
+The compact (n_voxels, n_dwis) array is placed in shared memory once, each
+worker builds the model once and fits contiguous chunks of voxels, and the
+chunk results are concatenated in voxel order. Every voxel is fitted exactly
+as in the serial path, so the maps do not depend on the number of jobs (up
+to the last bit: BLAS kernels round differently with the alignment of their
+arrays), except for fits that seed a voxel from its neighbour (the
+warm-started batched FWDTI fit): seeds do not cross chunks, so those maps
+depend on the chunks, as set by n_jobs, the checkpoint and the streamed
+blocks, within the tolerance of the solver.
+
+With several workers or a checkpoint, the maps of every chunk are saved as
+soon as the chunk is fitted: one .npy file per map, chunked maps (ODF, PDF)
+evaluated into it a block of voxels at a time, in the checkpoint directory
+or else in a temporary one. The maps are read back memory-mapped, and the
+chunked maps stay chunked maps over the saved files, so that they are never
+held whole in memory, in the workers or here. With a checkpoint, a rerun on
+the same data with the same options only fits the chunks without a saved
+result.
+
+Data loaded in float32 (precision='float32') is converted to float64 one
+chunk at a time for the solver, and the chunk's maps back to float32.
+"""
+
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from microstructure.model_cache import build_model
+from microstructure.precision import DEFAULT_PRECISION, cast_maps
+from microstructure.voxels import ChunkedMap
+
+# Thread pools of the numerical libraries, limited to one thread per worker
+# so that n_jobs workers do not oversubscribe the node.
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+# Chunks per worker, so that slow (e.g. constrained) voxels are balanced
+# across workers instead of stalling one of them.
+CHUNKS_PER_JOB = 4
+
+# Directory of the chunk checkpoints inside an output directory, and voxels
+# per checkpointed chunk, independent of the number of jobs so that a fit can
+# be resumed with another one.
+CHECKPOINT_DIR = '.checkpoint'
+CHECKPOINT_VOXELS = 2000
+
+# Options that do not change the fitted maps.
+CHECKPOINT_IGNORED = ['cache_dir', 'cache_size']
+
+_worker = {}
+
+
+def n_workers(n_jobs):
+    if n_jobs is None or n_jobs < 1:
+        return os.cpu_count() or 1
+    return n_jobs
+
+
+def chunk_bounds(n_voxels, n_chunks):
+    n_chunks = max(1, min(n_voxels, n_chunks))
+    edges = np.linspace(0, n_voxels, n_chunks + 1).astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def concatenate(chunks, results, scratch=None):
+    # results: the maps of each chunk, by its bounds. A chunked map stays a
+    # chunked map, read from the saved chunks; it keeps the scratch
+    # directory, if any, until it is no longer used.
+    maps = {}
+    for name, first in results[chunks[0]].items():
+        if isinstance(first, ChunkedMap):
+            maps[name] = stored_map(chunks, [results[bounds][name] for bounds in chunks], scratch)
+        else:
+            maps[name] = np.concatenate([np.asarray(results[bounds][name]) for bounds in chunks])
+    return maps
+
+
+def stored_map(chunks, parts, scratch=None):
+    def evaluate(start, stop, scratch=scratch):
+        return np.concatenate([part.evaluate(max(start, x0) - x0, min(stop, x1) - x0)
+                               for (x0, x1), part in zip(chunks, parts)
+                               if x0 < stop and x1 > start])
+    return ChunkedMap(chunks[-1][1], parts[0].shape, evaluate, dtype=parts[0].dtype)
+
+
+@contextmanager
+def single_threaded_children():
+    saved = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+    for name in THREAD_VARIABLES:
+        os.environ.setdefault(name, '1')
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def fit_chunk(module, model, data, options):
+    maps = module.fit(model, np.asarray(data, dtype=np.float64), **options)
+    return cast_maps(maps, options.get('precision', DEFAULT_PRECISION))
+
+
+def _init_worker(shm_name, shape, dtype, module_name, gtab, options):
+    shm = SharedMemory(name=shm_name)
+    # The parent owns the segment; keep the worker's resource tracker from
+    # unlinking it when the worker exits.
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    module = importlib.import_module(module_name)
+    _worker['shm'] = shm
+    _worker['data'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker['module'] = module
+    _worker['model'] = build_model(module, gtab, **options)
+    _worker['options'] = options
+
+
+def _fit_chunk(bounds, directory):
+    start, stop = bounds
+    maps = fit_chunk(_worker['module'], _worker['model'], _worker['data'][start:stop],
+                     _worker['options'])
+    # Saved rather than returned: the parent reads the maps back from the
+    # files, chunked maps without evaluating them whole.
+    save_chunk(directory, bounds, maps)
+    return bounds
+
+
+@contextmanager
+def worker_pool(module, gtab, data, n_workers, options):
+    shm = SharedMemory(create=True, size=max(1, data.nbytes))
+    shared = None
+    try:
+        shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+        shared[:] = data
+        # Workers are spawned rather than forked: the solvers (cvxpy, MOSEK)
+        # and BLAS keep threads that are not fork-safe.
+        with single_threaded_children(), \
+                ProcessPoolExecutor(max_workers=n_workers,
+                                    mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=_init_worker,
+                                    initargs=(shm.name, data.shape, data.dtype.str,
+                                              module.__name__, gtab, options)) as executor:
+            yield executor
+    finally:
+        # The segment can only be closed once no array uses its buffer.
+        del shared
+        shm.close()
+        shm.unlink()
+
+
+def checkpoint_dir(checkpoint, module, data, options):
+    # Checkpoints of a different model, options or data are not reused.
+    sha = hashlib.sha256()
+    sha.update(module.__name__.encode())
+    sha.update(repr(sorted((key, repr(value)) for key, value in options.items()
+                           if key not in CHECKPOINT_IGNORED)).encode())
+    sha.update(('%s %s' % (data.shape, data.dtype.str)).encode())
+    sha.update(np.ascontiguousarray(data).data)
+    return os.path.join(checkpoint, sha.hexdigest()[:16])
+
+
+def chunk_file(directory, bounds):
+    return os.path.join(directory, 'chunk_%09d_%09d' % bounds)
+
+
+def load_chunk(directory, bounds):
+    # The maps of a saved chunk, memory-mapped; None if it was not saved.
+    path = chunk_file(directory, bounds)
+    try:
+        with open(os.path.join(path, 'maps.json')) as f:
+            names = json.load(f)
+        maps = {}
+        for i, (name, chunked) in enumerate(names):
+            values = np.load(os.path.join(path, '%d.npy' % i), mmap_mode='r')
+            if chunked:
+                values = ChunkedMap(len(values), values.shape[1:],
+                                    lambda start, stop, values=values: values[start:stop],
+                                    dtype=values.dtype)
+            maps[name] = values
+        return maps
+    except (OSError, ValueError):
+        return None
+
+
+def save_chunk(directory, bounds, maps):
+    # Written under a temporary name and renamed once complete.
+    path = chunk_file(directory, bounds)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    try:
+        for i, values in enumerate(maps.values()):
+            filename = os.path.join(tmp, '%d.npy' % i)
+            if isinstance(values, ChunkedMap):
+                saved = np.lib.format.open_memmap(filename, mode='w+', dtype=values.dtype,
+                                                  shape=(values.n_voxels,) + values.shape)
+                for start, stop, chunk in values.chunks():
+                    saved[start:stop] = chunk
+                saved.flush()
+                del saved
+            else:
+                np.save(filename, np.asarray(values))
+        with open(os.path.join(tmp, 'maps.json'), 'w') as f:
+            json.dump([[name, isinstance(values, ChunkedMap)] for name, values in maps.items()], f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+
+def fit_checkpointed(module, gtab, data, n_jobs, model, checkpoint, options):
+    directory = checkpoint_dir(checkpoint, module, data, options)
+    os.makedirs(directory, exist_ok=True)
+    chunks = chunk_bounds(len(data), -(-len(data) // CHECKPOINT_VOXELS))
+    results = {bounds: load_chunk(directory, bounds) for bounds in chunks}
+    missing = [bounds for bounds in chunks if results[bounds] is None]
+
+    if n_jobs == 1 or len(missing) < 2:
+        for start, stop in missing:
+            if model is None:
+                model = build_model(module, gtab, **options)
+            maps = fit_chunk(module, model, data[start:stop], options)
+            save_chunk(directory, (start, stop), maps)
+            del maps
+    else:
+        if model is None and hasattr(module, 'cache_key'):
+            build_model(module, gtab, **options)
+        # Workers fit the chunks by their bounds in data.
+        with worker_pool(module, gtab, data, min(n_jobs, len(missing)), options) as executor:
+            futures = [executor.submit(_fit_chunk, bounds, directory) for bounds in missing]
+            for future in as_completed(futures):
+                future.result()
+
+    for bounds in missing:
+        results[bounds] = load_chunk(directory, bounds)
+        if results[bounds] is None:
+            raise RuntimeError("The maps of voxels %d to %d were not saved in %s."
+                               % (bounds + (directory,)))
+    return concatenate(chunks, results)
+
+
+def fit_voxels(module, gtab, data, n_jobs=1, built_model=None, checkpoint=None, **options):
+    # built_model: the model already built by the caller; options['model'] is
+    # an option of the model (e.g. the MAP-MRI variant).
+    n_jobs = n_workers(n_jobs)
+    if checkpoint is not None:
+        return fit_checkpointed(module, gtab, data, n_jobs, built_model, checkpoint, options)
+    if n_jobs == 1 or len(data) < 2:
+        model = built_model
+        if model is None:
+            model = build_model(module, gtab, **options)
+        return fit_chunk(module, model, data, options)
+
+    if built_model is None and hasattr(module, 'cache_key'):
+        # Store the model once here rather than in every worker.
+        build_model(module, gtab, **options)
+
+    chunks = chunk_bounds(len(data), n_jobs * CHUNKS_PER_JOB)
+    scratch = tempfile.TemporaryDirectory(prefix='microstructure-chunks-')
+    with worker_pool(module, gtab, data, min(n_jobs, len(chunks)), options) as executor:
+        list(executor.map(_fit_chunk, chunks, [scratch.name] * len(chunks)))
+
+    return concatenate(chunks, {bounds: load_chunk(scratch.name, bounds) for bounds in chunks},
+                       scratch)
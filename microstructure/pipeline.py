@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Load a subject once and fit any number of models on the shared data.
+"""
+
+import os
+import shutil
+import numpy as np
+from microstructure import streaming
+from microstructure.arguments import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS
+from microstructure.data import load_masked_dwi, load_gtab, load_scheme_gtab
+from microstructure.models import get_model
+from microstructure.output import DEFAULT_COMPRESSION, DEFAULT_WRITE_THREADS, save_maps
+from microstructure.instrumentation import RunLog, write_prometheus
+from microstructure.model_cache import build_model
+from microstructure.parallel import CHECKPOINT_DIR, fit_voxels, n_workers
+from microstructure.precision import DEFAULT_PRECISION, check_precision
+from microstructure.voxels import nonfinite_voxels
+
+
+def sample_fitter(module, gtab, n_jobs, options):
+    # Fits a subset of the voxels for the prepare() step of a model.
+    def fit_sample(sample, **sample_options):
+        return fit_voxels(module, gtab, sample, n_jobs=n_jobs, **dict(options, **sample_options))
+    return fit_sample
+
+
+def finish_checkpoint(checkpoint_dir):
+    # The chunk checkpoints are only needed until the maps are written.
+    if checkpoint_dir is not None:
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+
+def run(subjectDirectory, models, dwiFile, maskFile,
+        bvalFile=None, bvecFile=None, schemeFile=None,
+        big_delta=None, small_delta=None, n_jobs=1,
+        compression=DEFAULT_COMPRESSION, output_float32=False,
+        write_threads=DEFAULT_WRITE_THREADS, input_cache=False, max_memory=None,
+        checkpoint=False, prometheus=None, precision=DEFAULT_PRECISION,
+        output_format=DEFAULT_OUTPUT_FORMAT, saved=None, **options):
+    # saved: called with the name of each model once its outputs are written.
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format '%s', choose from: %s."
+                         % (output_format, ', '.join(OUTPUT_FORMATS)))
+    dtype = check_precision(precision)
+    # Maps are fitted, derived and written in the precision of the data.
+    options = dict(options, precision=precision)
+    output_float32 = output_float32 or dtype == np.float32
+    modules = [get_model(name) for name in models]
+    for module in modules:
+        if hasattr(module, 'check_options'):
+            module.check_options(**options)
+
+    log = RunLog(subject=os.path.abspath(subjectDirectory), n_jobs=n_workers(n_jobs))
+    with log.stage('load'):
+        if max_memory is None:
+            data, mask, dwi_affine = load_masked_dwi(
+                os.path.join(subjectDirectory, dwiFile),
+                os.path.join(subjectDirectory, maskFile),
+                input_cache=input_cache, dtype=dtype)
+        else:
+            # The voxels are read block by block while fitting.
+            voxels, dwi_affine = streaming.open_voxels(
+                os.path.join(subjectDirectory, dwiFile),
+                os.path.join(subjectDirectory, maskFile),
+                input_cache=input_cache, dtype=dtype)
+
+    gtabs = {}
+    with log.stage('gradients'):
+        for module in modules:
+            if module.GRADIENTS in gtabs:
+                continue
+            if module.GRADIENTS == 'scheme':
+                if schemeFile is None:
+                    raise ValueError("%s needs a scheme file." % module.__name__)
+                gtabs['scheme'] = load_scheme_gtab(
+                    os.path.join(subjectDirectory, schemeFile))
+            else:
+                if bvalFile is None or bvecFile is None:
+                    raise ValueError("%s needs b-value and b-vector files." % module.__name__)
+                gtabs['bvals'] = load_gtab(
+                    os.path.join(subjectDirectory, bvalFile),
+                    os.path.join(subjectDirectory, bvecFile),
+                    big_delta=big_delta, small_delta=small_delta)
+
+    logs = []
+    for name, module in zip(models, modules):
+        model_log = log.copy(model=name)
+        gtab = gtabs[module.GRADIENTS]
+        model_options = options
+        if hasattr(module, 'prepare'):
+            with model_log.stage('prepare'):
+                sample = (data if max_memory is None else
+                          voxels.sample(streaming.SAMPLE_VOXELS, dtype=dtype))
+                prepared, report = module.prepare(
+                    gtab, sample, sample_fitter(module, gtab, n_jobs, options), **options)
+            model_options = dict(options, **prepared)
+            if report:
+                model_log.info['prepare'] = report
+        with model_log.stage('build'):
+            # With several workers, each worker builds its own model; only a
+            # cached model is built here, to store it once.
+            model = None
+            if n_workers(n_jobs) == 1 or hasattr(module, 'cache_key'):
+                model = build_model(module, gtab, **model_options)
+        outdir = module.output_dir(subjectDirectory, **model_options)
+        # Recorded in a container output.
+        info = {'subject': os.path.abspath(subjectDirectory), 'model': name,
+                'inputs': {'dwiFile': dwiFile, 'maskFile': maskFile, 'bvalFile': bvalFile,
+                           'bvecFile': bvecFile, 'schemeFile': schemeFile},
+                'options': model_options}
+        checkpoint_dir = os.path.join(outdir, CHECKPOINT_DIR) if checkpoint else None
+        if max_memory is not None:
+            streaming.fit_model(module, gtab, voxels, outdir, dwi_affine, max_memory,
+                                log=model_log, n_jobs=n_jobs, built_model=model,
+                                checkpoint=checkpoint_dir,
+                                compression=compression, float32=output_float32,
+                                write_threads=write_threads, output_format=output_format,
+                                info=info, **model_options)
+            finish_checkpoint(checkpoint_dir)
+            model_log.write(outdir)
+            logs.append(model_log)
+            if saved is not None:
+                saved(name)
+            continue
+
+        with model_log.stage('fit'):
+            maps = fit_voxels(module, gtab, data, n_jobs=n_jobs, built_model=model,
+                              checkpoint=checkpoint_dir, **model_options)
+        if hasattr(module, 'finalize'):
+            with model_log.stage('derive'):
+                maps = module.finalize(maps, **model_options)
+        model_log.count('voxels', len(data))
+        model_log.count('failed_voxels', nonfinite_voxels(maps))
+
+        with model_log.stage('save'):
+            if output_format == 'hdf5':
+                from microstructure import container
+                container.save_maps(outdir, maps, mask, dwi_affine,
+                                    compression=compression, float32=output_float32,
+                                    write_threads=write_threads,
+                                    info=container.provenance(**info))
+            else:
+                save_maps(outdir, maps, mask, dwi_affine,
+                          compression=compression, float32=output_float32,
+                          write_threads=write_threads)
+        finish_checkpoint(checkpoint_dir)
+        model_log.write(outdir)
+        logs.append(model_log)
+        if saved is not None:
+            saved(name)
+
+    if prometheus is not None:
+        write_prometheus(prometheus, logs)
+    return logs
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Floating point precision of the data and the maps.
+
+With precision='float32' the masked voxels are loaded (or read block by
+block) as float32, every chunk of voxels is converted to float64 only while a
+solver fits it, and its maps are converted back to float32 as soon as they
+are returned, so that the maps held in memory, passed back from the workers,
+checkpointed, derived from and written are all float32. The Dipy and AMICO
+solvers themselves always work in float64.
+
+errors() measures the difference of a map against its float64 reference, as
+reported by ``python -m microstructure bench --precision``.
+"""
+
+import numpy as np
+from microstructure.arguments import DEFAULT_PRECISION, PRECISIONS
+from microstructure.voxels import ChunkedMap
+
+# Reference values below this fraction of the largest one are left out of the
+# relative errors.
+RELATIVE_FLOOR = 1e-6
+
+
+def check_precision(precision):
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision '%s', choose from: %s."
+                         % (precision, ', '.join(PRECISIONS)))
+    return np.dtype(precision)
+
+
+def cast_maps(maps, precision=DEFAULT_PRECISION):
+    # Only narrows: float64 maps stay as the models return them.
+    if precision == DEFAULT_PRECISION:
+        return maps
+    dtype = check_precision(precision)
+    for name, values in maps.items():
+        if isinstance(values, ChunkedMap):
+            values.dtype = dtype
+        elif np.issubdtype(np.asarray(values).dtype, np.floating):
+            maps[name] = np.asarray(values, dtype=dtype)
+    return maps
+
+
+def errors(reference, values):
+    reference = np.asarray(reference, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    finite = np.isfinite(reference) & np.isfinite(values)
+    difference = np.abs(values[finite] - reference[finite])
+    scale = np.abs(reference[finite])
+    significant = scale > RELATIVE_FLOOR * scale.max(initial=0)
+    relative = difference[significant] / scale[significant]
+    return {
+        'max_abs_error': float(difference.max(initial=0)),
+        'max_rel_error': float(relative.max(initial=0)),
+        'median_rel_error': float(np.median(relative)) if len(relative) else 0.0,
+        'nonfinite_mismatch': int(np.count_nonzero(np.isfinite(reference) != np.isfinite(values))),
+    }
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Out-of-core fitting with bounded memory.
+
+The DWI is memory-mapped (a gzipped DWI through the input cache) and the
+masked voxels are fitted in blocks, in axial slab order (z, then y, then x),
+so that a block reads a few contiguous slabs of every volume. Each block is
+fitted and written into memory-mapped output images before the next one is
+read, and the images are compressed into place at the end.
+
+The block size is chosen from the memory budget: a first small block of
+PROBE_VOXELS voxels measures the size of the model's maps per voxel, and the
+budget is divided by WORKING_FACTOR times the input and output bytes of a
+voxel, to leave room for the model's working arrays. The peak memory then
+depends on the budget rather than on the size of the volume.
+"""
+
+import numpy as np
+from microstructure.arguments import DEFAULT_OUTPUT_FORMAT
+from microstructure.data import load_dwi
+from microstructure.instrumentation import RunLog
+from microstructure.output import DEFAULT_COMPRESSION, DEFAULT_WRITE_THREADS, MapStream
+from microstructure.parallel import fit_voxels
+from microstructure.precision import DEFAULT_PRECISION
+from microstructure.voxels import ChunkedMap, nonfinite_voxels
+
+PROBE_VOXELS = 64
+
+# Working memory of a model per voxel, as a multiple of its input and outputs.
+WORKING_FACTOR = 4
+
+# Voxels read for the prepare() step of a model.
+SAMPLE_VOXELS = 20000
+
+
+class Voxels:
+    """The masked voxels of a memory-mapped DWI, in axial slab order."""
+
+    def __init__(self, dwi_data, mask):
+        self.dwi_data = dwi_data
+        self.mask = mask
+        z, y, x = np.nonzero(mask.transpose(2, 1, 0))
+        self.index = (x, y, z)
+        self.n_dwis = dwi_data.shape[-1]
+
+    def __len__(self):
+        return len(self.index[0])
+
+    def read(self, start, stop, dtype=np.float64):
+        coordinates = tuple(axis[start:stop] for axis in self.index)
+        return np.ascontiguousarray(self.dwi_data[coordinates], dtype=dtype)
+
+    def sample(self, n_voxels, seed=0, dtype=np.float64):
+        rng = np.random.default_rng(seed)
+        chosen = np.sort(rng.choice(len(self), min(n_voxels, len(self)), replace=False))
+        coordinates = tuple(axis[chosen] for axis in self.index)
+        return np.ascontiguousarray(self.dwi_data[coordinates], dtype=dtype)
+
+
+def open_voxels(dwiFile, maskFile, input_cache=False, dtype=np.float64):
+    # A gzipped DWI cannot be read a block at a time without decompressing
+    # it again for every block.
+    if dwiFile.endswith('.gz'):
+        input_cache = True
+    dwi_data, mask_data, dwi_affine = load_dwi(dwiFile, maskFile, input_cache=input_cache,
+                                               dtype=dtype)
+    return Voxels(dwi_data, np.asarray(mask_data) > 0), dwi_affine
+
+
+def map_bytes(values, n_voxels):
+    if isinstance(values, ChunkedMap):
+        return int(np.prod(values.shape)) * values.dtype.itemsize
+    return np.asarray(values).nbytes / max(1, n_voxels)
+
+
+def block_size(voxels, maps, n_voxels, max_memory):
+    output = sum(map_bytes(values, n_voxels) for values in maps.values())
+    per_voxel = WORKING_FACTOR * (voxels.n_dwis * (8 + voxels.dwi_data.dtype.itemsize) + output)
+    return max(1, int(max_memory * 1024 ** 3 // per_voxel))
+
+
+def fit_model(module, gtab, voxels, outdir, affine, max_memory, log=None, n_jobs=1,
+              built_model=None, checkpoint=None, compression=DEFAULT_COMPRESSION, float32=False,
+              write_threads=DEFAULT_WRITE_THREADS, precision=DEFAULT_PRECISION,
+              output_format=DEFAULT_OUTPUT_FORMAT, info=None, **options):
+    log = log if log is not None else RunLog()
+    stream = MapStream(outdir, voxels.mask.shape, voxels.index, affine,
+                       compression=compression, float32=float32)
+    try:
+        with log.stage('fit'):
+            start, size = 0, PROBE_VOXELS
+            while start < len(voxels):
+                stop = min(start + size, len(voxels))
+                maps = fit_voxels(module, gtab, voxels.read(start, stop, dtype=precision),
+                                  n_jobs=n_jobs, built_model=built_model, checkpoint=checkpoint,
+                                  precision=precision, **options)
+                if start == 0:
+                    size = block_size(voxels, maps, stop, max_memory)
+                    log.count('block_voxels', size)
+                log.count('blocks', 1)
+                log.count('failed_voxels', nonfinite_voxels(maps))
+                stream.write(start, stop, maps)
+                del maps
+                start = stop
+        log.count('voxels', len(voxels))
+
+        if hasattr(module, 'finalize'):
+            with log.stage('derive'):
+                written = stream.maps()
+                derived = module.finalize(dict(written), precision=precision, **options)
+                for name in written:
+                    if name not in derived:
+                        stream.discard(name)
+                stream.write(0, len(voxels), {name: values for name, values in derived.items()
+                                              if values is not written.get(name)})
+
+        with log.stage('save'):
+            if output_format == 'hdf5':
+                from microstructure import container
+                container.save_stream(outdir, stream, compression=compression,
+                                      write_threads=write_threads,
+                                      info=container.provenance(**(info or {})))
+            else:
+                stream.close(write_threads=write_threads)
+    except BaseException:
+        stream.abort()
+        raise
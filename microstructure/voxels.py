@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Compaction of the masked voxels of a volume.
+
+The models are fitted on a contiguous (n_voxels, n_dwis) array holding only
+the voxels inside the brain mask; maps are scattered back to the volume grid
+only when they are written.
+"""
+
+import numpy as np
+
+
+def gather(dwi_data, mask_data, dtype=np.float64):
+    mask = np.asarray(mask_data) > 0
+    data = np.ascontiguousarray(dwi_data[mask], dtype=dtype)
+    return data, mask
+
+
+def scatter(values, mask):
+    values = np.asarray(values)
+    volume = np.zeros(mask.shape + values.shape[1:], dtype=values.dtype)
+    volume[mask] = values
+    return volume
+
+
+def nonfinite_voxels(maps):
+    # Voxels where the fit failed and left NaN/inf in any of the maps.
+    failed = None
+    for values in maps.values():
+        if isinstance(values, np.ndarray) and np.issubdtype(values.dtype, np.floating):
+            nonfinite = ~np.isfinite(values.reshape(len(values), -1)).all(axis=1)
+            failed = nonfinite if failed is None else failed | nonfinite
+    return 0 if failed is None else int(failed.sum())
+
+
+# Voxels evaluated at once for a ChunkedMap (10000 voxels of a 724-direction
+# ODF in float32 are about 29 MB).
+CHUNK_VOXELS = 10000
+
+
+class ChunkedMap:
+    """A per-voxel map evaluated one chunk of voxels at a time.
+
+    Used for the large 4D maps (ODF, PDF) so that they are computed in float32
+    and written as they are evaluated, instead of being held in memory.
+    ``evaluate(start, stop)`` returns the values of voxels start to stop.
+    """
+
+    def __init__(self, n_voxels, shape, evaluate, dtype=np.float32):
+        self.n_voxels = n_voxels
+        self.shape = tuple(shape)
+        self.evaluate = evaluate
+        self.dtype = np.dtype(dtype)
+
+    def chunks(self, chunk_size=CHUNK_VOXELS):
+        for start in range(0, self.n_voxels, chunk_size):
+            stop = min(start + chunk_size, self.n_voxels)
+            yield start, stop, np.asarray(self.evaluate(start, stop), dtype=self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        values = np.empty((self.n_voxels,) + self.shape, dtype=self.dtype)
+        for start, stop, chunk in self.chunks():
+            values[start:stop] = chunk
+        return values if dtype is None else values.astype(dtype)
+
+
+def scatter_chunks(chunked, mask, volume):
+    # Voxel coordinates of the masked voxels, in the order of the compact array.
+    index = np.nonzero(mask)
+    for start, stop, chunk in chunked.chunks():
+        volume[tuple(axis[start:stop] for axis in index)] = chunk
+    return volume
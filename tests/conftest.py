@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Small phantoms of the benchmark, shared by the tests.
+"""
+
+import os
+
+import numpy as np
+import pytest
+from dipy.core.gradients import gradient_table
+from microstructure import benchmark
+from microstructure.data import load_gtab, load_masked_dwi
+
+PHANTOM_SHAPE = (6, 6, 4)
+
+
+@pytest.fixture(scope='session')
+def multishell():
+    # The gradient table and the signal of a few voxels of the bench phantom.
+    rng = np.random.default_rng(0)
+    bvals, bvecs = benchmark.multishell_protocol(rng)
+    gtab = gradient_table(bvals, bvecs, big_delta=benchmark.BIG_DELTA,
+                          small_delta=benchmark.SMALL_DELTA)
+    return gtab, benchmark.simulate(bvals, bvecs, 6, rng)
+
+
+@pytest.fixture(scope='session')
+def phantom(tmp_path_factory):
+    # A subject directory with the bench phantom, named as benchmark.FILES.
+    subjectDirectory = str(tmp_path_factory.mktemp('phantom'))
+    benchmark.make_phantom(subjectDirectory, shape=PHANTOM_SHAPE)
+    return subjectDirectory
+
+
+@pytest.fixture(scope='session')
+def phantom_gtab(phantom):
+    return load_gtab(os.path.join(phantom, benchmark.FILES['bvalFile']),
+                     os.path.join(phantom, benchmark.FILES['bvecFile']),
+                     big_delta=benchmark.BIG_DELTA, small_delta=benchmark.SMALL_DELTA)
+
+
+@pytest.fixture(scope='session')
+def phantom_data(phantom):
+    data, mask, affine = load_masked_dwi(os.path.join(phantom, benchmark.FILES['dwiFile']),
+                                         os.path.join(phantom, benchmark.FILES['maskFile']))
+    return data
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Manifests of the batch: a model is complete only with all its output files.
+"""
+
+import os
+import shutil
+
+import pytest
+from microstructure import batch
+
+FILES = {'dwiFile': 'dwi.nii.gz', 'bvalFile': 'dwi.bval', 'bvecFile': 'dwi.bvec',
+         'maskFile': 'mask.nii.gz'}
+
+OUTPUTS = ['FA.nii.gz', 'microstructure_run.json', os.path.join('WMTI', 'AWF.nii.gz'),
+           os.path.join('MSDKI', 'MSD.nii.gz')]
+
+
+@pytest.fixture
+def fitted(tmp_path):
+    # A subject with the outputs of the dki model, and its manifest.
+    for filename in FILES.values():
+        (tmp_path / filename).write_bytes(filename.encode())
+    outdir = tmp_path / 'DKI'
+    for output in OUTPUTS + [os.path.join('.checkpoint', 'chunk')]:
+        os.makedirs(os.path.dirname(str(outdir / output)), exist_ok=True)
+        (outdir / output).write_bytes(b'map')
+    batch.record(str(tmp_path), 'dki', FILES, {})
+    return str(tmp_path), str(outdir)
+
+
+def test_manifest_lists_files(fitted):
+    subject, outdir = fitted
+    assert batch.read_manifest(outdir)['outputs'] == sorted(OUTPUTS)
+    assert batch.is_complete(subject, 'dki', FILES, {})
+
+
+@pytest.mark.parametrize('removed', [os.path.join('WMTI', 'AWF.nii.gz'), 'MSDKI'])
+def test_missing_output_is_incomplete(fitted, removed):
+    subject, outdir = fitted
+    path = os.path.join(outdir, removed)
+    if os.path.isdir(path):
+        # An empty directory is not its outputs.
+        shutil.rmtree(path)
+        os.makedirs(path)
+    else:
+        os.remove(path)
+    assert not batch.is_complete(subject, 'dki', FILES, {})
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Eviction from the caches, under the locks of their entries.
+"""
+
+import os
+
+from microstructure.cache import evict, locked, try_locked
+
+
+def make_entry(directory, name, size, mtime):
+    entry = os.path.join(directory, name)
+    os.makedirs(entry)
+    with open(os.path.join(entry, 'data'), 'wb') as f:
+        f.write(b'\0' * size)
+    os.utime(entry, (mtime, mtime))
+    return entry
+
+
+def test_evict_least_recently_used(tmp_path):
+    directory = str(tmp_path)
+    old, new, kept = [make_entry(directory, name, 2 ** 20, mtime)
+                      for name, mtime in [('old', 1), ('new', 3), ('kept', 2)]]
+    evict(directory, 2, keep=kept)
+    assert sorted(os.listdir(directory)) == ['kept', 'new']
+
+
+def test_evict_skips_locked_entries(tmp_path):
+    directory = str(tmp_path)
+    busy, idle = [make_entry(directory, name, 2 ** 20, mtime)
+                  for name, mtime in [('busy', 1), ('idle', 2)]]
+    open(idle + '.lock', 'a').close()
+    # A lock file left by a failed generation, without its entry.
+    open(os.path.join(directory, 'failed.lock'), 'a').close()
+    with locked(busy + '.lock'):
+        evict(directory, 0, lock=True)
+        assert sorted(os.listdir(directory)) == ['busy', 'busy.lock']
+    evict(directory, 0, lock=True)
+    assert os.listdir(directory) == []
+
+
+def test_lock_of_removed_entry(tmp_path):
+    # A job waiting on the lock of an entry evicted meanwhile locks the new
+    # lock file, not the removed one.
+    lock = os.path.join(str(tmp_path), 'entry.lock')
+    with locked(lock):
+        with try_locked(lock) as taken:
+            assert not taken
+    with try_locked(lock) as taken:
+        assert taken
+    os.remove(lock)
+    with locked(lock):
+        assert os.path.exists(lock)
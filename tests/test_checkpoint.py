@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Resume of a checkpointed parallel.fit_voxels.
+"""
+
+import os
+import shutil
+
+import numpy as np
+from microstructure import parallel
+from microstructure.models import mapmri, msdki
+from microstructure.voxels import ChunkedMap
+
+
+def assert_maps_equal(maps, expected):
+    assert sorted(maps) == sorted(expected)
+    for name in expected:
+        np.testing.assert_array_equal(maps[name], expected[name])
+
+
+def test_checkpoint_resumes_missing_chunks(phantom_gtab, phantom_data, tmp_path, monkeypatch):
+    monkeypatch.setattr(parallel, 'CHECKPOINT_VOXELS', 10)
+    fitted = []
+
+    def fit(model, data, **kwargs):
+        fitted.append(len(data))
+        return msdki.maps(model.fit(data))
+
+    monkeypatch.setattr(msdki, 'fit', fit)
+    expected = parallel.fit_voxels(msdki, phantom_gtab, phantom_data)
+    fitted.clear()
+
+    checkpoint = str(tmp_path)
+    maps = parallel.fit_voxels(msdki, phantom_gtab, phantom_data, checkpoint=checkpoint)
+    assert_maps_equal(maps, expected)
+    assert sum(fitted) == len(phantom_data) and len(fitted) > 2
+
+    # A resumed fit only fits the chunks without a saved result.
+    directory = parallel.checkpoint_dir(checkpoint, msdki, phantom_data, {})
+    chunks = sorted(os.listdir(directory))
+    assert len(chunks) == len(fitted)
+    shutil.rmtree(os.path.join(directory, chunks[1]))
+    fitted.clear()
+    maps = parallel.fit_voxels(msdki, phantom_gtab, phantom_data, checkpoint=checkpoint)
+    assert_maps_equal(maps, expected)
+    assert len(fitted) == 1
+
+    # Other options or data do not reuse the checkpoint.
+    fitted.clear()
+    parallel.fit_voxels(msdki, phantom_gtab, phantom_data[:-1], checkpoint=checkpoint)
+    assert sum(fitted) == len(phantom_data) - 1
+
+
+def test_checkpoint_keeps_chunked_maps(phantom_gtab, phantom_data, tmp_path, monkeypatch):
+    monkeypatch.setattr(parallel, 'CHECKPOINT_VOXELS', 40)
+    expected = parallel.fit_voxels(mapmri, phantom_gtab, phantom_data, metrics='RTOP,ODF')
+    maps = parallel.fit_voxels(mapmri, phantom_gtab, phantom_data, checkpoint=str(tmp_path),
+                               metrics='RTOP,ODF')
+    # Read back chunk by chunk from the saved chunks.
+    assert isinstance(maps['ODF'], ChunkedMap)
+    assert_maps_equal(maps, expected)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Maps written to the HDF5 container and exported back to NIfTI.
+"""
+
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+
+from microstructure import container, output  # noqa: E402
+
+
+@pytest.fixture
+def fitted():
+    rng = np.random.default_rng(0)
+    mask = np.zeros((5, 4, 3), dtype=bool)
+    mask[1:4, 1:3, 1:] = True
+    n_voxels = int(mask.sum())
+    maps = {
+        'FA': rng.uniform(size=n_voxels),
+        'WMTI/AWF': rng.uniform(size=n_voxels).astype(np.float32),
+        'ODF': rng.uniform(size=(n_voxels, 7)),
+    }
+    affine = np.diag([2., 2., 2.5, 1.])
+    affine[:3, 3] = [-4., 3., 1.]
+    return maps, mask, affine
+
+
+def test_container_round_trip(fitted, tmp_path):
+    maps, mask, affine = fitted
+    outdir = str(tmp_path / 'hdf5')
+    container.save_maps(outdir, maps, mask, affine, info={'model': 'test'})
+    filename = os.path.join(outdir, container.CONTAINER)
+    assert container.read_provenance(filename)['model'] == 'test'
+
+    reference = str(tmp_path / 'nifti')
+    output.save_maps(reference, maps, mask, affine)
+    exported = str(tmp_path / 'exported')
+    container.export(filename, exported)
+    for name in maps:
+        image = nib.load(os.path.join(exported, name + '.nii.gz'))
+        expected = nib.load(os.path.join(reference, name + '.nii.gz'))
+        np.testing.assert_allclose(image.affine, affine)
+        assert image.get_data_dtype() == expected.get_data_dtype()
+        np.testing.assert_array_equal(np.asarray(image.dataobj), np.asarray(expected.dataobj))
+
+    region = (slice(1, 3), slice(None), slice(2, 3))
+    np.testing.assert_array_equal(container.read_map(filename, 'ODF', region),
+                                  np.asarray(nib.load(os.path.join(reference, 'ODF.nii.gz'))
+                                             .dataobj)[region])
+
+
+def test_export_selected_maps(fitted, tmp_path):
+    maps, mask, affine = fitted
+    container.save_maps(str(tmp_path), maps, mask, affine, float32=True)
+    filename = str(tmp_path / container.CONTAINER)
+    container.export(filename, names=['FA'], compression=0)
+    image = nib.load(str(tmp_path / 'FA.nii'))
+    assert image.get_data_dtype() == np.float32
+    assert not os.path.exists(str(tmp_path / 'ODF.nii'))
+    with pytest.raises(ValueError):
+        container.export(filename, names=['MD'])
+
+
+def masked_chunks(dataset, mask):
+    # The chunks of the grid that hold a voxel of the mask.
+    edges = dataset.chunks[:mask.ndim]
+    tiles = np.ndindex(*(-(-n // edge) for n, edge in zip(mask.shape, edges)))
+    return sum(mask[tuple(slice(i * edge, (i + 1) * edge) for i, edge in zip(tile, edges))].any()
+               for tile in tiles)
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_only_masked_chunks_stored(fitted, tmp_path, monkeypatch, stream):
+    _, _, affine = fitted
+    # Chunks of 2x2x2 voxels, and a mask that leaves chunks of its slabs empty.
+    monkeypatch.setattr(container, 'CHUNK_BYTES', 64)
+    mask = np.zeros((5, 4, 3), dtype=bool)
+    mask[0:2, 0:2, 0:2] = True
+    mask[3, 3, 2] = True
+    FA = np.arange(1, mask.sum() + 1, dtype=np.float64)
+    if stream:
+        map_stream = output.MapStream(str(tmp_path / 'stream'), mask.shape, np.nonzero(mask), affine)
+        map_stream.write(0, len(FA), {'FA': FA})
+        container.save_stream(str(tmp_path), map_stream)
+    else:
+        container.save_maps(str(tmp_path), {'FA': FA}, mask, affine)
+
+    with h5py.File(str(tmp_path / container.CONTAINER), 'r') as f:
+        dataset = f['FA']
+        assert dataset.chunks == (2, 2, 2)
+        assert dataset.id.get_num_chunks() == masked_chunks(dataset, mask) == 2
+        expected = np.zeros(mask.shape)
+        expected[mask] = FA
+        np.testing.assert_array_equal(dataset[()], expected)
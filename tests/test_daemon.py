@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Access to the socket of the warm worker daemon.
+"""
+
+import os
+import stat
+
+import pytest
+from microstructure import daemon
+
+
+@pytest.fixture
+def server(tmp_path):
+    # Bound without serving: only the socket and dispatch() are used.
+    umask = os.umask(0)
+    try:
+        server = daemon.Daemon(str(tmp_path / 'daemon.sock'))
+    finally:
+        os.umask(umask)
+    yield server
+    server.server_close()
+    server.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def test_socket_owner_only(server):
+    assert stat.S_IMODE(os.stat(server.server_address).st_mode) & 0o077 == 0
+
+
+@pytest.mark.parametrize('argv', [['serve', '--socket', 'other.sock'], ['batch', 'dwi.nii.gz'],
+                                  ['bench'], [], ['-v']])
+def test_rejects_other_commands(server, argv):
+    with pytest.raises(ValueError):
+        server.dispatch({'op': 'submit', 'argv': argv, 'wait': False})
+    assert not server.jobs
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+The batched FWDTI engine against Dipy's NLS fit.
+"""
+
+import numpy as np
+import pytest
+from microstructure import benchmark
+from microstructure.models import fwdti
+
+# The maps agree to the relative cost tolerance of the solvers.
+TOLERANCE = {'FA': 1e-5, 'FW': 1e-5, 'MD': 1e-7, 'RD': 1e-7, 'AD': 1e-7}
+
+
+@pytest.fixture(scope='module')
+def fwdti_phantom(multishell):
+    gtab, _ = multishell
+    rng = np.random.default_rng(1)
+    return gtab, benchmark.simulate(gtab.bvals, gtab.bvecs, 30, rng)
+
+
+@pytest.mark.parametrize('warm_start', [False, True])
+def test_batched_matches_dipy(fwdti_phantom, warm_start):
+    gtab, data = fwdti_phantom
+    expected = fwdti.fit(fwdti.build_model(gtab), data)
+    maps = fwdti.fit(fwdti.build_model(gtab, fwdti_engine='batched', warm_start=warm_start),
+                     data)
+    for name, tolerance in TOLERANCE.items():
+        np.testing.assert_allclose(maps[name], expected[name], rtol=0, atol=tolerance,
+                                   err_msg=name)
+
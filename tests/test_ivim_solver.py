@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+The batched IVIM engines against Dipy's VarPro fit.
+
+The phantom has no noise, so the least squares optimum is the truth, and its
+parameters lie within the bounds of both fits: D* and D within the range of
+Dipy's differential evolution, f above the lower bound of its convex step.
+"""
+
+import numpy as np
+import pytest
+from microstructure.models import ivim
+
+# Largest differences of (f, D*, D) from Dipy's fit: batched-varpro refines
+# the same least squares, the batched engine fits D on the high b-values
+# first, which leaves the segmented bias of the perfusion.
+TOLERANCE = {'batched': (0.04, 4e-3, 2e-5),
+             'batched-varpro': (1e-3, 1e-4, 1e-6)}
+
+
+@pytest.fixture(scope='module')
+def ivim_phantom(multishell):
+    gtab, _ = multishell
+    rng = np.random.default_rng(2)
+    n_voxels = 10
+    f = rng.uniform(0.12, 0.18, n_voxels)[:, None]
+    D_star = rng.uniform(6e-3, 9e-3, n_voxels)[:, None]
+    D = rng.uniform(0.6e-3, 0.9e-3, n_voxels)[:, None]
+    return gtab, 1000 * (f * np.exp(-gtab.bvals * D_star) + (1 - f) * np.exp(-gtab.bvals * D))
+
+
+@pytest.mark.parametrize('engine', ['batched', 'batched-varpro'])
+def test_batched_matches_dipy(ivim_phantom, engine):
+    gtab, data = ivim_phantom
+    # Dipy's differential evolution draws from the global generator.
+    np.random.seed(0)
+    expected = ivim.fit(ivim.build_model(gtab), data)
+    maps = ivim.fit(ivim.build_model(gtab, ivim_engine=engine), data)
+    for name, tolerance in zip(['Perfusion', 'D_star', 'D'], TOLERANCE[engine]):
+        np.testing.assert_allclose(maps[name], expected[name], rtol=0, atol=tolerance, err_msg=name)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Hits and invalidation of the AMICO kernel cache.
+"""
+
+import os
+
+import pytest
+
+pytest.importorskip('amico')
+
+from microstructure import kernel_cache  # noqa: E402
+
+
+class Model:
+    id = 'NODDI'
+
+    def __init__(self, dPar=1.7e-3):
+        self.dPar = dPar
+
+
+class Evaluation:
+    """The calls kernel_cache makes on an amico.Evaluation."""
+
+    def __init__(self, model):
+        self.model = model
+        self.config = {}
+        self.generated = 0
+        self.kernels = None
+
+    def set_config(self, name, value):
+        self.config[name] = value
+
+    def generate_kernels(self, regenerate=False, **kwargs):
+        kernels = os.path.join(self.config['ATOMS_path'], 'kernels.txt')
+        if regenerate or not os.path.exists(kernels):
+            self.generated += 1
+            with open(kernels, 'w') as f:
+                f.write(repr((self.model.dPar, sorted(kwargs.items()))))
+
+    def load_kernels(self):
+        with open(os.path.join(self.config['ATOMS_path'], 'kernels.txt')) as f:
+            self.kernels = f.read()
+
+
+@pytest.fixture
+def scheme(tmp_path):
+    schemeFile = str(tmp_path / 'dwi.scheme')
+    with open(schemeFile, 'w') as f:
+        f.write('VERSION: BVECTOR\n0 0 0 0\n1 0 0 1000\n')
+    return schemeFile
+
+
+def load(scheme, cache_dir, model=None, **kwargs):
+    ae = Evaluation(model or Model())
+    kernel_cache.load_kernels(ae, scheme, cache_dir=cache_dir, **kwargs)
+    return ae
+
+
+def test_kernels_generated_once(scheme, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    assert load(scheme, cache_dir).generated == 1
+    ae = load(scheme, cache_dir)
+    assert ae.generated == 0 and ae.kernels is not None
+    directory = os.path.join(cache_dir, 'kernels')
+    assert len([name for name in os.listdir(directory) if not name.endswith('.lock')]) == 1
+
+
+def test_kernels_invalidated(scheme, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    load(scheme, cache_dir)
+    # Other model parameters, kernel options or scheme.
+    assert load(scheme, cache_dir, model=Model(dPar=2e-3)).generated == 1
+    assert load(scheme, cache_dir, lmax=8).generated == 1
+    with open(scheme, 'a') as f:
+        f.write('0 1 0 2000\n')
+    assert load(scheme, cache_dir).generated == 1
+    assert load(scheme, cache_dir).generated == 0
+
+
+def test_kernels_evicted_with_their_locks(scheme, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    load(scheme, cache_dir)
+    load(scheme, cache_dir, model=Model(dPar=2e-3), cache_size=0)
+    assert len(os.listdir(os.path.join(cache_dir, 'kernels'))) == 2
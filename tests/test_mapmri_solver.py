@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+The qp engine of the constrained MAP-MRI variants against Dipy's cvxpy fit.
+"""
+
+import numpy as np
+import pytest
+from microstructure.models import mapmri
+
+# Fitted (normalized) signal; OSQP stops at cvxpy's default tolerance in Dipy.
+SIGNAL_TOLERANCE = {'CLARABEL': 1e-5, 'OSQP': 1e-3}
+
+
+@pytest.mark.parametrize('solver', mapmri.QP_SOLVERS)
+@pytest.mark.parametrize('variant', mapmri.QP_VARIANTS)
+def test_qp_engine_matches_dipy(multishell, variant, solver):
+    pytest.importorskip('cvxpy')
+    pytest.importorskip(solver.lower())
+    gtab, data = multishell
+    dipy_fit = mapmri.build_model(gtab, model=variant, cvxpy_solver=solver).fit(data)
+    qp_fit = mapmri.build_model(gtab, model=variant, cvxpy_solver=solver,
+                                mapmri_engine='qp').fit(data)
+
+    # Where Dipy's solver fails, it falls back to the unconstrained fit.
+    solved = np.array([dipy_fit[i].errorcode == 0 for i in range(len(data))])
+    assert solved.any()
+    assert all(qp_fit[i].errorcode == 0 for i in range(len(data)))
+    np.testing.assert_allclose(qp_fit.fitted_signal()[solved], dipy_fit.fitted_signal()[solved],
+                               rtol=0, atol=SIGNAL_TOLERANCE[solver])
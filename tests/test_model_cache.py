@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Hits and invalidation of the model cache.
+"""
+
+import os
+
+import numpy as np
+import pytest
+from dipy.core.gradients import gradient_table
+from dipy.reconst.mapmri import MapmriModel
+from microstructure import model_cache
+from microstructure.models import mapmri
+
+
+@pytest.fixture(autouse=True)
+def no_resident_models(monkeypatch):
+    monkeypatch.setattr(model_cache, '_resident', type(model_cache._resident)())
+
+
+def entries(cache_dir):
+    return sorted(os.listdir(os.path.join(cache_dir, 'models')))
+
+
+def test_cache_hit(multishell, tmp_path):
+    gtab, data = multishell
+    cache_dir = str(tmp_path)
+    model = model_cache.build_model(mapmri, gtab, cache_dir=cache_dir, model='anisoMAPL')
+    assert len(entries(cache_dir)) == 1
+    # Resident in this process, then loaded from the cache in another one.
+    assert model_cache.build_model(mapmri, gtab, cache_dir=cache_dir, model='anisoMAPL') is model
+    model_cache._resident.clear()
+    loaded = model_cache.build_model(mapmri, gtab, cache_dir=cache_dir, model='anisoMAPL')
+    assert loaded is not model and type(loaded) is type(model)
+    assert any(isinstance(value, np.memmap) for value in vars(loaded).values())
+    assert len(entries(cache_dir)) == 1
+
+    np.testing.assert_allclose(loaded.fit(data[:2]).rtop(), model.fit(data[:2]).rtop(), rtol=1e-12)
+
+
+def test_cache_invalidation(multishell, tmp_path):
+    gtab, data = multishell
+    cache_dir = str(tmp_path)
+    model_cache.build_model(mapmri, gtab, cache_dir=cache_dir, model='anisoMAPL')
+    # Another variant, another acquisition.
+    model_cache.build_model(mapmri, gtab, cache_dir=cache_dir, model='isoMAPL')
+    bvals = gtab.bvals.copy()
+    bvals[-1] += 5
+    other = gradient_table(bvals, gtab.bvecs, big_delta=gtab.big_delta,
+                           small_delta=gtab.small_delta)
+    model_cache.build_model(mapmri, other, cache_dir=cache_dir, model='anisoMAPL')
+    assert len(entries(cache_dir)) == 3
+
+    # A corrupt entry is rebuilt.
+    model_cache._resident.clear()
+    entry = os.path.join(cache_dir, 'models', entries(cache_dir)[0])
+    with open(os.path.join(entry, 'model.pkl'), 'wb') as f:
+        f.write(b'corrupt')
+    for variant, table in [('anisoMAPL', gtab), ('isoMAPL', gtab), ('anisoMAPL', other)]:
+        model = model_cache.build_model(mapmri, table, cache_dir=cache_dir, model=variant)
+        assert isinstance(model, MapmriModel)
+    assert len(entries(cache_dir)) == 3
+    with open(os.path.join(entry, 'model.pkl'), 'rb') as f:
+        assert f.read() != b'corrupt'
+
+
+def test_cache_eviction(multishell, tmp_path):
+    gtab, data = multishell
+    cache_dir = str(tmp_path)
+    model_cache.build_model(mapmri, gtab, cache_dir=cache_dir, model='anisoMAPL')
+    first = entries(cache_dir)
+    # Over the size of the cache, the least recently used entries go, but
+    # never the one just stored.
+    model_cache.build_model(mapmri, gtab, cache_dir=cache_dir, cache_size=0, model='isoMAPL')
+    assert len(entries(cache_dir)) == 1 and entries(cache_dir) != first
+
+
+def test_no_cache(multishell, tmp_path):
+    gtab, data = multishell
+    model = model_cache.build_model(mapmri, gtab, cache_dir=None, model='anisoMAPL')
+    assert isinstance(model, MapmriModel)
+    assert not os.listdir(tmp_path)
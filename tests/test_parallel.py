@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Maps of parallel.fit_voxels across numbers of jobs.
+"""
+
+import numpy as np
+import pytest
+from microstructure import parallel
+from microstructure.models import fwdti, mapmri, msdki
+from microstructure.voxels import ChunkedMap
+
+
+# BLAS kernels round differently with the alignment of their arrays, which
+# differs from process to process.
+RTOL = 1e-12
+
+
+def assert_maps_equal(maps, expected):
+    assert sorted(maps) == sorted(expected)
+    for name in expected:
+        np.testing.assert_allclose(maps[name], expected[name], rtol=RTOL, atol=0)
+
+
+@pytest.mark.parametrize('module, options', [(msdki, {}),
+                                             (fwdti, {'fwdti_engine': 'batched'}),
+                                             (mapmri, {'metrics': 'RTOP,ODF'})])
+def test_maps_do_not_depend_on_n_jobs(phantom_gtab, phantom_data, module, options):
+    serial = parallel.fit_voxels(module, phantom_gtab, phantom_data, n_jobs=1, **options)
+    pooled = parallel.fit_voxels(module, phantom_gtab, phantom_data, n_jobs=3, **options)
+    assert len(parallel.chunk_bounds(len(phantom_data), 3 * parallel.CHUNKS_PER_JOB)) > 1
+    assert_maps_equal(pooled, serial)
+    # Chunked maps come back chunked, read from the files of the workers.
+    for name, values in serial.items():
+        assert isinstance(pooled[name], ChunkedMap) == isinstance(values, ChunkedMap)
+
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Fits on the gathered masked voxels against Dipy's fit of the whole volume.
+"""
+
+import os
+
+import dipy.reconst.msdki as dipy_msdki
+import nibabel as nib
+import numpy as np
+from microstructure.benchmark import FILES
+from microstructure.models import msdki
+from microstructure.voxels import gather, scatter
+
+
+def test_gather_scatter_matches_full_volume_fit(phantom, phantom_gtab):
+    dwi_data = nib.load(os.path.join(phantom, FILES['dwiFile'])).get_fdata()
+    mask_data = nib.load(os.path.join(phantom, FILES['maskFile'])).get_fdata()
+    data, mask = gather(dwi_data, mask_data)
+    assert data.shape == (mask.sum(), dwi_data.shape[-1])
+    assert data.flags['C_CONTIGUOUS']
+
+    maps = msdki.fit(msdki.build_model(phantom_gtab), data)
+    volume_fit = dipy_msdki.MeanDiffusionKurtosisModel(phantom_gtab).fit(dwi_data, mask=mask)
+    for name, values in msdki.maps(volume_fit).items():
+        volume = scatter(maps[name], mask)
+        assert volume.shape == mask.shape
+        np.testing.assert_array_equal(volume[~mask], 0)
+        np.testing.assert_allclose(volume[mask], values[mask], rtol=1e-10, atol=1e-12)
+
+
+def test_scatter_keeps_trailing_axes():
+    mask = np.zeros((3, 4, 2), dtype=bool)
+    mask[1, 1:3, 1] = True
+    values = np.arange(2 * 5, dtype=np.float32).reshape(2, 5)
+    volume = scatter(values, mask)
+    assert volume.shape == (3, 4, 2, 5) and volume.dtype == np.float32
+    np.testing.assert_array_equal(volume[mask], values)
+    assert not volume[~mask].any()